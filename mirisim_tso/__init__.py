@@ -1,11 +1,30 @@
-#from main import ?
+# The modules of the package are imported when first used (PEP 562): "import mirisim_tso" doesn't load astropy,
+# configobj or the modules of the post treatment, which matters for short command line runs and worker processes.
 
-from . import utils
-from . import effects
-from .main import single_simulation_post_treatment, sequential_lightcurve_post_treatment
+import importlib
 
 from .version import __version__
 
 import logging
 logging.getLogger('mirisim_tso').addHandler(logging.NullHandler())
 
+_SUBMODULES = ["cache", "constants", "container", "effects", "main", "manifest", "metrics", "parallel", "scheduler",
+               "shared", "utils"]
+# key: attribute of the package ; value: module defining it
+_ATTRIBUTES = {"single_simulation_post_treatment": "main", "sequential_lightcurve_post_treatment": "main"}
+
+__all__ = _SUBMODULES + list(_ATTRIBUTES) + ["__version__"]
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    if name in _ATTRIBUTES:
+        value = getattr(importlib.import_module("." + _ATTRIBUTES[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,276 @@
+"""
+Caches of the post treatment.
+
+CoefficientCache: cache of the per pixel coefficients of the deterministic effects.
+
+Many simulations of a TSO have the same illum_model (all the out-of-transit ones, for instance). The coefficients
+of response_drift, response_drift_one and idle_recovery only depend on the illum_model, the gain and the effect
+parameters, so they are stored with a key derived from the digest of the illum_model content: a duplicate
+illumination costs one lookup, instead of decoding the illum_model and computing the coefficients again.
+
+The cache is kept in memory with a least recently used eviction, and optionally on disk as .npy files.
+
+StageCache: on-disk cache of the ramps with the deterministic effects (background, drift, idle, anneal), before
+the noise. A rerun where only the noise changed (seed, noise, noise_bis, number of realisations) starts from these
+ramps, without reading the det_images and computing the deterministic effects again.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from . import effects
+from . import manifest
+from . import metrics
+from . import utils
+from . import version
+
+LOG = logging.getLogger(__name__)
+
+
+class CoefficientCache:
+    """
+    Cache of the terms computed by effects.signal_terms.
+
+    :param int max_entries: [optional] maximum number of entries kept in memory. 0 disables the memory cache.
+    :param str directory: [optional] directory of the on-disk cache. By default, no on-disk cache.
+    """
+
+    def __init__(self, max_entries=32, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(illum_model, gain, config, nb_x):
+        """
+        Key of the terms of an illum_model.
+
+        :param utils.IllumModel illum_model: illum_model of the simulation
+        :param float gain: Gain in electron/DN
+        :param dict config: validated configuration
+        :param int nb_x: number of columns of the det_image
+        :return: hexadecimal digest
+        :rtype: str
+        """
+        text = repr((illum_model.digest, float(gain), int(nb_x), effects.effect_parameters(config),
+                     effects.TABLE_STEP, effects.EFFECTS_VERSION))
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=20).hexdigest()
+
+    def signal_terms(self, illum_model, gain, config, nb_x):
+        """
+        Same as effects.signal_terms(illum_model.signal(gain), config, nb_x), from the cache when possible.
+
+        :param utils.IllumModel illum_model: illum_model of the simulation
+        :param float gain: Gain in electron/DN
+        :param dict config: validated configuration
+        :param int nb_x: number of columns of the det_image
+        :return: (key, terms), the terms are read-only
+        :rtype: tuple
+        """
+        key = self.key(illum_model, gain, config, nb_x)
+
+        terms = self._entries.get(key)
+        if terms is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return key, terms
+
+        filename = None
+        if self.directory is not None:
+            filename = os.path.join(self.directory, key + ".npy")
+            if os.path.isfile(filename):
+                terms = self._from_array(np.load(filename))
+                self.disk_hits += 1
+                self._store(key, terms)
+                return key, terms
+
+        self.misses += 1
+        terms = effects.signal_terms(illum_model.signal(gain), config, nb_x)
+        terms = self._from_array(self._to_array(terms)) if terms else []
+        self._store(key, terms)
+        if filename is not None and terms:
+            # Write then rename, so that another process never reads a partial file
+            temporary_filename = "{}.{}.tmp.npy".format(filename[:-4], os.getpid())
+            np.save(temporary_filename, self._to_array(terms))
+            os.replace(temporary_filename, filename)
+
+        return key, terms
+
+    def _store(self, key, terms):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = terms
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _to_array(terms):
+        """
+        :return: prefactors and alphas, np.array(nb_terms, 2, nb_y, nb_x)
+        """
+        return np.stack([np.stack([prefactor, alpha]) for (prefactor, alpha, offset) in terms])
+
+    @staticmethod
+    def _from_array(array):
+        array.flags.writeable = False
+        return [(prefactor, alpha, 0.) for (prefactor, alpha) in array]
+
+    def stats(self):
+        """
+        :return: number of hits in memory, of hits on disk and of misses
+        :rtype: dict
+        """
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+
+class StageCache:
+    """
+    On-disk cache of the ramps with the deterministic effects, one .npy file (ramp) and one .json file (metadata)
+    per simulation.
+
+    The key of a ramp is derived from the input files of the simulation (path, size, modification time), the
+    background file, the sections of the configuration used by the deterministic effects, t_0, phase, the version
+    of MIRISim TSO and the version of the computation of the effects (effects.EFFECTS_VERSION).
+
+    :param str directory: directory of the cache
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(simulation_folder, t_0, phase, config_dict):
+        """
+        Key of the ramp of a simulation.
+
+        :param str simulation_folder: path to the MIRISim simulation folder
+        :param float t_0: Time in second since beginning of the observation
+        :param float phase: orbital phase
+        :param dict config_dict: validated configuration
+        :return: hexadecimal digest
+        :rtype: str
+        """
+        inputs = {os.path.abspath(filename): manifest.file_fingerprint(filename)
+                  for filename in manifest.simulation_inputs(simulation_folder)}
+        bck_filename = config_dict["background"]["filename"]
+        if bck_filename is not None:
+            inputs[os.path.abspath(bck_filename)] = manifest.file_fingerprint(bck_filename)
+
+        text = json.dumps([version.__version__, effects.EFFECTS_VERSION, inputs,
+                           utils.config_digest(config_dict, utils.DETERMINISTIC_SECTIONS), float(t_0), float(phase)],
+                          sort_keys=True)
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=20).hexdigest()
+
+    def _filenames(self, key):
+        filename = os.path.join(self.directory, key)
+        return filename + ".npy", filename + ".json"
+
+    def load(self, key):
+        """
+        :param str key: key of the ramp, see StageCache.key
+        :return: (new_ramp, metadatas), or None if the ramp is not in the cache
+        :rtype: tuple
+        """
+        (ramp_filename, metadata_filename) = self._filenames(key)
+        # The metadata file is written last, its presence means the ramp is complete
+        if not os.path.isfile(metadata_filename):
+            self.misses += 1
+            return None
+
+        with open(metadata_filename) as metadata_file:
+            metadatas = json.load(metadata_file)
+        new_ramp = np.load(ramp_filename)
+        metrics.add_bytes(read=new_ramp.nbytes)
+        self.hits += 1
+        return new_ramp, metadatas
+
+    def store(self, key, new_ramp, metadatas):
+        """
+        :param str key: key of the ramp, see StageCache.key
+        :param np.ndarray new_ramp: ramp with the deterministic effects, in DN
+        :param dict metadatas: metadata of the deterministic effects
+        """
+        (ramp_filename, metadata_filename) = self._filenames(key)
+        suffix = ".{}.tmp".format(os.getpid())
+        # Write then rename, so that another process never reads a partial file
+        with open(ramp_filename + suffix, "wb") as ramp_file:
+            np.save(ramp_file, new_ramp)
+        os.replace(ramp_filename + suffix, ramp_filename)
+        with open(metadata_filename + suffix, "w") as metadata_file:
+            json.dump(metadatas, metadata_file, default=float)
+        os.replace(metadata_filename + suffix, metadata_filename)
+
+    def stats(self):
+        """
+        :return: number of hits and of misses
+        :rtype: dict
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def cache_options(config_dict):
+    """
+    Options of CoefficientCache in the configuration.
+
+    :param dict config_dict: validated configuration
+    :return: keyword arguments of CoefficientCache
+    :rtype: dict
+    """
+    cache_conf = config_dict.get("cache", {})
+    return {"max_entries": cache_conf.get("coefficients_size", 32),
+            "directory": cache_conf.get("coefficients_dir", None)}
+
+
+def run_caches(config_dict):
+    """
+    Caches of a process, from the configuration.
+
+    :param dict config_dict: validated configuration
+    :return: coefficient cache and stage cache (None if config["cache"]["stage_dir"] is not set)
+    :rtype: tuple(CoefficientCache, StageCache)
+    """
+    stage_dir = config_dict.get("cache", {}).get("stage_dir", None)
+    stage_cache = None if stage_dir is None else StageCache(stage_dir)
+    return CoefficientCache(**cache_options(config_dict)), stage_cache
+
+
+def caches_stats(coefficient_cache, stage_cache=None):
+    """
+    :return: stats of the caches of a process, see log_stats
+    :rtype: dict
+    """
+    return {"coefficients": coefficient_cache.stats(),
+            "stage": None if stage_cache is None else stage_cache.stats()}
+
+
+def log_stats(stats):
+    """
+    Report the hits and misses of the caches of a run.
+
+    :param stats: stats of the caches of a process, see caches_stats, or list of stats of several processes
+    :type stats: dict or list(dict)
+    """
+    if isinstance(stats, dict):
+        stats = [stats]
+
+    coefficients = [process_stats["coefficients"] for process_stats in stats]
+    total = {name: sum(cache_stats[name] for cache_stats in coefficients) for name in ("hits", "disk_hits", "misses")}
+    LOG.info("Coefficient cache | {hits} hits, {disk_hits} hits on disk, {misses} misses".format(**total))
+
+    stages = [process_stats["stage"] for process_stats in stats if process_stats["stage"] is not None]
+    if stages:
+        total = {name: sum(cache_stats[name] for cache_stats in stages) for name in ("hits", "misses")}
+        LOG.info("Stage cache | {hits} hits, {misses} misses".format(**total))
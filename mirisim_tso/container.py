@@ -0,0 +1,458 @@
+"""
+Consolidated output of the post treatment: one multi-integration FITS file per variant and noise realisation,
+instead of one FITS file per simulation folder, optionally segmented like the JWST products.
+
+The file is created before the post treatment, with its final size, from the first det_image: primary HDU,
+SCI extension (nb_integrations, nb_frames, nb_y, nb_x), REFOUT extension (if in the det_images) with one plane per
+integration, the other extensions of the det_image (PIXELDQ, ASDF, ...) and INTEGRATIONS table (integration index,
+simulation, time_0, phase and obs_time of each integration, and with noise the spawn key of its noise seed sequence). The post treatment of a simulation writes its
+integrations in place, at their offset in the SCI and REFOUT extensions, from any process and in any order:
+no small file per simulation, no merge pass afterwards.
+
+With config["container"]["segment_size"], the integrations are split in segments of at most this size, written in
+<filename>_<suffix>-segNNN.fits with the EXSEGNUM, EXSEGTOT, INTSTART, INTEND and NINTS keywords of the JWST segmented
+products (see misc/merge_sim_files.py). The segment of each simulation is listed in <filename>_<suffix>-segments.json.
+
+The integrations are numbered from the index of the simulation folder (simulation_012 -> 12 * nb_integrations,
+see first_integration_indices), also when filtername or nb_simulations select simulations that don't start at 0:
+INTSTART and INTEND are the numbers of the first and last integrations of the file, NINTS the number of integrations
+up to the last simulation of the run.
+"""
+import functools
+import json
+import logging
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from . import effects
+from . import utils
+from . import version
+
+LOG = logging.getLogger(__name__)
+
+INTEGRATIONS_EXTNAME = "INTEGRATIONS"
+
+# Extensions with one plane per integration, besides the science cube (first extension)
+SCI_EXTNAME = "SCI"
+REFOUT_EXTNAME = "REFOUT"
+
+# Data type of the cubes, whatever the type of the input det_images
+DATA_TYPE = np.dtype(">f4")
+
+# Size of a FITS block, in bytes: the headers and the data are padded to a multiple of it
+BLOCK_SIZE = 2880
+
+
+def is_active(config_dict):
+    """
+    :param dict config_dict: validated configuration
+    :return: True if the outputs are written in containers, see config["container"]
+    :rtype: bool
+    """
+    return config_dict.get("container", {}).get("active", False)
+
+
+def container_filename(output_folder, config_dict):
+    """
+    Name of the container of an output directory.
+
+    :param str output_folder: output directory (of the run, or of a noise realisation)
+    :param dict config_dict: validated configuration (of the variant)
+    :rtype: str
+    """
+    return os.path.join(output_folder, "{}_{}.fits".format(config_dict["container"]["filename"],
+                                                           utils.output_suffix(config_dict)))
+
+
+def segments_filename(filename):
+    """
+    :param str filename: name of the container, see container_filename
+    :return: name of the index of the segments of the container
+    :rtype: str
+    """
+    return filename[:-len(".fits")] + "-segments.json"
+
+
+def segment_filename(filename, segment):
+    """
+    :param str filename: name of the container, see container_filename
+    :param int segment: segment number, starting at 1
+    :return: name of the segment
+    :rtype: str
+    """
+    return "{}-seg{:03d}.fits".format(filename[:-len(".fits")], segment)
+
+
+def output_filename(output_folder, config_dict):
+    """
+    File created for the outputs of an output directory: the container, or the index of its segments.
+
+    :param str output_folder: output directory (of the run, or of a noise realisation)
+    :param dict config_dict: validated configuration (of the variant)
+    :rtype: str
+    """
+    filename = container_filename(output_folder, config_dict)
+    if config_dict["container"].get("segment_size") is None:
+        return filename
+    return segments_filename(filename)
+
+
+def run_containers(config_dict):
+    """
+    Containers of a run, one per variant and noise realisation.
+
+    :param dict config_dict: validated configuration
+    :return: list of (variant_config, filename, realisation), realisation is None with a single noise realisation
+    :rtype: list(tuple)
+    """
+    containers = []
+    for (variant, variant_config) in utils.variant_configs(config_dict):
+        output_folder = variant_config["simulations"]["output_dir"]
+        nb_realisations = utils.nb_realisations(variant_config)
+        if nb_realisations > 1:
+            output_folders = [(utils.realisation_folder(output_folder, realisation), realisation)
+                              for realisation in range(nb_realisations)]
+        else:
+            output_folders = [(output_folder, None)]
+        containers += [(variant_config, container_filename(folder, variant_config), realisation)
+                       for (folder, realisation) in output_folders]
+    return containers
+
+
+def simulation_name(simulation_folder):
+    """
+    :param str simulation_folder: path to the MIRISim simulation folder
+    :return: name of the simulation in the INTEGRATIONS table
+    :rtype: str
+    """
+    return os.path.basename(os.path.normpath(simulation_folder))
+
+
+def first_integration_indices(tasks, nb_integrations):
+    """
+    Index of the first integration of each simulation in the exposure, from the index of its folder (see
+    utils.simulation_index), or from its position in tasks if a folder name doesn't end with an index.
+
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time), all the simulations of the run
+    :param int nb_integrations: number of integrations per simulation
+    :rtype: list(int)
+    """
+    indices = [utils.simulation_index(task[0]) for task in tasks]
+    if None in indices:
+        indices = range(len(tasks))
+    return [index * nb_integrations for index in indices]
+
+
+def integrations_table(tasks, nb_integrations, first_integrations=None, spawn_keys=None):
+    """
+    Table of the integrations of a container, in the order of the tasks.
+
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time)
+    :param int nb_integrations: number of integrations per simulation
+    :param list first_integrations: [optional] index of the first integration of each task in the exposure, see
+                                    first_integration_indices. By default, the integrations are numbered from 0.
+    :param list spawn_keys: [optional] spawn key of the noise seed sequence of each task, see
+                            effects.noise_seed_sequence
+    :rtype: fits.BinTableHDU
+    """
+    names = [simulation_name(task[0]) for task in tasks]
+    rows = np.repeat(np.arange(len(tasks)), nb_integrations)
+    obs_times = [np.nan if task[3] is None else task[3] for task in tasks]
+    if first_integrations is None:
+        first_integrations = nb_integrations * np.arange(len(tasks))
+    integrations = np.array(first_integrations)[rows] + np.tile(np.arange(nb_integrations), len(tasks))
+    columns = [fits.Column(name="INTEGRATION", format="J", array=integrations),
+               fits.Column(name="SIMULATION", format="{}A".format(max(len(name) for name in names)),
+                           array=np.array(names)[rows]),
+               fits.Column(name="TIME_0", format="D", unit="s", array=np.array([task[1] for task in tasks])[rows]),
+               fits.Column(name="PHASE", format="D", array=np.array([task[2] for task in tasks])[rows]),
+               fits.Column(name="BJD_OBS", format="D", unit="d", array=np.array(obs_times, dtype=float)[rows])]
+    if spawn_keys is not None:
+        spawn_keys = [str(spawn_key) for spawn_key in spawn_keys]
+        columns.append(fits.Column(name="SPAWN_KEY", format="{}A".format(max(len(key) for key in spawn_keys)),
+                                   array=np.array(spawn_keys)[rows]))
+    return fits.BinTableHDU.from_columns(columns, name=INTEGRATIONS_EXTNAME)
+
+
+def _is_cube(index, hdu):
+    """
+    :return: True if the extension of a det_image has one plane per integration
+    """
+    return index == 1 or hdu.name == REFOUT_EXTNAME
+
+
+class IntegrationContainer:
+    """
+    Multi-integration FITS file, filled simulation per simulation. See the module docstring.
+
+    :param str filename: name of an existing container, see IntegrationContainer.create
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with fits.open(filename) as hdulist:
+            # Position and shape of the cubes in the file
+            self.cubes = {}
+            for (index, hdu) in enumerate(hdulist):
+                if index > 0 and _is_cube(index, hdu):
+                    self.cubes[SCI_EXTNAME if index == 1 else hdu.name] = (hdu.fileinfo()["datLoc"], hdu.shape)
+            table = hdulist[INTEGRATIONS_EXTNAME].data
+            # First plane and number of integrations of each simulation
+            (names, first, counts) = np.unique(table["SIMULATION"], return_index=True, return_counts=True)
+            self.integrations = {str(name): (int(row), int(count)) for (name, row, count) in zip(names, first, counts)}
+
+    @classmethod
+    def create(cls, filename, det_images_filename, tasks, config_dict, overwrite=True, first_integrations=None,
+               segment=None, realisation=None):
+        """
+        Create a container with its final size, the cubes are filled with zeros.
+
+        :param str filename: name of the container
+        :param str det_images_filename: det_image of the first simulation, its headers and its extensions without
+                                        integrations are the ones of the container
+        :param list tasks: list of (simulation_folder, t_0, phase, obs_time), the simulations of the container
+        :param dict config_dict: validated configuration (of the variant)
+        :param bool overwrite: [optional] By default, True. Overwrite the container if it already exists.
+        :param list first_integrations: [optional] index of the first integration of each task in the exposure, see
+                                        first_integration_indices. By default, from the index of the simulation folders.
+        :param tuple segment: [optional] (segment number, number of segments, number of integrations of the run)
+                              By default, the container is the only segment, with all the integrations of the run.
+        :param int realisation: [optional] index of the noise realisation of the container, see run_containers
+        :rtype: IntegrationContainer
+        """
+        output_folder = os.path.dirname(filename)
+        if output_folder and not os.path.isdir(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
+
+        with fits.open(det_images_filename) as hdulist:
+            nb_integrations = hdulist[1].header["NAXIS4"]
+            nb_container_integrations = nb_integrations * len(tasks)
+            if first_integrations is None:
+                first_integrations = first_integration_indices(tasks, nb_integrations)
+            (segment_number, nb_segments, nints) = segment or (1, 1, max(first_integrations) + nb_integrations)
+
+            primary = fits.PrimaryHDU(header=hdulist[0].header.copy())
+            header = primary.header
+            header["history"] = "Post processing with MIRISim TSO v{}".format(version.__version__)
+            header["history"] = "MIRISim TSO: {} of {} simulations, integrations listed in {}".format(
+                utils.output_suffix(config_dict), len(tasks), INTEGRATIONS_EXTNAME)
+            spawn_keys = None
+            if utils.noise_active(config_dict):
+                # Lineage of the noise of each simulation, as in the history of the files written per simulation
+                header["history"] = "MIRISim TSO: Noise seed entropy={}, spawn_key of each integration in {}".format(
+                    config_dict["noise"].get("seed"), INTEGRATIONS_EXTNAME)
+                spawn_keys = [effects.noise_spawn_key(utils.simulation_index(task[0]), realisation) for task in tasks]
+            header["TSOVISIT"] = True
+            header["EXSEGTOT"] = (nb_segments, "The total number of segments")
+            header["EXSEGNUM"] = (segment_number, "The segment number of the current product")
+            header["INTSTART"] = (min(first_integrations) + 1, "Starting integration number of this segment")
+            header["INTEND"] = (max(first_integrations) + nb_integrations, "Ending integration number of this segment")
+            header["NINTS"] = (nints, "Number of integrations in the exposure")
+            if "EFFINTTM" in header:
+                header["DURATION"] = (nints * header["EFFINTTM"], '[s] Total duration of exposure')
+                header["EFFEXPTM"] = (nints * header["EFFINTTM"], '[s] Effective exposure time')
+            primary.writeto(filename, overwrite=overwrite)
+
+            # The cubes are reserved without being computed: the data are written by each simulation
+            for (index, hdu) in enumerate(hdulist[1:], start=1):
+                if _is_cube(index, hdu):
+                    cube_header = hdu.header.copy()
+                    cube_header["BITPIX"] = -32
+                    cube_header["NAXIS4"] = nb_container_integrations
+                    for keyword in ("BZERO", "BSCALE"):
+                        cube_header.remove(keyword, ignore_missing=True)
+                    data_size = int(np.prod(hdu.shape[1:])) * nb_container_integrations * DATA_TYPE.itemsize
+                    with open(filename, "ab") as container_file:
+                        container_file.write(cube_header.tostring().encode("ascii"))
+                        container_file.truncate(container_file.tell() + -(-data_size // BLOCK_SIZE) * BLOCK_SIZE)
+                else:
+                    with fits.open(filename, mode="append") as container_hdulist:
+                        container_hdulist.append(hdu.copy())
+
+        with fits.open(filename, mode="append") as container_hdulist:
+            container_hdulist.append(integrations_table(tasks, nb_integrations, first_integrations=first_integrations,
+                                                        spawn_keys=spawn_keys))
+
+        LOG.debug("IntegrationContainer | {} created, {} integrations".format(filename, nb_container_integrations))
+        return cls(filename)
+
+    def is_layout(self, tasks):
+        """
+        :param list tasks: list of (simulation_folder, t_0, phase, obs_time)
+        :return: True if the container has the integrations of these simulations
+        :rtype: bool
+        """
+        return set(self.integrations) == {simulation_name(task[0]) for task in tasks}
+
+    def write(self, simulation_folder, new_ramp, det_image=None):
+        """
+        Write the integrations of a simulation in place. Different simulations can be written at the same time.
+
+        :param str simulation_folder: path to the MIRISim simulation folder
+        :param np.ndarray new_ramp: ramp with effects, in DN (nb_integrations, nb_frames, nb_y, nb_x)
+        :param det_image: det_image of the simulation, for its REFOUT extension (needed if the container has one)
+        :type det_image: str or utils.DetImage
+        :return: number of bytes written
+        :rtype: int
+        """
+        name = simulation_name(simulation_folder)
+        if name not in self.integrations:
+            raise ValueError("{} is not in the container {}".format(name, self.filename))
+        (first, nb_integrations) = self.integrations[name]
+
+        cubes = {SCI_EXTNAME: new_ramp}
+        if REFOUT_EXTNAME in self.cubes:
+            if det_image is None:
+                raise ValueError("The det_image of {} is needed for the {} extension of {}".format(
+                    name, REFOUT_EXTNAME, self.filename))
+            if isinstance(det_image, utils.DetImage):
+                cubes[REFOUT_EXTNAME] = det_image.extension(REFOUT_EXTNAME)
+            else:
+                with utils.DetImage(det_image) as opened_det_image:
+                    cubes[REFOUT_EXTNAME] = np.array(opened_det_image.extension(REFOUT_EXTNAME))
+
+        nb_bytes = 0
+        with open(self.filename, "r+b") as container_file:
+            for (extname, cube) in cubes.items():
+                (data_offset, shape) = self.cubes[extname]
+                if cube.shape != (nb_integrations,) + shape[1:]:
+                    raise ValueError("Shape {} of the {} of {} doesn't match the container {} ({} integrations of {})"
+                                     .format(cube.shape, extname, name, self.filename, nb_integrations, shape[1:]))
+                data = np.ascontiguousarray(cube, dtype=DATA_TYPE)
+                container_file.seek(data_offset + first * data[0].nbytes)
+                container_file.write(data.data)
+                nb_bytes += data.nbytes
+        return nb_bytes
+
+
+def read_segments(filename):
+    """
+    Index of the segments of a container, read once per process while the file is unchanged.
+
+    :param str filename: name of the index, see segments_filename
+    :return: name of the segment file of each simulation, key: simulation name (see simulation_name)
+    :rtype: dict
+    """
+    stat = os.stat(filename)
+    return _read_segments(filename, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=16)
+def _read_segments(filename, mtime_ns, size):
+    with open(filename) as segments_file:
+        return json.load(segments_file)
+
+
+def container_for(output_folder, config_dict, simulation_folder):
+    """
+    Container (or segment) of the integrations of a simulation.
+
+    :param str output_folder: output directory (of the run, or of a noise realisation)
+    :param dict config_dict: validated configuration (of the variant)
+    :param str simulation_folder: path to the MIRISim simulation folder
+    :rtype: IntegrationContainer
+    """
+    filename = container_filename(output_folder, config_dict)
+    if config_dict["container"].get("segment_size") is None:
+        return IntegrationContainer(filename)
+    segments = read_segments(segments_filename(filename))
+    return IntegrationContainer(os.path.join(os.path.dirname(filename), segments[simulation_name(simulation_folder)]))
+
+
+def simulations_per_segment(det_images_filename, segment_size):
+    """
+    Number of simulations in a segment, at least one.
+
+    :param str det_images_filename: det_image of a simulation
+    :param float segment_size: maximum size of the cubes of a segment, in MB
+    :rtype: int
+    """
+    with fits.open(det_images_filename) as hdulist:
+        simulation_size = sum(int(np.prod(hdu.shape)) * DATA_TYPE.itemsize
+                              for (index, hdu) in enumerate(hdulist) if index > 0 and _is_cube(index, hdu))
+    return max(1, int(segment_size * 1E6 // simulation_size))
+
+
+def create_segments(filename, tasks, config_dict, det_image_filename, resume=False, realisation=None):
+    """
+    Create the segments of a container, and their index.
+
+    :param str filename: name of the container, see container_filename
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time), all the simulations of the run
+    :param dict config_dict: validated configuration (of the variant)
+    :param callable det_image_filename: name of the det_image of a simulation folder
+    :param bool resume: [optional] see create_containers
+    :param int realisation: [optional] index of the noise realisation of the container, see run_containers
+    :return: True if the segments have been created, False if the existing ones are kept
+    :rtype: bool
+    """
+    index_filename = segments_filename(filename)
+    names = [simulation_name(task[0]) for task in tasks]
+    if resume and os.path.isfile(index_filename):
+        segments = read_segments(index_filename)
+        output_folder = os.path.dirname(filename)
+        if set(segments) == set(names) and all(os.path.isfile(os.path.join(output_folder, segment))
+                                               for segment in set(segments.values())):
+            LOG.info("create_segments() | resume: segments of {} kept".format(filename))
+            return False
+
+    first_det_image = det_image_filename(tasks[0][0])
+    nb_simulations = simulations_per_segment(first_det_image, config_dict["container"]["segment_size"])
+    nb_integrations = fits.getheader(first_det_image, 1)["NAXIS4"]
+    nb_segments = -(-len(tasks) // nb_simulations)
+    run_integrations = first_integration_indices(tasks, nb_integrations)
+    nints = max(run_integrations) + nb_integrations
+    segments = {}
+    for segment in range(nb_segments):
+        segment_tasks = tasks[segment * nb_simulations:(segment + 1) * nb_simulations]
+        segment_file = segment_filename(filename, segment + 1)
+        # Header of the first simulation of the segment, as in misc/merge_sim_files.py
+        IntegrationContainer.create(segment_file, det_image_filename(segment_tasks[0][0]), segment_tasks, config_dict,
+                                    overwrite=config_dict["simulations"]["overwrite"],
+                                    first_integrations=run_integrations[segment * nb_simulations:
+                                                                        (segment + 1) * nb_simulations],
+                                    segment=(segment + 1, nb_segments, nints),
+                                    realisation=realisation)
+        segments.update((simulation_name(task[0]), os.path.basename(segment_file)) for task in segment_tasks)
+
+    # Write then rename, so that a writer never reads a partial index
+    temporary_filename = "{}.{}.tmp".format(index_filename, os.getpid())
+    with open(temporary_filename, "w") as segments_file:
+        json.dump(segments, segments_file, indent=0)
+    os.replace(temporary_filename, index_filename)
+    LOG.info("create_segments() | {} segments of {} simulations for {}".format(nb_segments, nb_simulations, filename))
+    return True
+
+
+def create_containers(tasks, config_dict, det_image_filename, resume=False):
+    """
+    Create the containers of a run (see run_containers), or their segments, before the post treatment of its
+    simulations.
+
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time), all the simulations of the run
+    :param dict config_dict: validated configuration
+    :param callable det_image_filename: name of the det_image of a simulation folder
+    :param bool resume: [optional] By default, False. If True, the existing containers with the same simulations
+                        are kept, with the simulations already written.
+    :return: containers created (or segmented containers), all their integrations are to be written
+    :rtype: list(str)
+    """
+    created = []
+    for (variant_config, filename, realisation) in run_containers(config_dict):
+        if utils.output_suffix(variant_config) == "det_images":
+            LOG.warning("All effects are deactivated, not writing any output")
+            continue
+        if variant_config["container"].get("segment_size") is not None:
+            if create_segments(filename, tasks, variant_config, det_image_filename, resume=resume,
+                               realisation=realisation):
+                created.append(filename)
+            continue
+        if resume and os.path.isfile(filename) and IntegrationContainer(filename).is_layout(tasks):
+            LOG.info("create_containers() | resume: {} kept".format(filename))
+            continue
+        IntegrationContainer.create(filename, det_image_filename(tasks[0][0]), tasks, variant_config,
+                                    overwrite=variant_config["simulations"]["overwrite"], realisation=realisation)
+        created.append(filename)
+    return created
@@ -1,6 +1,7 @@
 # 23 February 2022 R Gastaud add the function add_poisson_noise  version 0.7.62
 # 24 February 2022 R Gastaud correct the  function response_drift for LRS SLITLESS  version 0.7.63
 # 28 February 2022 R Gastaud correc add the function add background version 0.7.64
+import os
 import numpy as np
 
 # from mirisim_tso import constants as c  RG
@@ -9,8 +10,34 @@ import logging
 LOG = logging.getLogger(__name__)
 
 
-def response_drift_one(original_ramp, t_0, signal, t_frame=0.159):
+def exponential_decay(alpha, t_start, nb_frames, frame):
+    """
+    Compute exp(-(t_start + k * frame) / alpha) for the frames k = 0 .. nb_frames-1.
+
+    As the frames are evenly spaced, exp(-(t_start + k * frame) / alpha) = exp(-t_start / alpha) * exp(-frame / alpha)**k
+    and the cube is obtained by a cumulative product: the exponential is evaluated twice per pixel,
+    instead of once per pixel and per frame.
+
+    :param alpha: time constant in seconds
+    :type alpha: np.array(nb_y, nb_x) or float
+    :param float t_start: time of the first frame in seconds
+    :param int nb_frames: number of frames
+    :param float frame: duration of a frame in seconds
+
+    :return: decay
+    :rtype: np.array(nb_frames, nb_y, nb_x)
     """
+    alpha = np.asarray(alpha, dtype=float)
+    decay = np.empty((nb_frames,) + alpha.shape)
+    decay[0] = np.exp(-t_start / alpha)
+    decay[1:] = np.exp(-frame / alpha)
+    np.cumprod(decay, axis=0, out=decay)
+
+    return decay
+
+
+def response_drift_one(original_ramp, t_0, signal, t_frame=0.159):
+    r"""
     This is a simpiflied version of response_drift, with only one exponential model.
     It computes the response drift effect on the ramp. Coefficients values come from
     JPL tests of 2019.
@@ -51,9 +78,6 @@ https://jwst-docs.stsci.edu/mid-infrared-instrument/miri-instrumentation/miri-de
     # - If yes, we have a det_image, and the dispatch on the different formulas needs to be done with np.where()
     # - If not, it needs to be turned into a 3D array, before np.where()
     # Can it be done outside this function ?
-    low_threshold =  75  # to avoid negative pixel
-    fading_threshold = 5000
-
     (nb_integrations, nb_frames, nb_y, nb_x) = original_ramp.shape
     
     (nbs_y, nbs_x) = signal.shape
@@ -61,29 +85,12 @@ https://jwst-docs.stsci.edu/mid-infrared-instrument/miri-instrumentation/miri-de
         #LOG.warning('problem of reference pixels,{} remove the 4 first columns from illumination model{}'.format(original_ramp.shape, signal.shape))
         signal = signal[:,4:]
 
-    # Creating two pixels masks corresponding to two different fitting regimes
-    index = np.where( (signal > low_threshold) & (signal < fading_threshold) )
-
-    alpha1 = np.ones_like(signal)
-    amp1 = np.zeros_like(signal)
+    [(prefactor1, alpha1, _)] = response_drift_one_coefficients(signal)
 
-    # Values fitted from JPL test data
-     
-    alpha1[index] = 2.59295558e+03 * np.exp(-8.57428099e-04 * signal[index]) + 1.20593193e+02
+    decay1 = exponential_decay(alpha1, t_0, nb_frames, t_frame)  # exp(-t / alpha1), t sampling the frames
 
-    amp1[index] = 2.94507350e-06 * signal[index]**2 + -3.27886892e-02 * signal[index]\
-    + -4.70669170e+00
-    
-
-    t = t_0 + np.arange(0, nb_frames) * t_frame  # Time sampling in seconds
-    t = t[:, np.newaxis, np.newaxis]  # Prepare broadcasting
-
-    prefactor1 = amp1 * alpha1
-   
-    ramp_difference_t_0 = prefactor1 * np.exp(-t_0 / alpha1)
-
-    # We integrate from t_0, need to remove evolution between t_0 and t_i (ramp_difference_t_0)
-    ramp_difference = ramp_difference_t_0 - prefactor1 * np.exp(-t / alpha1)
+    # We integrate from t_0, need to remove evolution between t_0 and t_i (ramp_difference_t_0 = decay1[0])
+    ramp_difference = prefactor1 * (decay1[0] - decay1)
     #import pdb pdb.set_trace()
     ramp_difference = ramp_difference.reshape([1, nb_frames, nb_y, nb_x]) # RG convention hypercube
     ramp_difference = np.float32(ramp_difference)
@@ -93,7 +100,7 @@ https://jwst-docs.stsci.edu/mid-infrared-instrument/miri-instrumentation/miri-de
 
 
 def response_drift(original_ramp, t_0, signal, frame=0.159):
-    """
+    r"""
     Computes the response drift effect on the ramp. Coefficients values come from JPL tests of 2019.
 
     There are 3 modes:
@@ -128,43 +135,19 @@ def response_drift(original_ramp, t_0, signal, frame=0.159):
     # - If yes, we have a det_image, and the dispatch on the different formulas needs to be done with np.where()
     # - If not, it needs to be turned into a 3D array, before np.where()
     # Can it be done outside this function ?
-    transition_threshold =  750
-    fading_threshold = 5000
-
     (nb_integrations, nb_frames, nb_y, nb_x) = original_ramp.shape
     (nbs_y, nbs_x) = signal.shape
     if( nbs_x == (nb_x+4)):
         LOG.warning('problem of reference pixels,{} remove the 4 first columns from illumination model{}'.format(original_ramp.shape, signal.shape))
         signal = signal[:,4:]
 
-    # Creating two pixels masks corresponding to two different fitting regimes
-    faint_pixels = signal < transition_threshold
-    medium_pixels = (~faint_pixels) & (signal < fading_threshold)
-
-    alpha1 = np.ones_like(signal)
-    alpha2 = np.ones_like(signal)
-    amp1 = np.zeros_like(signal)
-    amp2 = np.zeros_like(signal)
-
-    # Values fitted from JPL test data, obtained with notebook extract_responsedrift_expressions.ipynb
-    alpha1[faint_pixels] = -0.24824707509094024 * signal[faint_pixels] + 256.0307052443123
-    amp1[faint_pixels] = -3.309038643901135 * np.exp(0.002099958184394631 * signal[faint_pixels]) + -3.1679206249778638
-    alpha2[faint_pixels] = (11.128462112080102 * 55332.60403145965 * signal[faint_pixels] + 168405550.01410204) / (55332.60403145965 + (signal[faint_pixels] - 245.45591611338756)**2)
-    amp2[faint_pixels] = -0.041975980807126514 * signal[faint_pixels] + 0.28375014129499576
-
-    alpha1[medium_pixels] = 2643.2695863041595 * np.exp(-0.0008722598069934617 * signal[medium_pixels]) + 125.05736916420666
-    amp1[medium_pixels] = 3.311621436854758e-06 * signal[medium_pixels]**2 + -0.034646597553672186 * signal[medium_pixels] + -2.551106144746854
-
-    t = t_0 + np.arange(0, nb_frames) * frame  # Time sampling in seconds
-    t = t[:, np.newaxis, np.newaxis]  # Prepare broadcasting
-
-    prefactor1 = amp1 * alpha1
-    prefactor2 = amp2 * alpha2
+    [(prefactor1, alpha1, _), (prefactor2, alpha2, _)] = response_drift_coefficients(signal)
 
-    ramp_difference_t_0 = prefactor1 * np.exp(-t_0 / alpha1) + prefactor2 * np.exp(-t_0 / alpha2)
+    decay1 = exponential_decay(alpha1, t_0, nb_frames, frame)  # exp(-t / alpha1), t sampling the frames
+    decay2 = exponential_decay(alpha2, t_0, nb_frames, frame)
 
-    # We integrate from t_0, need to remove evolution between t_0 and t_i (ramp_difference_t_0)
-    ramp_difference = ramp_difference_t_0 - prefactor1 * np.exp(-t / alpha1) - prefactor2 * np.exp(-t / alpha2)
+    # We integrate from t_0, need to remove evolution between t_0 and t_i (decay[0])
+    ramp_difference = prefactor1 * (decay1[0] - decay1) + prefactor2 * (decay2[0] - decay2)
     ramp_difference = np.float32(ramp_difference)
     
     LOG.debug("response_drift() | ramp shape={:}, dtype={:} ".format(ramp_difference.shape, ramp_difference.dtype))
@@ -202,21 +185,14 @@ def anneal_recovery(original_ramp, t_0, frame, config):
     anneal_time = config["anneal_recovery"]["time"]
     (nb_integrations, nb_frames, nb_y, nb_x) = original_ramp.shape
 
-    beta1 = 197.97132 * np.ones((nb_y, nb_x))
-    amp1   = 11.600852 * np.ones((nb_y, nb_x))
-    beta2 = 991.76323 * np.ones((nb_y, nb_x))
-    amp2   = 0.86786327 * np.ones((nb_y, nb_x))
+    [(prefactor1, beta1, _), (prefactor2, beta2, _)] = anneal_recovery_coefficients(anneal_time, shape=(nb_y, nb_x))
 
-    t = t_0 + np.arange(0, nb_frames) * frame  # Time sampling in seconds
-    t = t[:, np.newaxis, np.newaxis]  # Prepare broadcasting
+    # exp(-(t + anneal_time) / beta), t sampling the frames
+    decay1 = exponential_decay(beta1, t_0 + anneal_time, nb_frames, frame)
+    decay2 = exponential_decay(beta2, t_0 + anneal_time, nb_frames, frame)
 
-    prefactor1 = amp1 * beta1
-    prefactor2 = amp2 * beta2
-
-    ramp_difference_t_0 = prefactor1 * np.exp(-(t_0 + anneal_time) / beta1) + prefactor2 * np.exp(-(t_0 + anneal_time) / beta2)
-
-    # We integrate from t_0, need to remove evolution between t_0 and t_i (ramp_difference_t_0)
-    ramp_difference = ramp_difference_t_0 - prefactor1 * np.exp(-(t + anneal_time) / beta1) - prefactor2 * np.exp(-(t + anneal_time) / beta2)
+    # We integrate from t_0, need to remove evolution between t_0 and t_i (decay[0])
+    ramp_difference = prefactor1 * (decay1[0] - decay1) + prefactor2 * (decay2[0] - decay2)
     ramp_difference = np.float32(ramp_difference)
     LOG.debug("anneal_recovery() | ramp shape={:}, dtype={:} ".format(ramp_difference.shape, ramp_difference.dtype))
     return ramp_difference
@@ -255,16 +231,12 @@ def idle_recovery(original_ramp, t_0, signal, frame, config):
         #LOG.warning('problem of reference pixels,{} remove the 4 first columns from illumination model{}'.format(original_ramp.shape, signal.shape))
         signal = signal[:,4:]
 
-    alpha1 = 2975790.21677 * np.exp(-0.0173557837941 * signal) + 1133.82032361
-    amp1 = ((2.04271769088e-05 * signal**2 + -0.0166816654355 * signal + 4.08114118945)/2011.9) * idle_time
+    [(prefactor1, alpha1, _)] = idle_recovery_coefficients(signal, idle_time)
 
-    t = t_0 + np.arange(0, nb_frames) * frame  # Time sampling in seconds
-    t = t[:, np.newaxis, np.newaxis]  # Prepare broadcasting
+    decay1 = exponential_decay(alpha1, t_0, nb_frames, frame)  # exp(-t / alpha1), t sampling the frames
 
-    ramp_difference_t_0 = (amp1 * alpha1) * np.exp(-t_0 / alpha1)
-
-    # We integrate from t_0, need to remove evolution between t_0 and t_i (ramp_difference_t_0)
-    ramp_difference = ramp_difference_t_0 - (amp1 * alpha1) * np.exp(-t / alpha1)
+    # We integrate from t_0, need to remove evolution between t_0 and t_i (decay1[0])
+    ramp_difference = prefactor1 * (decay1[0] - decay1)
 
     ramp_difference = ramp_difference.reshape([1, nb_frames, nb_y, nb_x]) # RG convention hypercube
     ramp_difference = np.float32(ramp_difference)
@@ -272,7 +244,638 @@ def idle_recovery(original_ramp, t_0, signal, frame, config):
     return ramp_difference
 
 
-def poisson_noise(original_ramp, mask, gain):
+# Fits of the JPL test data of 2019, as functions of the signal in DN/s
+
+def _drift_one_alpha1(signal):
+    return 2.59295558e+03 * np.exp(-8.57428099e-04 * signal) + 1.20593193e+02
+
+
+def _drift_one_amp1(signal):
+    return 2.94507350e-06 * signal**2 + -3.27886892e-02 * signal + -4.70669170e+00
+
+
+# Obtained with notebook extract_responsedrift_expressions.ipynb
+def _drift_faint_alpha1(signal):
+    return -0.24824707509094024 * signal + 256.0307052443123
+
+
+def _drift_faint_amp1(signal):
+    return -3.309038643901135 * np.exp(0.002099958184394631 * signal) + -3.1679206249778638
+
+
+def _drift_faint_alpha2(signal):
+    return (11.128462112080102 * 55332.60403145965 * signal + 168405550.01410204) / (55332.60403145965 + (signal - 245.45591611338756)**2)
+
+
+def _drift_faint_amp2(signal):
+    return -0.041975980807126514 * signal + 0.28375014129499576
+
+
+def _drift_medium_alpha1(signal):
+    return 2643.2695863041595 * np.exp(-0.0008722598069934617 * signal) + 125.05736916420666
+
+
+def _drift_medium_amp1(signal):
+    return 3.311621436854758e-06 * signal**2 + -0.034646597553672186 * signal + -2.551106144746854
+
+
+def _idle_alpha1(signal):
+    return 2975790.21677 * np.exp(-0.0173557837941 * signal) + 1133.82032361
+
+
+def _idle_amp1(signal):
+    # Per second of idle time
+    return (2.04271769088e-05 * signal**2 + -0.0166816654355 * signal + 4.08114118945)/2011.9
+
+
+# Signal thresholds (DN/s) of the response drift regimes
+DRIFT_ONE_LOW_THRESHOLD = 75  # to avoid negative pixel
+DRIFT_TRANSITION_THRESHOLD = 750
+DRIFT_FADING_THRESHOLD = 5000
+
+# Step (DN/s) of the coefficient tables. The maximum relative error of the tables with respect to the
+# fits is 4e-7 (idle recovery alpha1 near 0 DN/s), below 1e-7 for the response drift coefficients.
+TABLE_STEP = 0.1
+# Upper limit (DN/s) of the idle recovery tables, the fits are evaluated directly for brighter pixels
+IDLE_TABLE_MAX = 10000
+
+# Version of the computation of the deterministic effects, part of the keys of the caches (see cache): increase it
+# each time a change of the code changes the values of the ramps or of the coefficients
+EFFECTS_VERSION = 1
+
+# Fraction of active pixels above which the deterministic effects are evaluated on the dense frames,
+# instead of on the active pixels only, see active_pixels
+ACTIVE_FRACTION_MAX = 0.25
+
+
+class CoefficientTable:
+    """
+    Linear interpolation table of a coefficient, sampled on an evenly spaced signal grid.
+    The grid cell of each pixel is found by a direct index computation (no search).
+
+    :param callable function: coefficient as a function of the signal in DN/s
+    :param float low: first signal value of the grid in DN/s
+    :param float high: last signal value of the grid in DN/s
+    :param float step: [optional] step of the grid in DN/s
+    :param np.ndarray values: [optional] values of the function on the grid, already computed (e.g. in shared memory)
+    :param np.ndarray slopes: [optional] differences of values, already computed
+    """
+
+    def __init__(self, function, low, high, step=TABLE_STEP, values=None, slopes=None):
+        self.function = function
+        self.low = low
+        self.high = high
+        nb_steps = int(round((high - low) / step))
+        self.step = (high - low) / nb_steps
+        self.values = function(np.linspace(low, high, nb_steps + 1)) if values is None else values
+        self.slopes = np.diff(self.values) if slopes is None else slopes
+
+    def __call__(self, signal, exact_outside=False):
+        """
+        Coefficient for each pixel.
+
+        :param np.ndarray signal: signal in DN/s
+        :param bool exact_outside: [optional] if True, the function is evaluated for the pixels out of the grid,
+                                   else they get the value of the nearest end of the grid.
+        :rtype: np.ndarray
+        """
+        position = (np.clip(signal, self.low, self.high) - self.low) / self.step
+        index = np.minimum(position.astype(np.intp), self.slopes.size - 1)
+        position -= index
+        values = self.values[index] + position * self.slopes[index]
+
+        if exact_outside:
+            outside = (signal < self.low) | (signal > self.high)
+            if outside.any():
+                values[outside] = self.function(signal[outside])
+
+        return values
+
+
+# key: coefficient name ; value: (function, low, high) of its CoefficientTable
+_TABLE_DEFINITIONS = {
+    "drift_one_alpha1": (_drift_one_alpha1, DRIFT_ONE_LOW_THRESHOLD, DRIFT_FADING_THRESHOLD),
+    "drift_one_amp1": (_drift_one_amp1, DRIFT_ONE_LOW_THRESHOLD, DRIFT_FADING_THRESHOLD),
+    "drift_faint_alpha1": (_drift_faint_alpha1, 0, DRIFT_TRANSITION_THRESHOLD),
+    "drift_faint_amp1": (_drift_faint_amp1, 0, DRIFT_TRANSITION_THRESHOLD),
+    "drift_faint_alpha2": (_drift_faint_alpha2, 0, DRIFT_TRANSITION_THRESHOLD),
+    "drift_faint_amp2": (_drift_faint_amp2, 0, DRIFT_TRANSITION_THRESHOLD),
+    "drift_medium_alpha1": (_drift_medium_alpha1, DRIFT_TRANSITION_THRESHOLD, DRIFT_FADING_THRESHOLD),
+    "drift_medium_amp1": (_drift_medium_amp1, DRIFT_TRANSITION_THRESHOLD, DRIFT_FADING_THRESHOLD),
+    "idle_alpha1": (_idle_alpha1, 0, IDLE_TABLE_MAX),
+    "idle_amp1": (_idle_amp1, 0, IDLE_TABLE_MAX),
+}
+
+# Tables of the process, built on the first call of coefficient_tables or set by set_coefficient_tables
+_COEFFICIENT_TABLES = None
+
+
+def coefficient_tables():
+    """
+    Tables of the coefficients of response_drift, response_drift_one and idle_recovery.
+    Built once per process, on the first call.
+
+    :return: dict, key: coefficient name, value: CoefficientTable
+    :rtype: dict
+    """
+    global _COEFFICIENT_TABLES
+    if _COEFFICIENT_TABLES is None:
+        _COEFFICIENT_TABLES = {name: CoefficientTable(function, low, high)
+                               for (name, (function, low, high)) in _TABLE_DEFINITIONS.items()}
+    return _COEFFICIENT_TABLES
+
+
+def set_coefficient_tables(arrays):
+    """
+    Use tables already computed by another process (e.g. attached from shared memory by a worker process),
+    instead of building them.
+
+    :param dict arrays: key: coefficient name, value: (values, slopes) of its CoefficientTable
+    """
+    global _COEFFICIENT_TABLES
+    _COEFFICIENT_TABLES = {name: CoefficientTable(function, low, high, values=arrays[name][0],
+                                                  slopes=arrays[name][1])
+                           for (name, (function, low, high)) in _TABLE_DEFINITIONS.items()}
+
+
+def response_drift_one_coefficients(signal, tabulated=False):
+    """
+    Coefficients of the response drift with one exponential, see response_drift_one.
+
+    :param signal: illum_image value in DN/s, without the reference columns
+    :type signal: np.array(nb_y, nb_x)
+    :param bool tabulated: [optional] if True, use the coefficient tables instead of the fits, see TABLE_STEP
+
+    :return: list of terms (prefactor, alpha, time offset), see add_deterministic_effects
+    :rtype: list(tuple)
+    """
+    if tabulated:
+        tables = coefficient_tables()
+        active = (signal > DRIFT_ONE_LOW_THRESHOLD) & (signal < DRIFT_FADING_THRESHOLD)
+        alpha1 = np.where(active, tables["drift_one_alpha1"](signal), 1.)
+        amp1 = np.where(active, tables["drift_one_amp1"](signal), 0.)
+        return [(amp1 * alpha1, alpha1, 0.)]
+
+    # Creating two pixels masks corresponding to two different fitting regimes
+    index = np.where( (signal > DRIFT_ONE_LOW_THRESHOLD) & (signal < DRIFT_FADING_THRESHOLD) )
+
+    alpha1 = np.ones_like(signal)
+    amp1 = np.zeros_like(signal)
+
+    # Values fitted from JPL test data
+    alpha1[index] = _drift_one_alpha1(signal[index])
+    amp1[index] = _drift_one_amp1(signal[index])
+
+    return [(amp1 * alpha1, alpha1, 0.)]
+
+
+def response_drift_coefficients(signal, tabulated=False):
+    """
+    Coefficients of the response drift with two exponentials, see response_drift.
+
+    :param signal: illum_image value in DN/s, without the reference columns
+    :type signal: np.array(nb_y, nb_x)
+    :param bool tabulated: [optional] if True, use the coefficient tables instead of the fits, see TABLE_STEP
+
+    :return: list of terms (prefactor, alpha, time offset), see add_deterministic_effects
+    :rtype: list(tuple)
+    """
+    # Creating two pixels masks corresponding to two different fitting regimes
+    faint_pixels = signal < DRIFT_TRANSITION_THRESHOLD
+    medium_pixels = (~faint_pixels) & (signal < DRIFT_FADING_THRESHOLD)
+
+    if tabulated:
+        tables = coefficient_tables()
+        alpha1 = np.where(faint_pixels, tables["drift_faint_alpha1"](signal, exact_outside=True),
+                          np.where(medium_pixels, tables["drift_medium_alpha1"](signal), 1.))
+        amp1 = np.where(faint_pixels, tables["drift_faint_amp1"](signal, exact_outside=True),
+                        np.where(medium_pixels, tables["drift_medium_amp1"](signal), 0.))
+        alpha2 = np.where(faint_pixels, tables["drift_faint_alpha2"](signal, exact_outside=True), 1.)
+        amp2 = np.where(faint_pixels, tables["drift_faint_amp2"](signal, exact_outside=True), 0.)
+        return [(amp1 * alpha1, alpha1, 0.), (amp2 * alpha2, alpha2, 0.)]
+
+    alpha1 = np.ones_like(signal)
+    alpha2 = np.ones_like(signal)
+    amp1 = np.zeros_like(signal)
+    amp2 = np.zeros_like(signal)
+
+    # Values fitted from JPL test data
+    alpha1[faint_pixels] = _drift_faint_alpha1(signal[faint_pixels])
+    amp1[faint_pixels] = _drift_faint_amp1(signal[faint_pixels])
+    alpha2[faint_pixels] = _drift_faint_alpha2(signal[faint_pixels])
+    amp2[faint_pixels] = _drift_faint_amp2(signal[faint_pixels])
+
+    alpha1[medium_pixels] = _drift_medium_alpha1(signal[medium_pixels])
+    amp1[medium_pixels] = _drift_medium_amp1(signal[medium_pixels])
+
+    return [(amp1 * alpha1, alpha1, 0.), (amp2 * alpha2, alpha2, 0.)]
+
+
+def idle_recovery_coefficients(signal, idle_time, tabulated=False):
+    """
+    Coefficients of the idle recovery, see idle_recovery.
+
+    :param signal: illum_image value in DN/s, without the reference columns
+    :type signal: np.array(nb_y, nb_x)
+    :param float idle_time: duration of the idle phase before the observation began in seconds
+    :param bool tabulated: [optional] if True, use the coefficient tables instead of the fits, see TABLE_STEP
+
+    :return: list of terms (prefactor, alpha, time offset), see add_deterministic_effects
+    :rtype: list(tuple)
+    """
+    if tabulated:
+        tables = coefficient_tables()
+        alpha1 = tables["idle_alpha1"](signal, exact_outside=True)
+        amp1 = tables["idle_amp1"](signal, exact_outside=True) * idle_time
+    else:
+        alpha1 = _idle_alpha1(signal)
+        amp1 = _idle_amp1(signal) * idle_time
+
+    return [(amp1 * alpha1, alpha1, 0.)]
+
+
+def anneal_recovery_coefficients(anneal_time, shape=None):
+    """
+    Coefficients of the anneal recovery, see anneal_recovery. They are the same for all pixels.
+
+    :param float anneal_time: time between the end of the anneal and the start of the observation in seconds
+    :param tuple shape: [optional] (nb_y, nb_x) shape of the coefficient images. By default, scalars.
+
+    :return: list of terms (prefactor, beta, time offset), see add_deterministic_effects
+    :rtype: list(tuple)
+    """
+    if shape is None:
+        shape = ()
+
+    beta1 = 197.97132 * np.ones(shape)
+    amp1   = 11.600852 * np.ones(shape)
+    beta2 = 991.76323 * np.ones(shape)
+    amp2   = 0.86786327 * np.ones(shape)
+
+    return [(amp1 * beta1, beta1, anneal_time), (amp2 * beta2, beta2, anneal_time)]
+
+
+def signal_terms(signal, config, nb_x, tabulated=True):
+    """
+    Exponential terms of the deterministic effects which depend on the illumination, active in the configuration
+    (response_drift, response_drift_one, idle_recovery).
+
+    :param signal: illum_image value in DN/s, with or without the 4 reference columns
+    :type signal: np.array(nb_y, nb_x) or np.array(nb_y, nb_x+4)
+    :param dict config: validated configuration
+    :param int nb_x: number of columns of the det_image
+    :param bool tabulated: [optional] if True (default), use the coefficient tables instead of the fits,
+                           see TABLE_STEP
+
+    :return: list of terms (prefactor, alpha, time offset), prefactor and alpha are np.array(nb_y, nb_x)
+    :rtype: list(tuple)
+    """
+    (nbs_y, nbs_x) = signal.shape
+    if( nbs_x == (nb_x+4)):
+        # The normal case for the illum_models read by utils.read_illum_model, with the 4 reference columns
+        LOG.debug('problem of reference pixels, nb_x={} remove the 4 first columns from illumination model{}'.format(
+            nb_x, signal.shape))
+        signal = signal[:,4:]
+
+    terms = []
+    if config["response_drift"]["active"]:
+        terms += response_drift_coefficients(signal, tabulated=tabulated)
+    if config["response_drift_one"]["active"]:
+        terms += response_drift_one_coefficients(signal, tabulated=tabulated)
+    if config["idle_recovery"]["active"]:
+        terms += idle_recovery_coefficients(signal, config["idle_recovery"]["duration"], tabulated=tabulated)
+
+    return terms
+
+
+# Effects of signal_terms, in the order of their terms, with their number of terms
+SIGNAL_EFFECTS = (("response_drift", 2), ("response_drift_one", 1), ("idle_recovery", 1))
+
+
+def select_signal_terms(terms, config, selection):
+    """
+    Terms of some of the effects, from the terms computed for more effects.
+
+    :param list terms: terms computed by signal_terms(signal, config, nb_x)
+    :param dict config: configuration used to compute the terms
+    :param dict selection: configuration of the selected effects, they must be active in config
+
+    :return: the terms of signal_terms(signal, selection, nb_x)
+    :rtype: list(tuple)
+    """
+    selected = []
+    start = 0
+    for (effect, nb_terms) in SIGNAL_EFFECTS:
+        if config[effect]["active"]:
+            if selection[effect]["active"]:
+                selected += terms[start:start + nb_terms]
+            start += nb_terms
+        elif selection[effect]["active"]:
+            raise ValueError("{} is not active in the configuration of the terms".format(effect))
+    return selected
+
+
+def signal_effects_active(config):
+    """
+    :param dict config: validated configuration
+    :return: True if at least one of the effects computed by signal_terms is active
+    :rtype: bool
+    """
+    return (config["response_drift"]["active"] or config["response_drift_one"]["active"]
+            or config["idle_recovery"]["active"])
+
+
+def anneal_terms(config):
+    """
+    Exponential terms of the anneal recovery, if active in the configuration. They are the same for all pixels.
+
+    :param dict config: validated configuration
+    :return: list of terms (prefactor, beta, time offset), see add_deterministic_effects
+    :rtype: list(tuple)
+    """
+    if config["anneal_recovery"]["active"]:
+        return anneal_recovery_coefficients(config["anneal_recovery"]["time"])
+    return []
+
+
+def deterministic_terms(signal, config, nb_x, tabulated=True):
+    """
+    Exponential terms of all the deterministic effects active in the configuration
+    (response_drift, response_drift_one, idle_recovery, anneal_recovery).
+
+    :param signal: illum_image value in DN/s, with or without the 4 reference columns
+    :type signal: np.array(nb_y, nb_x) or np.array(nb_y, nb_x+4)
+    :param dict config: validated configuration
+    :param int nb_x: number of columns of the det_image
+    :param bool tabulated: [optional] if True (default), use the coefficient tables instead of the fits,
+                           see TABLE_STEP
+
+    :return: list of terms (prefactor, alpha, time offset), see add_deterministic_effects
+    :rtype: list(tuple)
+    """
+    return signal_terms(signal, config, nb_x, tabulated=tabulated) + anneal_terms(config)
+
+
+def add_deterministic_effects(ramp, t_0, terms, frame=0.159):
+    """
+    Add all the deterministic effects to the ramp, in place, in a single pass over the frames.
+
+    Each effect is a sum of exponential terms, with per pixel coefficients. The loss of signal of a term,
+    for the frame at time t, is:
+        prefactor * (exp(-(t_0 + offset) / alpha) - exp(-(t + offset) / alpha))
+    The terms are evaluated together, one frame at a time, so that the memory needed is one frame image per term,
+    instead of one cube per effect. The result is the sum of response_drift, response_drift_one, idle_recovery and
+    anneal_recovery, to float32 precision.
+    The frames being evenly spaced, the exponential of the frame k+1 is the one of the frame k multiplied by
+    exp(-frame / alpha), see exponential_decay: the exponentials are evaluated twice per pixel and per term.
+    When few pixels have a per pixel term not zero (response drift only, on LRS SLITLESS), the terms are evaluated on
+    these active pixels only, see active_pixels.
+
+    Parameters
+    ----------
+    ramp: np.ndarray
+        ramp in DN (nb_integrations, nb_frames, nb_y, nb_x), modified in place. All integrations get the same
+        loss of signal, as in the single effect functions.
+    t_0: float
+        time since beginning of the observation in seconds
+    terms: list(tuple)
+        list of (prefactor, alpha, time offset), see deterministic_terms
+    frame: float
+        duration of a frame in seconds
+
+    Returns
+    -------
+    ramp: np.ndarray
+        the same array than the input ramp
+    """
+    if not terms:
+        return ramp
+
+    index = active_pixels(terms)
+    terms = pack_terms(terms, index)
+    prefactors = [prefactor for (prefactor, alpha, offset) in terms]
+    decays = [np.array(np.exp(-(t_0 + offset) / alpha)) for (prefactor, alpha, offset) in terms]
+    ratios = [np.exp(-frame / alpha) for (prefactor, alpha, offset) in terms]
+
+    _add_terms(ramp, prefactors, decays, ratios, index)
+
+    LOG.debug("add_deterministic_effects() | {} terms, ramp shape={:}, dtype={:} ".format(len(terms), ramp.shape, ramp.dtype))
+    return ramp
+
+
+def active_pixels(terms, max_fraction=ACTIVE_FRACTION_MAX):
+    """
+    Compact index of the active pixels, where at least one of the per pixel terms is not zero.
+
+    Below DRIFT_ONE_LOW_THRESHOLD or above DRIFT_FADING_THRESHOLD, the prefactors of the response drift are zero,
+    on LRS SLITLESS most pixels have no drift at all. The terms which are the same for all pixels (scalars, as
+    anneal_recovery) are not taken into account.
+
+    :param list terms: list of (prefactor, alpha, time offset), see deterministic_terms
+    :param float max_fraction: [optional] fraction of active pixels above which the dense evaluation is used
+
+    :return: flat indices of the active pixels in a (nb_y, nb_x) image, or None if the dense evaluation is better
+    :rtype: np.ndarray
+    """
+    pixel_prefactors = [prefactor for (prefactor, alpha, offset) in terms if np.ndim(prefactor) > 0]
+    if not pixel_prefactors:
+        return None
+
+    active = np.zeros(np.shape(pixel_prefactors[0]), dtype=bool)
+    for prefactor in pixel_prefactors:
+        active |= (prefactor != 0)
+
+    if np.count_nonzero(active) > max_fraction * active.size:
+        return None
+
+    return np.flatnonzero(active)
+
+
+def pack_terms(terms, index):
+    """
+    Per pixel terms restricted to the active pixels.
+
+    :param list terms: list of (prefactor, alpha, time offset), see deterministic_terms
+    :param np.ndarray index: flat indices of the active pixels, see active_pixels. If None, the terms are unchanged.
+
+    :return: list of (prefactor, alpha, time offset), the per pixel prefactor and alpha are np.array(nb_active)
+    :rtype: list(tuple)
+    """
+    if index is None:
+        return terms
+
+    return [(prefactor, alpha, offset) if np.ndim(prefactor) == 0
+            else (np.ravel(prefactor)[index], np.ravel(alpha)[index], offset)
+            for (prefactor, alpha, offset) in terms]
+
+
+def _add_terms(ramp, prefactors, decays, ratios, index):
+    """
+    Add the terms to the ramp, dense or packed on the active pixels.
+
+    :param np.ndarray ramp: ramp in DN (nb_integrations, nb_frames, nb_y, nb_x), modified in place
+    :param list prefactors: prefactor of each term, see pack_terms
+    :param list decays: exp(-(t_0 + offset) / alpha) of each term, modified in place
+    :param list ratios: exp(-frame / alpha) of each term
+    :param np.ndarray index: flat indices of the active pixels, see active_pixels. None for the dense evaluation.
+    """
+    if index is None:
+        _accumulate_terms(ramp, prefactors, decays, ratios)
+        return
+
+    uniform = [i for (i, prefactor) in enumerate(prefactors) if np.ndim(prefactor) == 0]
+    pixel = [i for (i, prefactor) in enumerate(prefactors) if np.ndim(prefactor) > 0]
+
+    if uniform:
+        _accumulate_terms(ramp, [prefactors[i] for i in uniform], [decays[i] for i in uniform],
+                          [ratios[i] for i in uniform])
+
+    if pixel and index.size:
+        # Evaluated in a packed (nb_frames, nb_active) layout, then scattered in the ramp, frame by frame
+        (nb_integrations, nb_frames) = ramp.shape[:2]
+        packed = np.zeros((1, nb_frames, index.size))
+        _accumulate_terms(packed, [prefactors[i] for i in pixel], [decays[i] for i in pixel],
+                          [ratios[i] for i in pixel])
+        if ramp.flags.c_contiguous:
+            flat_ramp = ramp.reshape(nb_integrations, nb_frames, -1)
+            for k in range(nb_frames):
+                flat_ramp[:, k, index] += packed[:, k]
+        else:
+            (rows, columns) = np.unravel_index(index, ramp.shape[2:])
+            ramp[:, :, rows, columns] += packed
+
+
+def _accumulate_terms(ramp, prefactors, decays, ratios):
+    """
+    Frame loop of add_deterministic_effects.
+
+    :param np.ndarray ramp: ramp in DN (nb_integrations, nb_frames, ...), modified in place
+    :param list prefactors: prefactor of each term
+    :param list decays: exp(-(t_0 + offset) / alpha) of each term, modified in place
+    :param list ratios: exp(-frame / alpha) of each term
+    """
+    nb_frames = ramp.shape[1]
+
+    ramp_difference_t_0 = sum(prefactor * decay for (prefactor, decay) in zip(prefactors, decays))
+
+    for k in range(nb_frames):
+        # We integrate from t_0, need to remove evolution between t_0 and t_i (ramp_difference_t_0)
+        frame_difference = ramp_difference_t_0 - sum(prefactor * decay for (prefactor, decay) in zip(prefactors, decays))
+        ramp[:, k] += frame_difference
+        # exp(-(t + offset) / alpha) is updated from one frame to the next by a multiplication with exp(-frame / alpha)
+        for (decay, ratio) in zip(decays, ratios):
+            np.multiply(decay, ratio, out=decay)
+
+
+class EffectState:
+    """
+    State of the deterministic effects, carried from one integration to the next.
+
+    The effects depend only on the time since the beginning of the observation. For two consecutive integrations,
+    at t_0 and t_0 + delta_t, with the same illum_model, exp(-(t_0 + delta_t) / alpha) is obtained from
+    exp(-t_0 / alpha) by a multiplication with exp(-delta_t / alpha). This factor is kept for the last values of
+    delta_t, so that for evenly spaced integrations the exponentials are not evaluated anymore.
+
+    The exponentials are computed again (full recompute) when the terms change (illum_model, effect parameters),
+    when the frame duration changes, or when the integrations are not in chronological order. The index of the
+    active pixels (see active_pixels) is built at the same time, once per illum_model.
+
+    :param int max_steps: [optional] number of delta_t values whose factors are kept
+    """
+
+    def __init__(self, max_steps=4):
+        self.max_steps = max_steps
+        self._key = None
+        self.t_0 = None
+        self.index = None
+        self.prefactors = []
+        self._alphas = []
+        self.decays = []  # exp(-(t_0 + offset) / alpha) of each term
+        self.ratios = []  # exp(-frame / alpha) of each term
+        self._steps = {}  # key: delta_t ; value: exp(-delta_t / alpha) of each term
+        self._variants = {}  # key: name of the variant ; value: EffectState
+        self.nb_full = 0
+        self.nb_incremental = 0
+
+    def variant(self, name):
+        """
+        State of a variant of the configuration (see utils.variant_configs), each variant has its own sequence.
+
+        :param str name: name of the variant, None for this state
+        :rtype: EffectState
+        """
+        if name is None:
+            return self
+        if name not in self._variants:
+            self._variants[name] = EffectState(max_steps=self.max_steps)
+        return self._variants[name]
+
+    def _reset(self, key, terms, t_0, frame):
+        self._key = key
+        self.t_0 = t_0
+        self.index = active_pixels(terms)
+        terms = pack_terms(terms, self.index)
+        self.prefactors = [prefactor for (prefactor, alpha, offset) in terms]
+        self._alphas = [alpha for (prefactor, alpha, offset) in terms]
+        self.decays = [np.array(np.exp(-(t_0 + offset) / alpha)) for (prefactor, alpha, offset) in terms]
+        self.ratios = [np.exp(-frame / alpha) for (prefactor, alpha, offset) in terms]
+        self._steps = {}
+        self.nb_full += 1
+
+    def _advance(self, t_0):
+        delta_t = t_0 - self.t_0
+        factors = self._steps.get(delta_t)
+        if factors is None:
+            if len(self._steps) >= self.max_steps:
+                self._steps.clear()
+            factors = [np.exp(-delta_t / alpha) for alpha in self._alphas]
+            self._steps[delta_t] = factors
+        for (decay, factor) in zip(self.decays, factors):
+            np.multiply(decay, factor, out=decay)
+        self.t_0 = t_0
+        self.nb_incremental += 1
+
+    def add_effects(self, ramp, t_0, terms, frame=0.159, key=None):
+        """
+        Same as add_deterministic_effects(ramp, t_0, terms, frame), using the state of the previous integration
+        when the terms are the same.
+
+        :param np.ndarray ramp: ramp in DN (nb_integrations, nb_frames, nb_y, nb_x), modified in place
+        :param float t_0: time since beginning of the observation in seconds
+        :param list terms: list of (prefactor, alpha, time offset), see deterministic_terms
+        :param float frame: duration of a frame in seconds
+        :param key: [optional] hashable value identifying the terms, for instance the digest of the illum_model
+                    and of the effect parameters. If None, the terms are considered as new.
+
+        :return: the same array than the input ramp
+        :rtype: np.ndarray
+        """
+        key = None if key is None else (key, frame)
+        if key is None or key != self._key or self.t_0 is None or t_0 < self.t_0:
+            self._reset(key, terms, t_0, frame)
+        elif t_0 != self.t_0:
+            self._advance(t_0)
+
+        if self.prefactors:
+            _add_terms(ramp, self.prefactors, [decay.copy() for decay in self.decays], self.ratios, self.index)
+
+        return ramp
+
+
+def effect_parameters(config):
+    """
+    Parameters of the deterministic effects in the configuration.
+
+    :param dict config: validated configuration
+    :return: activation and parameters of response_drift, response_drift_one, idle_recovery and anneal_recovery
+    :rtype: tuple
+    """
+    return (config["response_drift"]["active"], config["response_drift_one"]["active"],
+            config["idle_recovery"]["active"], config["idle_recovery"]["duration"],
+            config["anneal_recovery"]["active"], config["anneal_recovery"]["time"])
+
+
+def poisson_noise(original_ramp, mask, gain, rng=None, chunk_frames=None):
     """
     Compute Poisson noise on all integration of a det_image data cube.
     We follow the technical note of Massimo Roberto WFC3-2007-12.pdf, paragraph 2.4, equation 1.40
@@ -280,6 +883,11 @@ def poisson_noise(original_ramp, mask, gain):
     where the various p_i are statistically independent packets of electrons.
     So the Poisson distribution is applied to p_i, not y_i
     http://web.ipac.caltech.edu/staff/fmasci/home/astro_refs/SUR_vs_CDS.pdf
+
+    The cube is processed by blocks of chunk_frames frames of an integration, the temporary arrays have the size of a
+    block. The blocks are processed in the order of the cube, the random values and the result are the same whatever
+    chunk_frames.
+
     Parameters
     ----------
     original_ramp:
@@ -292,45 +900,70 @@ def poisson_noise(original_ramp, mask, gain):
     gain:
         float - Gain in electron/DN
 
+    rng:
+        np.random.Generator - [optional] random generator. By default, a generator created once per process.
+
+    chunk_frames:
+        int - [optional] number of frames of a block. By default, all the frames of an integration.
+
     Returns
     -------
     data cube with Poisson noise added (this is not a ramp difference, this is the full ramp)
 
     """
+    if rng is None:
+        rng = _default_rng()
+
     # get the shape and check that the cube is 4D
     (nb_integrations, nb_frames, nb_y, nb_x) =  original_ramp.shape
-    # create the hypercube of differences in electron
-    #  I duplicate the  first image of difference
-    frame_differences = np.diff(original_ramp, axis=1)
-    # diff = original_ramp[:,1:,:,:] - original_ramp[:,0:-1,:,:] equivalent
-    first_difference = frame_differences[0,0,:,:]
-    first_difference = first_difference.reshape([1, 1, nb_y, nb_x])
-    frame_differences = np.append(first_difference, frame_differences, axis=1)
-    # now frame_differences has the same shape than original_ramp
-
-    #
+    if chunk_frames is None:
+        chunk_frames = nb_frames
     ## beware, we have some negative pixels because of the RON applied before
-    good_pixels = np.broadcast_to(np.invert(mask), original_ramp.shape)
-    frame_noise = np.zeros([nb_integrations, nb_frames, nb_y, nb_x], dtype=np.float32)
-    # I create the variable good_frame_differences because I was not able to
-    #  frame_differences[good_pixels][ii] = 0  does not work !
-    good_frame_differences = frame_differences[good_pixels]
-    ii = np.where(good_frame_differences < 0)
-    good_frame_differences[ii] = 0
-    nb_negatif = len(ii[0])
-    if (np.min(frame_differences[good_pixels]) < 0):
-        pass
-        LOG.debug(f"poisson_noise minimum {np.min(frame_differences[good_pixels])} {nb_negatif}")
-        LOG.debug("poisson_noise() |  minimum frame_differences[good_pixels]={:}, nb_negatif={:} ".format(np.min(frame_differences[good_pixels]), nb_negatif ))
-        
-    # add the noise, comput in electron, only for good pixels
-    frame_noise[good_pixels] = np.float32(np.random.poisson(good_frame_differences*gain)/gain)
-    
-    # add the first image of the ramp
-    frame_noise[0,0,:,:] += (original_ramp[0,0,:,:] - first_difference[0,0,:,:])
-
-    # cumulative sum
-    noised_ramp = np.cumsum(frame_noise, axis=1)
+    good_pixels = np.invert(mask)
+    noised_ramp = np.empty([nb_integrations, nb_frames, nb_y, nb_x], dtype=np.float32)
+    nb_negatif = 0
+    min_difference = 0.
+    debug = LOG.isEnabledFor(logging.DEBUG)
+    for integration in range(nb_integrations):
+        # the frame differences are in electron
+        #  I duplicate the  first image of difference, for the first frame of each integration
+        first_difference = np.diff(original_ramp[integration, 0:2], axis=0)
+        for start in range(0, nb_frames, chunk_frames):
+            stop = min(start + chunk_frames, nb_frames)
+            if start == 0:
+                frame_differences = np.append(first_difference, np.diff(original_ramp[integration, 0:stop], axis=0),
+                                              axis=0)
+            else:
+                frame_differences = np.diff(original_ramp[integration, start - 1:stop], axis=0)
+
+            good_block = np.broadcast_to(good_pixels, frame_differences.shape)
+            # I create the variable good_frame_differences because I was not able to
+            #  frame_differences[good_pixels][ii] = 0  does not work !
+            good_frame_differences = frame_differences[good_block]
+            negative = good_frame_differences < 0
+            nb_block_negatif = np.count_nonzero(negative)
+            if nb_block_negatif:
+                nb_negatif += nb_block_negatif
+                # The minimum is only computed for the log
+                if debug:
+                    min_difference = min(min_difference, good_frame_differences[negative].min())
+                good_frame_differences[negative] = 0
+
+            # add the noise, comput in electron, only for good pixels
+            frame_noise = np.zeros(frame_differences.shape, dtype=np.float32)
+            frame_noise[good_block] = np.float32(rng.poisson(good_frame_differences*gain)/gain)
+
+            if start == 0:
+                # add the first image of the ramp of the integration
+                frame_noise[0] += (original_ramp[integration, 0] - first_difference[0])
+            else:
+                # the cumulative sum goes on from the last frame of the previous block
+                frame_noise[0] += noised_ramp[integration, start - 1]
+            np.cumsum(frame_noise, axis=0, out=noised_ramp[integration, start:stop])
+
+    if nb_negatif and debug:
+        LOG.debug("poisson_noise() |  minimum frame_differences[good_pixels]={:}, nb_negatif={:} ".format(
+            min_difference, nb_negatif))
 
     # This works only for the good pixels (which accumulate signal). We use the bad pixels CDP from MIRISim
     # Overwrite bad pixels with the original value.
@@ -340,7 +973,7 @@ def poisson_noise(original_ramp, mask, gain):
     LOG.debug("poisson_noise() |  noised ramp shape={:}, dtype={:} ".format(noised_ramp.shape, noised_ramp.dtype))
     return noised_ramp
 
-def add_poisson_noise(original_ramp, mask, gain):
+def add_poisson_noise(original_ramp, mask, gain, rng=None):
     """
     Add Poisson noise on all integration of a det_image data cube.
     The previous function, poisson_noise(), computes the Poisson noise but has a problem
@@ -350,10 +983,16 @@ def add_poisson_noise(original_ramp, mask, gain):
     where the various p_i are statistically independent packets of electrons.
     So the Poisson distribution is applied to p_i, not y_i
     http://web.ipac.caltech.edu/staff/fmasci/home/astro_refs/SUR_vs_CDS.pdf
+
+    The frames are processed one after the other: the noise of each frame difference is added to a running sum of
+    the noise of the previous frames, which is added to the frame, in place. The memory needed is a few frame images,
+    instead of several copies of the cube.
+
     Parameters
     ----------
     original_ramp:
                  Original ramp from MIRISim det_image in DN. Dimensions: (nb_integrations, nb_frames, nb_y, nb_x)
+                 Modified in place, must be a float array.
     mask:
         np.array(bool) - Array of bad pixels (True if bad, False if good)
                  Needed because the bad pixels have non-additive shapes where computation is not applicable. They need
@@ -362,56 +1001,122 @@ def add_poisson_noise(original_ramp, mask, gain):
     gain:
         float - Gain in electron/DN
 
+    rng:
+        np.random.Generator - [optional] random generator. By default, a generator created once per process.
+
     Returns
     -------
-    data cube with Poisson noise added (this is not a ramp difference, this is the full ramp)
+    data cube with Poisson noise added (this is not a ramp difference, this is the full ramp), the same array than
+    original_ramp
 
     """
+    if rng is None:
+        rng = _default_rng()
+
     # get the shape and check that the cube is 4D
     (nb_integrations, nb_frames, nb_y, nb_x) =  original_ramp.shape
-    # create the hypercube of differences in electron
-    #  I duplicate the  first image of difference
-    frame_differences = np.diff(original_ramp, axis=1)
-    # diff = original_ramp[:,1:,:,:] - original_ramp[:,0:-1,:,:] equivalent
-    first_difference = frame_differences[0,0,:,:]
-    first_difference = first_difference.reshape([1, 1, nb_y, nb_x])
-    frame_differences = np.append(first_difference, frame_differences, axis=1)
-    # now frame_differences has the same shape than original_ramp
     #   original ramp unit = DN,  frame_differences unit = DN
-    #
-    ## beware, we have some negative pixels because of the Read Out Noise applied before
-    ii = np.where(frame_differences < 0)
-    frame_differences[ii] = 0  # works even if ii is empty
-    nb_negatif = len(ii[0])
-    if (nb_negatif > 0):
-        pass
-        LOG.debug(f"poisson_noise minimum {np.min(frame_differences)} {nb_negatif}")
-        LOG.debug("poisson_noise() |  minimum frame_differences={:}, nb_negatif={:} ".format(np.min(frame_differences), nb_negatif ))
-        
-    # add the noise, comput in electron
-    frame_noise = np.float32(np.random.poisson(frame_differences*gain)/gain)
-
-    # remove the original signal
-    frame_only_noise = frame_noise - frame_differences
-
-    # cumulative sum
-    ramp_only_noise = np.cumsum(frame_only_noise, axis=1)
-    noised_ramp = ramp_only_noise + original_ramp
     # This works only for the good pixels (which accumulate signal). We use the bad pixels CDP from MIRISim
-    # Overwrite bad pixels with the original value.
-    #import pdb
-    #pdb.set_trace()
-    bad_pixels = np.broadcast_to(mask, original_ramp.shape)
-    noised_ramp[bad_pixels] = original_ramp[bad_pixels]
+    # The bad pixels keep the original value.
+    good_pixels = np.invert(np.asarray(mask, dtype=bool))
+
+    nb_negatif = 0
+    min_difference = 0.
+    debug = LOG.isEnabledFor(logging.DEBUG)
+    previous_frame = np.empty((nb_y, nb_x))
+    frame_difference = np.empty((nb_y, nb_x))
+    frame_noise = np.empty((nb_y, nb_x))
+    noised_difference = np.empty((nb_y, nb_x), dtype=np.float32)
+    ramp_only_noise = np.empty((nb_y, nb_x))
+    for integration in original_ramp:
+        ramp_only_noise[...] = 0.
+        for k in range(nb_frames):
+            frame = integration[k]
+            if k == 0:
+                # The first frame has the difference between the 2 first frames of the integration
+                if nb_frames > 1:
+                    np.subtract(integration[1], frame, out=frame_difference)
+                else:
+                    frame_difference[...] = 0.
+            else:
+                np.subtract(frame, previous_frame, out=frame_difference)
+            previous_frame[...] = frame
+
+            ## beware, we have some negative pixels because of the Read Out Noise applied before
+            negative = frame_difference < 0
+            nb_frame_negatif = np.count_nonzero(negative)
+            if nb_frame_negatif:
+                nb_negatif += nb_frame_negatif
+                if debug:
+                    min_difference = min(min_difference, frame_difference.min())
+                frame_difference[negative] = 0
+
+            # add the noise, comput in electron, and remove the original signal
+            np.multiply(frame_difference, gain, out=frame_noise)
+            np.divide(rng.poisson(frame_noise), gain, out=noised_difference)
+            np.subtract(noised_difference, frame_difference, out=frame_noise)
+            frame_noise *= good_pixels
+            ramp_only_noise += frame_noise
+            frame += ramp_only_noise
+
+    if (nb_negatif > 0):
+        LOG.debug("poisson_noise() |  minimum frame_differences={:}, nb_negatif={:} ".format(min_difference, nb_negatif))
+
+    LOG.debug("poisson_noise() |  noised ramp shape={:}, dtype={:} ".format(original_ramp.shape, original_ramp.dtype))
+    return original_ramp
+
+
+def noise_seed_sequence(seed, simulation_index=None, realisation=None):
+    """
+    Seed of the noise of a simulation.
+
+    The seed sequence of the simulation of index i is the child i of SeedSequence(seed), as given by
+    SeedSequence(seed).spawn(n)[i]: the streams of the simulations are independent, and the stream of a simulation
+    doesn't depend on the other simulations of the run (number of workers, order). The noise realisation r of the
+    simulation i is the child r of the simulation seed sequence.
+
+    :param int seed: seed of the run. If None, new entropy is drawn from the operating system.
+    :param int simulation_index: [optional] index of the simulation. If None, the seed sequence of the run.
+    :param int realisation: [optional] index of the noise realisation.
+
+    :return: seed sequence, to create the random generator of the simulation (np.random.default_rng)
+    :rtype: np.random.SeedSequence
+    """
+    if seed is None:
+        return np.random.SeedSequence()
+    return np.random.SeedSequence(seed, spawn_key=noise_spawn_key(simulation_index, realisation))
+
+
+def noise_spawn_key(simulation_index=None, realisation=None):
+    """
+    :param int simulation_index: [optional] index of the simulation
+    :param int realisation: [optional] index of the noise realisation
+    :return: spawn key of the seed sequence of the noise of a simulation, see noise_seed_sequence
+    :rtype: tuple(int)
+    """
+    return tuple(index for index in (simulation_index, realisation) if index is not None)
+
+
+# Random generator of the process, see _default_rng
+_RNG = {}
 
-    LOG.debug("poisson_noise() |  noised ramp shape={:}, dtype={:} ".format(noised_ramp.shape, noised_ramp.dtype))
-    return noised_ramp
+
+def _default_rng():
+    """
+    :return: random generator of the process, created at the first call and reused by the next ones.
+             A forked process gets its own generator, not a copy of the one of its parent.
+    :rtype: np.random.Generator
+    """
+    pid = os.getpid()
+    if pid not in _RNG:
+        _RNG.clear()
+        _RNG[pid] = np.random.default_rng()
+    return _RNG[pid]
 
 ############
 def add_background(original_ramp, background, time=0.159, gain=5.5):
     """
     Add background on all integration of a det_image data cube.
-    BEWARE works only for one integration
 
     Parameters
     ----------
@@ -428,17 +1133,62 @@ def add_background(original_ramp, background, time=0.159, gain=5.5):
     data cube with background added (this is not a ramp difference, this is the full ramp)
 
     """
-    # get the shape and check that the cube is 4D
-    (nb_integrations, nb_frames, nb_y, nb_x) =  original_ramp.shape
-    if (nb_integrations != 1): return
-    # create the hypercube of differences in electron
-    #
-    imagette = background*time/gain
-    cube0 = np.tile(imagette, nb_frames).reshape([nb_y,nb_frames,nb_x])
-    cube1 = cube0.swapaxes(1,0)
-    cube1 = np.cumsum(cube1, axis=0)
-    new_ramp = original_ramp + cube1.reshape([1,nb_frames, nb_y, nb_x])
-    new_ramp = np.float32(new_ramp)
-    LOG.debug("add_background() |  new ramp shape={:}, dtype={:} ".format(new_ramp.shape, new_ramp.dtype))
-    return new_ramp
+    new_ramp = np.float32(original_ramp)
+    if new_ramp is original_ramp:
+        new_ramp = original_ramp.copy()
+    return BackgroundRamp(background).add(new_ramp, time=time, gain=gain)
+
+
+class BackgroundRamp:
+    """
+    Cumulative background ramp of a run.
+
+    The background ramp only depends on the background image, the number of frames, the frame time and the gain:
+    it is the same for all the simulations of a TSO. It is computed once, and added in place to each ramp, for all
+    its integrations.
+
+    :param np.ndarray background: image of the background, electron/second
+    :param dict ramps: [optional] background ramps already computed (e.g. in shared memory), see ramps
+    """
 
+    def __init__(self, background, ramps=None):
+        self.background = background
+        self._ramps = dict(ramps or {})  # key: (nb_frames, frame time, gain) ; value: background ramp
+
+    @property
+    def ramps(self):
+        """
+        :return: the background ramps computed so far, key: (nb_frames, frame time, gain), value: read-only ramp
+        :rtype: dict
+        """
+        return dict(self._ramps)
+
+    def ramp(self, nb_frames, time=0.159, gain=5.5):
+        """
+        :param int nb_frames: number of frames of the ramps
+        :param float time: frame time in seconds
+        :param float gain: Gain in electron/DN
+        :return: background in DN, accumulated from the first frame, np.array(nb_frames, nb_y, nb_x), read-only
+        :rtype: np.ndarray
+        """
+        key = (nb_frames, time, gain)
+        if key not in self._ramps:
+            imagette = self.background * time / gain
+            ramp = np.float32(np.arange(1, nb_frames + 1)[:, np.newaxis, np.newaxis] * imagette)
+            ramp.flags.writeable = False
+            self._ramps[key] = ramp
+            LOG.debug("BackgroundRamp.ramp() |  background ramp shape={:}, dtype={:} ".format(ramp.shape, ramp.dtype))
+        return self._ramps[key]
+
+    def add(self, ramp, time=0.159, gain=5.5):
+        """
+        Add the background ramp to each integration of the ramp, in place.
+
+        :param np.ndarray ramp: ramp in DN (nb_integrations, nb_frames, nb_y, nb_x), modified in place
+        :param float time: frame time in seconds
+        :param float gain: Gain in electron/DN
+        :return: the same array than the input ramp
+        :rtype: np.ndarray
+        """
+        ramp += self.ramp(ramp.shape[1], time=time, gain=gain)
+        return ramp
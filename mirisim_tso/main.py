@@ -8,16 +8,23 @@ add noise2 in the configuration dictionary, correct the  function response_drift
               version '0.7.63', 25 February 2022, R Gastaud
 add obs_time version 0.7.65, 04 March 2022 R Gastaud
 """
+import copy
 import sys
 import os
 from . import utils
 from . import effects
+from . import parallel
+from . import manifest
+from . import cache
+from . import container
+from . import metrics
+from . import scheduler
 import logging
 import sys
 import glob
-from astropy.io import ascii # for timedat
 from astropy.io import fits # for background
 import time
+import numpy as np
 
 from . import version
 
@@ -26,7 +33,8 @@ from . import version
 LOG = logging.getLogger(__name__)
 
 
-def single_simulation_post_treatment(simulation_folder, t_0, phase,  conf, mask=None, background=None, obs_time=None):
+def single_simulation_post_treatment(simulation_folder, t_0, phase,  conf, mask=None, background=None, obs_time=None,
+                                     state=None, coefficient_cache=None, stage_cache=None):
     """
     Apply post treatment to a single simulation folder.
 
@@ -52,7 +60,19 @@ def single_simulation_post_treatment(simulation_folder, t_0, phase,  conf, mask=
                  to be excluded from the computation.
     
     background:
-        np.array(float) - Image of the background, e-/s
+        np.array(float) - Image of the background, e-/s, or effects.BackgroundRamp
+
+    obs_time: float
+        barycenter julian date of the start of the exposure
+
+    state: effects.EffectState
+        [optional] state of the deterministic effects, shared by the simulations of a sequence
+
+    coefficient_cache: cache.CoefficientCache
+        [optional] cache of the coefficients of the deterministic effects, shared by the simulations of a sequence
+
+    stage_cache: cache.StageCache
+        [optional] cache of the ramps with the deterministic effects
 
     Returns
     -------
@@ -69,88 +89,544 @@ def single_simulation_post_treatment(simulation_folder, t_0, phase,  conf, mask=
 
     LOG.debug("Post-Treatment for folder {}".format(simulation_folder))
 
-    det_images_filename = glob.glob(os.path.join(simulation_folder, "det_images", "det_image_*.fits"))[0]
-        #"det_image_seq1_MIRIMAGE_P750Lexp1.fits")
+    (det_image, stages, simulation_data) = read_stages(simulation_folder, t_0, phase, config_dict,
+                                                       stage_cache=stage_cache)
+
+    with det_image:
+        for (variant_config, output_folder, det_image, new_ramp, metadatas) in compute_simulation(
+                simulation_folder, t_0, phase, config_dict, det_image, stages, simulation_data, mask=mask,
+                background=background, state=state, coefficient_cache=coefficient_cache, stage_cache=stage_cache):
+            write_simulation(simulation_folder, det_image, new_ramp, metadatas, variant_config,
+                             obs_time=obs_time, output_folder=output_folder)
+    metrics.finish(simulation_folder)
+
+
+def read_simulation(simulation_folder, preload=False, det_image=None):
+    """
+    Read stage of the post treatment: det_image and illum_model of a simulation folder.
+
+    The det_image is memory-mapped: without preload, the ramp is read from the disk at its first use.
+
+    Parameters
+    ----------
+    simulation_folder: str
+        path (relative or absolute) to the MIRISim simulation folder (the one that contains det_images/illum_models folder)
+    preload: bool
+        [optional] By default, False. If True, the det_image data are read from the disk now, instead of at their
+        first use.
+    det_image: utils.DetImage
+        [optional] det_image of the simulation, already opened. By default, opened here.
+
+    Returns
+    -------
+    det_image: utils.DetImage
+        det_image of the simulation, to be closed after the write of the outputs
+    original_ramp: np.ndarray
+        ramp in DN (nb_integrations, nb_frames, nb_y, nb_x)
+    header: fits.Header
+        primary header of the det_image
+    illum_model: utils.IllumModel
+        illum_model file content, decoded only when needed
+    """
+    if det_image is None:
+        det_image = open_det_image(simulation_folder)
     illum_models_filename = glob.glob(os.path.join(simulation_folder, "illum_models", "illum_model_*.fits"))[0]
     #"illum_model_1_MIRIMAGE_P750L.fits")
 
-    original_ramp, header = utils.read_det_image(det_images_filename)
-    LOG.debug("main() | Value check for the original ramp: min={} / max={}".format(original_ramp.min(), original_ramp.max()))
+    original_ramp = det_image.data
+    header = det_image.header
+    if preload:
+        original_ramp = np.array(original_ramp)
+    metrics.add_quality("original", original_ramp)
+
+    illum_model = utils.IllumModel(illum_models_filename)
+    metrics.add_bytes(read=os.path.getsize(det_image.filename) + len(illum_model.content))
+
+    return det_image, original_ramp, header, illum_model
+
+
+def det_image_filename(simulation_folder):
+    """
+    :param str simulation_folder: path (relative or absolute) to the MIRISim simulation folder
+    :return: name of the det_image file of the simulation
+    :rtype: str
+    """
+    return glob.glob(os.path.join(simulation_folder, "det_images", "det_image_*.fits"))[0]
+        #"det_image_seq1_MIRIMAGE_P750Lexp1.fits")
+
+
+def open_det_image(simulation_folder):
+    """
+    :param str simulation_folder: path (relative or absolute) to the MIRISim simulation folder
+    :return: det_image of the simulation, memory-mapped
+    :rtype: utils.DetImage
+    """
+    return utils.DetImage(det_image_filename(simulation_folder))
+
+
+def read_cached_stage(simulation_folder, t_0, phase, config_dict, stage_cache=None):
+    """
+    Read stage of the post treatment, from the stage cache: ramp with the deterministic effects.
+
+    Parameters
+    ----------
+    simulation_folder: str
+        path (relative or absolute) to the MIRISim simulation folder
+    t_0: float
+        Time in second since beginning of the observation
+    phase: float
+        orbital phase
+    config_dict: dict
+        validated configuration
+    stage_cache: cache.StageCache
+        [optional] cache of the ramps with the deterministic effects
+
+    Returns
+    -------
+    stage_key: str
+        key of the simulation in the stage cache (None without stage cache)
+    stage: tuple
+        (new_ramp, metadatas), see apply_deterministic_effects, or None if not in the cache
+    """
+    if stage_cache is None:
+        return None, None
+
+    stage_key = stage_cache.key(simulation_folder, t_0, phase, config_dict)
+    stage = stage_cache.load(stage_key)
+    if stage is None:
+        return stage_key, None
+
+    LOG.debug("read_cached_stage() | deterministic effects of {} from the stage cache".format(simulation_folder))
+    return stage_key, stage
+
+
+def read_stages(simulation_folder, t_0, phase, config_dict, stage_cache=None, preload=False):
+    """
+    Read stage of the post treatment, for all the variants of the configuration (see utils.variant_configs):
+    the variants in the stage cache, and the simulation if at least one variant is not in the stage cache.
+    The det_image is opened once, for the read of the simulation and the write of all the outputs.
+
+    Parameters
+    ----------
+    simulation_folder: str
+        path (relative or absolute) to the MIRISim simulation folder
+    t_0: float
+        Time in second since beginning of the observation
+    phase: float
+        orbital phase
+    config_dict: dict
+        validated configuration
+    stage_cache: cache.StageCache
+        [optional] cache of the ramps with the deterministic effects
+    preload: bool
+        [optional] see read_simulation
+
+    Returns
+    -------
+    det_image: utils.DetImage
+        det_image of the simulation, to be closed after the write of the outputs
+    stages: list
+        (stage_key, stage) of each variant, see read_cached_stage
+    simulation_data: tuple
+        see read_simulation, None if all the variants are in the stage cache
+    """
+    with metrics.simulation(simulation_folder), metrics.span("read"):
+        stages = [read_cached_stage(simulation_folder, t_0, phase, variant_config, stage_cache)
+                  for (variant, variant_config) in utils.variant_configs(config_dict)]
+
+        det_image = open_det_image(simulation_folder)
+        metrics.set_integrations(det_image.shape[0])
+        simulation_data = None
+        if any(stage is None for (stage_key, stage) in stages):
+            simulation_data = read_simulation(simulation_folder, preload=preload, det_image=det_image)
+
+    return det_image, stages, simulation_data
+
+
+def compute_simulation(simulation_folder, t_0, phase, config_dict, det_image, stages, simulation_data, mask=None,
+                       background=None, state=None, coefficient_cache=None, stage_cache=None):
+    """
+    Compute stage of the post treatment, for all the variants and all the noise realisations.
+
+    The simulation is read once for all the variants, the coefficients of the effects depending on the illumination
+    are computed once, for all the effects of the variants.
+
+    Parameters
+    ----------
+    simulation_folder: str
+        path (relative or absolute) to the MIRISim simulation folder
+    t_0: float
+        Time in second since beginning of the observation
+    phase: float
+        orbital phase
+    config_dict: dict
+        validated configuration
+    det_image, stages, simulation_data:
+        see read_stages
+    mask:
+        np.array(bool) - Array of bad pixels (True if bad, False if good)
+    background:
+        np.array(float) - Image of the background, e-/s, or effects.BackgroundRamp
+    state: effects.EffectState
+        [optional] state of the deterministic effects, carried from one integration to the next
+    coefficient_cache: cache.CoefficientCache
+        [optional] cache of the coefficients of the deterministic effects
+    stage_cache: cache.StageCache
+        [optional] cache of the ramps with the deterministic effects
+
+    Returns
+    -------
+    generator of (variant_config, output_folder, det_image, new_ramp, metadatas), one per output file
+    """
+    variants = utils.variant_configs(config_dict)
+    simulation_index = utils.simulation_index(simulation_folder)
+    # Configuration of the effects of all the variants, their coefficients are computed once
+    union = None
+    if variants[0][0] is not None:
+        union = utils.union_config([variant_config for (name, variant_config) in variants])
+
+    shared_terms = None
+    for ((variant, variant_config), (stage_key, stage)) in zip(variants, stages):
+        # The spans of the compute stage are recorded for this simulation, see metrics.span
+        with metrics.simulation(simulation_folder):
+            if stage is None:
+                (det_image, original_ramp, header, illum_model) = simulation_data
+                signal_terms = None
+                if variant is not None:
+                    if shared_terms is None:
+                        shared_terms = signal_effect_terms(original_ramp, header, illum_model, union,
+                                                           coefficient_cache=coefficient_cache)
+                    # Each variant has its own effect state, the key of the shared terms identifies its terms
+                    (key, terms) = shared_terms
+                    signal_terms = (key, effects.select_signal_terms(terms, union, variant_config))
+
+                # A ramp preloaded in memory (not memory-mapped) used by a single variant gets the effects in place
+                (new_ramp, metadatas) = apply_deterministic_effects(
+                    original_ramp, header, illum_model, t_0, phase, variant_config, background=background,
+                    state=None if state is None else state.variant(variant), coefficient_cache=coefficient_cache,
+                    signal_terms=signal_terms, copy=len(variants) > 1 or not original_ramp.flags.owndata)
+                if stage_cache is not None:
+                    stage_cache.store(stage_key, new_ramp, metadatas)
+            else:
+                header = det_image.header
+                (new_ramp, metadatas) = stage
+            del stage
+
+            for (output_folder, noised_ramp, noised_metadatas) in noise_realisations(
+                    new_ramp, header, metadatas, variant_config, mask=mask, simulation_index=simulation_index):
+                yield variant_config, output_folder, det_image, noised_ramp, noised_metadatas
+            del new_ramp
+
+
+def signal_effect_terms(original_ramp, header, illum_model, config_dict, coefficient_cache=None):
+    """
+    Terms of the effects depending on the illumination (see effects.signal_terms), and their key.
+
+    Parameters
+    ----------
+    original_ramp: np.ndarray
+        ramp in DN (nb_integrations, nb_frames, nb_y, nb_x)
+    header: fits.Header
+        primary header of the det_image
+    illum_model: utils.IllumModel
+        illum_model of the simulation
+    config_dict: dict
+        validated configuration
+    coefficient_cache: cache.CoefficientCache
+        [optional] cache of the coefficients of the deterministic effects
+
+    Returns
+    -------
+    key: str
+        key of the terms, see cache.CoefficientCache.key, also without cache for the effect state
+    terms: list
+        terms of the effects
+    """
+    gain = header["GAINCF"]
+    nb_x = original_ramp.shape[-1]
+    with metrics.span("coefficients"):
+        if coefficient_cache is None:
+            return (cache.CoefficientCache.key(illum_model, gain, config_dict, nb_x),
+                    effects.signal_terms(illum_model.signal(gain), config_dict, nb_x))
+        return coefficient_cache.signal_terms(illum_model, gain, config_dict, nb_x)
+
+
+def apply_effects(original_ramp, header, illum_model, t_0, phase, config_dict, mask=None, background=None, state=None,
+                  coefficient_cache=None, simulation_index=None):
+    """
+    Compute stage of the post treatment: apply all the active effects to the original ramp.
+
+    Parameters
+    ----------
+    original_ramp: np.ndarray
+        ramp in DN (nb_integrations, nb_frames, nb_y, nb_x)
+    header: fits.Header
+        primary header of the det_image
+    illum_model: utils.IllumModel
+        illum_model of the simulation
+    t_0: float
+        Time in second since beginning of the observation
+    phase: float
+        orbital phase
+    config_dict: dict
+        validated configuration
+    mask:
+        np.array(bool) - Array of bad pixels (True if bad, False if good)
+    background:
+        np.array(float) - Image of the background, e-/s, or effects.BackgroundRamp
+    state: effects.EffectState
+        [optional] state of the deterministic effects, carried from one integration to the next
+    coefficient_cache: cache.CoefficientCache
+        [optional] cache of the coefficients of the deterministic effects
+    simulation_index: int
+        [optional] index of the simulation, its noise stream is derived from the noise seed and this index
+
+    Returns
+    -------
+    new_ramp: np.ndarray
+        ramp with effects, in DN
+    metadatas: dict
+        metadata to add to the output file
+    """
+    (new_ramp, metadatas) = apply_deterministic_effects(original_ramp, header, illum_model, t_0, phase, config_dict,
+                                                        background=background, state=state,
+                                                        coefficient_cache=coefficient_cache)
+
+    new_ramp = apply_noise(new_ramp, header, metadatas, config_dict, mask=mask, simulation_index=simulation_index)
+
+    return new_ramp, metadatas
+
 
+def apply_deterministic_effects(original_ramp, header, illum_model, t_0, phase, config_dict, background=None,
+                                state=None, coefficient_cache=None, signal_terms=None, copy=True):
+    """
+    First part of the compute stage: background, response drift, idle recovery and anneal recovery.
+
+    Parameters
+    ----------
+    See apply_effects
+
+    signal_terms: tuple
+        [optional] (key, terms) of the effects depending on the illumination, already computed,
+        see signal_effect_terms. By default, computed from illum_model.
+
+    copy: bool
+        [optional] By default, True. If False, the effects are added in place in original_ramp.
+
+    Returns
+    -------
+    new_ramp: np.ndarray
+        ramp with the deterministic effects, in DN
+    metadatas: dict
+        metadata to add to the output file
+    """
     frame_time = header["TFRAME"]  # or TGROUP
     gain       = header["GAINCF"]  # for the background
     
     metadatas = {'history': ["Post processing with MIRISim TSO v{}".format(version.__version__)], 'time_0' : t_0,
                  'phase': phase, 'TSOVISIT': True} # 'TSOVISIT': 'T' RG 28 nov 2021
 
-    new_ramp = original_ramp.copy()
+    new_ramp = original_ramp.copy() if copy else original_ramp
 
-    signal = utils.read_illum_model(illum_models_filename, gain)
-    
     # Add background before all the other effects are applied
     bck_filename = config_dict["background"]["filename"]
     if bck_filename is not None:
         metadatas['history'].append("MIRISim TSO: Add Background {}".format(bck_filename))
-        new_ramp = effects.add_background(new_ramp, background, time=frame_time, gain=gain)
+        with metrics.span("background"):
+            if not isinstance(background, effects.BackgroundRamp):
+                background = effects.BackgroundRamp(background)
+            background.add(new_ramp, time=frame_time, gain=gain)
 
     if config_dict["response_drift"]["active"]:
         metadatas['history'].append("MIRISim TSO: Add Response drift")
-        ramp_difference = effects.response_drift(original_ramp, t_0, signal, frame_time)
-        new_ramp += ramp_difference
         
     if config_dict["response_drift_one"]["active"]:
         metadatas['history'].append("MIRISim TSO: Add Response drift")
-        ramp_difference = effects.response_drift_one(original_ramp, t_0, signal, frame_time)
-        new_ramp += ramp_difference
 
     if config_dict["idle_recovery"]["active"]:
         metadatas['history'].append("MIRISim TSO: Add Idle Recovery")
-        ramp_difference = effects.idle_recovery(original_ramp, t_0, signal, frame_time, config_dict)
-        new_ramp += ramp_difference
 
     if config_dict["anneal_recovery"]["active"]:
         metadatas['history'].append("MIRISim TSO: Add Anneal Recovery")
-        ramp_difference = effects.anneal_recovery(original_ramp, t_0, frame_time, config_dict)
-        new_ramp += ramp_difference
-
-
-    # Apply poisson noise after all the other effects are applied
-    if config_dict["noise"]["active"]:
-        if mask is None:
-            mask_file = config_dict["CDP"]["mask_file"]
-            mode = config_dict["CDP"]["mode"]
-            mask = utils.read_mask(mask_file, mode)  # done 16 nov 2021 RG & AD
-        metadatas['history'].append("MIRISim TSO: Add Poisson Noise old way")
-        new_ramp = effects.poisson_noise(new_ramp, mask, gain)
-        
-    # Apply poisson noise after all the other effects are applied
-    #import pdb
-    if 'noise_bis' in config_dict:
-        if config_dict["noise_bis"]["active"]:
-            if mask is None:
-                mask_file = config_dict["CDP"]["mask_file"]
-                mode = config_dict["CDP"]["mode"]
-                mask = utils.read_mask(mask_file, mode)  # done 16 nov 2021 RG & AD
-            metadatas['history'].append("MIRISim TSO: Add Poisson Noise bis")
-            new_ramp = effects.add_poisson_noise(new_ramp, mask, gain)
-    #pdb.set_trace()
-    LOG.debug("main() | Value check for the new ramp: min={} / max={}".format(new_ramp.min(), new_ramp.max()))
 
-    # TODO Add the time-stamp in BJD to the file header.
-    
-    output_folder = config_dict["simulations"]["output_dir"]
-    output_filename = os.path.join(output_folder, os.path.basename(simulation_folder))
-    
-    # Write fits file
-    utils.write_det_image_with_effects(det_images_filename, output_filename,  new_data=new_ramp, extra_metadata=metadatas, config=config_dict,
-                                       overwrite=config_dict["simulations"]["overwrite"], obs_time=obs_time)
+    # All the deterministic effects are accumulated together in new_ramp, in a single pass
+    if signal_terms is None:
+        signal_terms = signal_effect_terms(original_ramp, header, illum_model, config_dict,
+                                           coefficient_cache=coefficient_cache)
+    (key, terms) = signal_terms
+    terms = terms + effects.anneal_terms(config_dict)
+    with metrics.span("effects"):
+        if state is None:
+            effects.add_deterministic_effects(new_ramp, t_0, terms, frame_time)
+        else:
+            state.add_effects(new_ramp, t_0, terms, frame_time, key=key)
+
+    return new_ramp, metadatas
+
+
+def apply_noise(new_ramp, header, metadatas, config_dict, mask=None, simulation_index=None, realisation=None):
+    """
+    Second part of the compute stage: Poisson noise, after all the other effects are applied.
 
+    Parameters
+    ----------
+    new_ramp: np.ndarray
+        ramp with the deterministic effects, in DN. Can be modified in place.
+    header: fits.Header
+        primary header of the det_image
+    metadatas: dict
+        metadata to add to the output file, the history of the noise is appended
+    config_dict: dict
+        validated configuration
+    mask:
+        np.array(bool) - Array of bad pixels (True if bad, False if good)
+    simulation_index: int
+        [optional] index of the simulation, its noise stream is derived from the noise seed and this index
+    realisation: int
+        [optional] index of the noise realisation, see noise_realisations
 
-def sequential_lightcurve_post_treatment(conf):
+    Returns
+    -------
+    new_ramp: np.ndarray
+        ramp with effects, in DN
+    """
+    if not utils.noise_active(config_dict):
+        return new_ramp
+
+    gain = header["GAINCF"]
+
+    # One random stream per simulation (and per realisation), derived from the seed of the run
+    seed_sequence = effects.noise_seed_sequence(config_dict["noise"].get("seed"), simulation_index,
+                                                realisation=realisation)
+    metadatas['history'].append("MIRISim TSO: Noise seed entropy={} spawn_key={}".format(
+        seed_sequence.entropy, seed_sequence.spawn_key))
+    rng = np.random.default_rng(seed_sequence)
+
+    if mask is None:
+        mask_file = config_dict["CDP"]["mask_file"]
+        mode = config_dict["CDP"]["mode"]
+        mask = utils.read_mask(mask_file, mode)  # done 16 nov 2021 RG & AD
+
+    with metrics.span("noise"):
+        # Apply poisson noise after all the other effects are applied
+        if config_dict["noise"]["active"]:
+            metadatas['history'].append("MIRISim TSO: Add Poisson Noise old way")
+            new_ramp = effects.poisson_noise(new_ramp, mask, gain, rng=rng,
+                                             chunk_frames=config_dict.get("simulations", {}).get("chunk_frames"))
+
+        # Apply poisson noise after all the other effects are applied
+        if 'noise_bis' in config_dict:
+            if config_dict["noise_bis"]["active"]:
+                metadatas['history'].append("MIRISim TSO: Add Poisson Noise bis")
+                new_ramp = effects.add_poisson_noise(new_ramp, mask, gain, rng=rng)
+
+    return new_ramp
+
+
+def noise_realisations(new_ramp, header, metadatas, config_dict, mask=None, simulation_index=None):
+    """
+    Noise stage, for each noise realisation of the simulation (see config["noise"]["n_realisations"]).
+
+    The deterministic effects are computed once, each realisation is a copy of the ramp with its own noise draw,
+    written in output_dir/realisation_XXX. With a single realisation, the noise is added to new_ramp, written in
+    output_dir.
+
+    Parameters
+    ----------
+    new_ramp: np.ndarray
+        ramp with the deterministic effects, in DN, see apply_deterministic_effects
+    header: fits.Header
+        primary header of the det_image
+    metadatas: dict
+        metadata of the deterministic effects
+    config_dict: dict
+        validated configuration
+    mask:
+        np.array(bool) - Array of bad pixels (True if bad, False if good)
+    simulation_index: int
+        [optional] index of the simulation
+
+    Returns
+    -------
+    generator of (output_folder, new_ramp, metadatas), one per realisation
+    """
+    output_folder = config_dict["simulations"]["output_dir"]
+    nb_realisation = utils.nb_realisations(config_dict)
+    if nb_realisation == 1:
+        yield output_folder, apply_noise(new_ramp, header, metadatas, config_dict, mask=mask,
+                                         simulation_index=simulation_index), metadatas
+        return
+
+    if mask is None:
+        mask = utils.read_mask(config_dict["CDP"]["mask_file"], config_dict["CDP"]["mode"])
+
+    for realisation in range(nb_realisation):
+        realisation_metadatas = dict(metadatas)
+        realisation_metadatas['history'] = metadatas['history'] + [
+            "MIRISim TSO: Noise realisation {} / {}".format(realisation, nb_realisation)]
+        noised_ramp = apply_noise(new_ramp.copy(), header, realisation_metadatas, config_dict, mask=mask,
+                                  simulation_index=simulation_index, realisation=realisation)
+        yield utils.realisation_folder(output_folder, realisation), noised_ramp, realisation_metadatas
+
+
+def write_simulation(simulation_folder, det_image, new_ramp, metadatas, config_dict, obs_time=None,
+                     output_folder=None):
+    """
+    Write stage of the post treatment: the new det_image in the output directory, or its integrations in the
+    container of the output directory (see container.IntegrationContainer).
+
+    Parameters
+    ----------
+    simulation_folder: str
+        path to the MIRISim simulation folder, its name is used for the output file
+    det_image: str or utils.DetImage
+        original det_image, file name or already opened
+    new_ramp: np.ndarray
+        ramp with effects, in DN
+    metadatas: dict
+        metadata to add to the output file
+    config_dict: dict
+        validated configuration
+    obs_time: float
+        barycenter julian date of the start of the exposure
+    output_folder: str
+        [optional] output directory, created if needed. By default, config_dict["simulations"]["output_dir"]
+    """
+    # TODO Add the time-stamp in BJD to the file header.
+    
+    if output_folder is None:
+        output_folder = config_dict["simulations"]["output_dir"]
+    elif not os.path.isdir(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+    with metrics.simulation(simulation_folder):
+        # Statistics of each output ramp, named after its folder relative to output_dir (variant, realisation)
+        output_name = os.path.relpath(output_folder, config_dict["simulations"]["output_dir"])
+        metrics.add_quality("output" if output_name == os.curdir else "output/" + output_name, new_ramp)
+
+        if container.is_active(config_dict):
+            # Integrations written in place in the container of the output directory
+            if utils.output_suffix(config_dict) != "det_images":
+                with metrics.span("write"):
+                    nb_bytes = container.container_for(output_folder, config_dict, simulation_folder).write(
+                        simulation_folder, new_ramp, det_image=det_image)
+                metrics.add_bytes(written=nb_bytes)
+            return
+
+        output_filename = os.path.join(output_folder, os.path.basename(simulation_folder))
+
+        # Write fits file
+        utils.write_det_image_with_effects(det_image, output_filename,  new_data=new_ramp, extra_metadata=metadatas, config=config_dict,
+                                           overwrite=config_dict["simulations"]["overwrite"], obs_time=obs_time)
+
+
+def sequential_lightcurve_post_treatment(conf, workers=None):
     """
     Add the post treatement, integration per integration
     :param conf: name of the ConfigObj .ini file, or corresponding dictionary
     :type conf: str or Dict
+    :param workers: number of worker processes, each one treating a simulation folder at a time.
+                    [optional] By default, use config["simulations"]["workers"]. 1 means serial processing.
+    :type workers: int
 
     :return:
     """
@@ -185,6 +661,8 @@ def sequential_lightcurve_post_treatment(conf):
     bck_filename = config_dict["background"]["filename"]
     if bck_filename is not None:
         background = fits.getdata(bck_filename)  # done March, 1rst 2022 RG
+        # Same background ramp for all the simulations, computed once
+        background = effects.BackgroundRamp(background)
     #
     obs_time_flag = False   # done March, 1rst 2022 RG
     period = config_dict["orbit"]["period"]
@@ -207,6 +685,7 @@ def sequential_lightcurve_post_treatment(conf):
     time_filename = config_dict["simulations"]["time_filename"]
     if time_filename is None:
         time_filename = os.path.join(input_folder, "times.dat")
+    from astropy.io import ascii  # for timedat, only used here
     data = ascii.read(time_filename)
     t_start = data["time"].data
     # t_start = data["t_start"].data obsolete since version 1.0.0
@@ -222,24 +701,134 @@ def sequential_lightcurve_post_treatment(conf):
         simulation_obs_time[sim] = None
         if(obs_time_flag): simulation_obs_time[sim] = orbital_phase[simulation_index[sim]]*period + epoch
 
+    # Time of each stage of each simulation, in output_dir
+    recorder = metrics.configure(config_dict)
+    metrics_offset = metrics.file_offset(recorder)
+
     # Run each simulation post treatment, one after the other
     nb_simulations = len(simulations)
     if config_dict["simulations"]["nb_simulations"] is not None:
         nb_simulations = config_dict["simulations"]["nb_simulations"]
     LOG.info("sequential_lightcurve_post_treatment() | number of simulation selected={} / total={}".format(nb_simulations, len(simulations)))
-    
-    # Run each simulation post treatment, one after the other
-    simu_i = 0
+
+    tasks = [(simulation, simulation_start_time[simulation], simulation_orbital_phase[simulation],
+              simulation_obs_time[simulation]) for simulation in simulations[:nb_simulations]]
+
+    # Without a noise seed, the entropy is drawn once for the run and used as its seed: the noise of each simulation
+    # is derived from it, and written in the history of the outputs, so that the run can be reproduced
+    run_config = config_dict
+    if utils.noise_active(config_dict) and config_dict["noise"].get("seed") is None:
+        run_config = config_dict.dict() if hasattr(config_dict, "dict") else copy.deepcopy(config_dict)
+        run_config["noise"]["seed"] = np.random.SeedSequence().entropy
+        LOG.info("sequential_lightcurve_post_treatment() | noise seed entropy={}".format(run_config["noise"]["seed"]))
+
+    # Containers of the outputs, created with all the simulations before the post treatment of the first one
+    resume = config_dict["simulations"].get("resume", False)
+    created_containers = []
+    if container.is_active(config_dict):
+        created_containers = container.create_containers(tasks, run_config, det_image_filename, resume=resume)
+
+    # Record each simulation written in the manifest, and skip the ones already done if resume is set
+    run_manifest = manifest.Manifest(output_folder, config_dict, run_inputs=[mask_file, bck_filename])
+    manifest_entries = {task[0]: run_manifest.entry(task) for task in tasks}
+    if resume and created_containers:
+        # All the simulations have integrations in the new containers, none of them is done
+        LOG.info("sequential_lightcurve_post_treatment() | resume: new containers {}, all the simulations are "
+                 "done again".format(", ".join(created_containers)))
+        run_manifest.reset()
+    if resume:
+        tasks = [task for task in tasks if not run_manifest.is_done(manifest_entries[task[0]])]
+        LOG.info("sequential_lightcurve_post_treatment() | resume: {} simulations already done, {} to do".format(
+            len(manifest_entries) - len(tasks), len(tasks)))
+
+    def on_done(simulation):
+        run_manifest.record(manifest_entries[simulation])
+
+    config_dict = run_config
+
+    if workers is None:
+        workers = config_dict["simulations"].get("workers", 1)
+
+    streaming = False
+    if 'streaming' in config_dict:
+        streaming = config_dict["streaming"]["active"]
+
+    # Headers of the det_images, read once for the memory plan and the background ramps of the workers
+    planned = tasks and (workers == 0 or config_dict["simulations"].get("max_memory") is not None)
+    layouts = None
+    if planned or (tasks and background is not None and workers > 1):
+        layouts = scheduler.det_image_layouts(tasks, det_image_filename)
+
+    # Number of workers (0: chosen) and blocks of the noise, from the size of the det_images and max_memory
+    if planned:
+        run_plan = scheduler.plan(tasks, config_dict, det_image_filename, workers=workers, layouts=layouts)
+        LOG.info("sequential_lightcurve_post_treatment() | memory plan: {} workers, noise blocks of {} frames, "
+                 "{:.0f} MB per simulation".format(run_plan.workers, run_plan.chunk_frames or "all",
+                                                    run_plan.simulation_bytes / 1E6))
+        if workers > 1 and run_plan.workers < workers:
+            LOG.warning("sequential_lightcurve_post_treatment() | {} workers instead of {}, to stay under "
+                        "max_memory".format(run_plan.workers, workers))
+        workers = run_plan.workers
+        # The plan is for this run only, the configuration of the caller is not modified
+        config_dict = config_dict.dict() if hasattr(config_dict, "dict") else copy.deepcopy(config_dict)
+        config_dict["simulations"]["chunk_frames"] = run_plan.chunk_frames
+        if streaming:
+            config_dict["streaming"]["max_in_flight"] = run_plan.max_in_flight
+    workers = max(workers, 1)
+
+    variants = utils.variant_configs(config_dict)
+    if variants[0][0] is not None:
+        LOG.info("sequential_lightcurve_post_treatment() | variants: {}".format(
+            ", ".join("{} ({})".format(name, utils.output_suffix(variant_config)) for (name, variant_config) in variants)))
+
+    if config_dict["noise"].get("n_realisations", 1) > 1:
+        if utils.noise_active(config_dict):
+            LOG.info("sequential_lightcurve_post_treatment() | {} noise realisations per simulation".format(
+                utils.nb_realisations(config_dict)))
+        else:
+            LOG.warning("sequential_lightcurve_post_treatment() | n_realisations is ignored without noise")
+
     LOG.info('Calculating...')
-    for simulation in simulations:
-        simu_i += 1
-        LOG.debug(' ')
-        LOG.debug("Run simulation {}: {:.1f}%".format(simulation, (simu_i*100/nb_simulations)))
-        single_simulation_post_treatment(simulation, simulation_start_time[simulation], simulation_orbital_phase[simulation], config_dict, mask=mask, background=background, obs_time=simulation_obs_time[simulation])
-        if (simu_i == nb_simulations):
-            print('yoho')
-            break
+    if workers > 1:
+        LOG.info("sequential_lightcurve_post_treatment() | process pool with {} workers".format(workers))
+        if streaming:
+            LOG.warning("sequential_lightcurve_post_treatment() | streaming is ignored with several workers")
+        if background is not None:
+            # Background ramps computed once here, one per (nb_frames, frame time, gain) of the run, shared with the
+            # workers instead of computed by each of them
+            for (nb_frames, frame_time, gain) in {(layout.shape[1], layout.frame_time, layout.gain)
+                                                  for layout in layouts.values()}:
+                if frame_time is not None and gain is not None:
+                    background.ramp(nb_frames, time=frame_time, gain=gain)
+        cache_stats = parallel.run_parallel(tasks, config_dict, mask=mask, background=background, workers=workers,
+                                            on_done=on_done)
+    elif streaming:
+        streaming_conf = config_dict["streaming"]
+        LOG.info("sequential_lightcurve_post_treatment() | streaming with prefetch={}, writers={}, max_in_flight={}".format(
+            streaming_conf["prefetch"], streaming_conf["writers"], streaming_conf["max_in_flight"]))
+        cache_stats = parallel.run_streaming(tasks, config_dict, mask=mask, background=background,
+                                             prefetch=streaming_conf["prefetch"], writers=streaming_conf["writers"],
+                                             max_in_flight=streaming_conf["max_in_flight"], on_done=on_done)
+    else:
+        # Run each simulation post treatment, one after the other
+        state = effects.EffectState()
+        (coefficient_cache, stage_cache) = cache.run_caches(config_dict)
+        simu_i = 0
+        for (simulation, t_0, phase, obs_time) in tasks:
+            simu_i += 1
+            LOG.debug(' ')
+            LOG.debug("Run simulation {}: {:.1f}%".format(simulation, (simu_i*100/len(tasks))))
+            single_simulation_post_treatment(simulation, t_0, phase, config_dict, mask=mask, background=background,
+                                             obs_time=obs_time, state=state, coefficient_cache=coefficient_cache,
+                                             stage_cache=stage_cache)
+            on_done(simulation)
+        LOG.debug("sequential_lightcurve_post_treatment() | effect state: {} full computations, {} incremental".format(
+            state.nb_full, state.nb_incremental))
+        cache_stats = cache.caches_stats(coefficient_cache, stage_cache)
+    cache.log_stats(cache_stats)
 
     LOG.info('Done !')
     elapsed_time = time.time() - start_time
     LOG.info(f'Job done in : {elapsed_time} s')
+    metrics.log_summary(metrics.summary(recorder, metrics_offset, elapsed_time))
+    metrics.configure({})
@@ -0,0 +1,158 @@
+"""
+Completion manifest of a post-treatment run, to resume a run that has been interrupted.
+
+The manifest is a JSON lines file in the output directory, one line is appended each time a simulation is written.
+Each line records, for a simulation folder: the size and modification time of its input files, the digest of the
+effect configuration, the time values (t_0, phase, obs_time) and the output file. On a rerun, a simulation whose
+last entry is still valid (same inputs, same configuration, output file still there) can be skipped.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+
+from . import container
+from . import utils
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "mirisim_tso_manifest.jsonl"
+
+
+def file_fingerprint(filename):
+    """
+    Cheap fingerprint of a file, changed if the file is rewritten.
+
+    :param str filename: name of the file
+    :return: [size in bytes, modification time in ns]
+    :rtype: list(int)
+    """
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def simulation_inputs(simulation_folder):
+    """
+    Input files of a simulation folder, used by the post treatment.
+
+    :param str simulation_folder: path to the MIRISim simulation folder
+    :return: det_image and illum_model filenames
+    :rtype: list(str)
+    """
+    return (glob.glob(os.path.join(simulation_folder, "det_images", "det_image_*.fits"))[:1] +
+            glob.glob(os.path.join(simulation_folder, "illum_models", "illum_model_*.fits"))[:1])
+
+
+def output_filename(simulation_folder, config_dict):
+    """
+    Name of the output file written by the post treatment of a simulation folder.
+    With several variants or noise realisations, the one of the last variant and realisation, written last.
+    With containers (see config["container"]), the container (or the index of its segments) of the last variant
+    and realisation.
+
+    :param str simulation_folder: path to the MIRISim simulation folder
+    :param dict config_dict: validated configuration
+    :rtype: str
+    """
+    config_dict = utils.variant_configs(config_dict)[-1][1]
+    output_folder = config_dict["simulations"]["output_dir"]
+    nb_realisations = utils.nb_realisations(config_dict)
+    if nb_realisations > 1:
+        output_folder = utils.realisation_folder(output_folder, nb_realisations - 1)
+    if container.is_active(config_dict):
+        return container.output_filename(output_folder, config_dict)
+    return os.path.join(output_folder, os.path.basename(simulation_folder)) + utils.output_suffix(config_dict) + '.fits'
+
+
+class Manifest:
+    """
+    Completion manifest of the simulations of a run, stored in output_dir.
+
+    :param str output_dir: output directory of the run
+    :param dict config_dict: validated configuration
+    :param list(str) run_inputs: [optional] files used by all the simulations (mask, background, ...)
+    """
+
+    def __init__(self, output_dir, config_dict, run_inputs=None):
+        self.filename = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.config_dict = config_dict
+        self.digest = utils.config_digest(config_dict)
+        self.run_inputs = {filename: file_fingerprint(filename) for filename in (run_inputs or [])
+                           if filename is not None and os.path.isfile(filename)}
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        """
+        Read the existing manifest, the last entry of a simulation replaces the previous ones.
+
+        :return: entries, key: absolute path of the simulation folder
+        :rtype: dict
+        """
+        entries = {}
+        if not os.path.isfile(self.filename):
+            return entries
+
+        with open(self.filename) as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of an interrupted run
+                    LOG.warning("Manifest | ignore corrupted line in {}".format(self.filename))
+                    continue
+                entries[entry["simulation"]] = entry
+
+        return entries
+
+    def entry(self, task):
+        """
+        Manifest entry of a simulation, from the current state of its inputs.
+
+        :param tuple task: (simulation_folder, t_0, phase, obs_time)
+        :rtype: dict
+        """
+        (simulation, t_0, phase, obs_time) = task
+        inputs = dict(self.run_inputs)
+        for filename in simulation_inputs(simulation):
+            inputs[filename] = file_fingerprint(filename)
+
+        return {"simulation": os.path.abspath(simulation),
+                "inputs": inputs,
+                "config_digest": self.digest,
+                "t_0": float(t_0),
+                "phase": float(phase),
+                "obs_time": None if obs_time is None else float(obs_time),
+                "output": output_filename(simulation, self.config_dict)}
+
+    def is_done(self, entry):
+        """
+        Is the simulation already done, with the same inputs and configuration?
+
+        :param dict entry: current entry of the simulation, computed by Manifest.entry
+        :rtype: bool
+        """
+        recorded = self.entries.get(entry["simulation"])
+        if recorded is None:
+            return False
+
+        return recorded == entry and os.path.isfile(recorded["output"])
+
+    def reset(self):
+        """
+        Forget the simulations already done, when their outputs have been recreated (e.g. a new container).
+        """
+        with self._lock:
+            self.entries = {}
+
+    def record(self, entry):
+        """
+        Append the entry of a simulation which has been written. Thread safe.
+
+        :param dict entry: entry computed by Manifest.entry before the post treatment of the simulation
+        """
+        with self._lock:
+            with open(self.filename, "a") as manifest_file:
+                manifest_file.write(json.dumps(entry) + "\n")
+            self.entries[entry["simulation"]] = entry
@@ -0,0 +1,342 @@
+"""
+Timing and throughput metrics of the post treatment.
+
+Each simulation gets a record of the time spent in each stage (read, coefficients, background, effects, noise,
+header, write), of the bytes read and written and of the peak resident memory of its process. When the simulation is
+written, its record is appended as a JSON line to mirisim_tso_metrics.jsonl in the output directory, by the process
+which treated it. At the end of the run, the median and 95th percentile of each stage and the number of integrations
+per second are reported and appended as a summary line.
+
+The stages are recorded with span(stage), in the simulation context of the current thread (see simulation): out of
+a simulation context, or when the metrics are not active, span does nothing.
+
+When [metrics] quality is set, the data quality statistics of the original ramp and of each output ramp (min, max,
+mean, number of NaN and of negative frame differences, see ramp_statistics) are added to the record.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+LOG = logging.getLogger(__name__)
+
+METRICS_FILENAME = "mirisim_tso_metrics.jsonl"
+
+# Recorder of the process, see configure
+_RECORDER = None
+# Data quality statistics of the ramps recorded, see configure
+_QUALITY = False
+
+# Stack of the simulation records of each thread, see simulation
+_LOCAL = threading.local()
+
+
+class SimulationRecord:
+    """
+    Metrics of a simulation, filled by the threads treating it.
+
+    :param str simulation_folder: path to the MIRISim simulation folder
+    """
+
+    def __init__(self, simulation_folder):
+        self.simulation = simulation_folder
+        self.spans = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.nb_integrations = 0
+        self.quality = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, duration):
+        with self._lock:
+            self.spans[stage] = self.spans.get(stage, 0.) + duration
+
+    def add_bytes(self, read=0, written=0):
+        with self._lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def to_dict(self):
+        """
+        :return: JSON line of the simulation
+        :rtype: dict
+        """
+        return {"type": "simulation", "simulation": self.simulation, "pid": os.getpid(), "spans": self.spans,
+                "bytes_read": self.bytes_read, "bytes_written": self.bytes_written,
+                "nb_integrations": self.nb_integrations, "peak_rss": peak_rss(), "quality": self.quality}
+
+
+class Recorder:
+    """
+    Metrics of the simulations treated by a process, appended to a JSON lines file.
+
+    :param str filename: name of the JSON lines file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def record(self, simulation_folder):
+        """
+        :param str simulation_folder: path to the MIRISim simulation folder
+        :return: record of the simulation, created if needed
+        :rtype: SimulationRecord
+        """
+        with self._lock:
+            if simulation_folder not in self._records:
+                self._records[simulation_folder] = SimulationRecord(simulation_folder)
+            return self._records[simulation_folder]
+
+    def finish(self, simulation_folder):
+        """
+        Append the record of a simulation to the file, once all its outputs are written.
+
+        :param str simulation_folder: path to the MIRISim simulation folder
+        """
+        with self._lock:
+            record = self._records.pop(simulation_folder, None)
+            if record is None:
+                return
+            # A single write per line, the lines of several processes are not mixed
+            with open(self.filename, "a") as metrics_file:
+                metrics_file.write(json.dumps(record.to_dict()) + "\n")
+
+
+def peak_rss():
+    """
+    :return: peak resident memory of the process, in bytes (None if not available)
+    :rtype: int
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def configure(config_dict):
+    """
+    Set the recorder of the process, from the configuration.
+
+    :param dict config_dict: validated configuration
+    :return: the recorder, None if the metrics are not active
+    :rtype: Recorder
+    """
+    global _RECORDER, _QUALITY
+    _RECORDER = None
+    _QUALITY = False
+    if config_dict.get("metrics", {}).get("active", False):
+        _RECORDER = Recorder(os.path.join(config_dict["simulations"]["output_dir"], METRICS_FILENAME))
+        _QUALITY = config_dict["metrics"].get("quality", False)
+    return _RECORDER
+
+
+def _current():
+    stack = getattr(_LOCAL, "stack", None)
+    if not stack:
+        return None
+    return stack[-1]
+
+
+@contextlib.contextmanager
+def simulation(simulation_folder):
+    """
+    Simulation context of the current thread: the spans and bytes are recorded for this simulation.
+
+    :param str simulation_folder: path to the MIRISim simulation folder
+    """
+    if _RECORDER is None:
+        yield
+        return
+    if getattr(_LOCAL, "stack", None) is None:
+        _LOCAL.stack = []
+    _LOCAL.stack.append(_RECORDER.record(simulation_folder))
+    try:
+        yield
+    finally:
+        _LOCAL.stack.pop()
+
+
+@contextlib.contextmanager
+def span(stage):
+    """
+    Time spent in a stage, added to the record of the current simulation.
+
+    :param str stage: name of the stage
+    """
+    record = _current()
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add_span(stage, time.perf_counter() - start)
+
+
+def add_bytes(read=0, written=0):
+    """
+    Bytes read or written for the current simulation.
+
+    :param int read: number of bytes read
+    :param int written: number of bytes written
+    """
+    record = _current()
+    if record is not None:
+        record.add_bytes(read=read, written=written)
+
+
+def set_integrations(nb_integrations):
+    """
+    :param int nb_integrations: number of integrations of the current simulation
+    """
+    record = _current()
+    if record is not None:
+        record.nb_integrations = int(nb_integrations)
+
+
+def ramp_statistics(ramp):
+    """
+    Data quality statistics of a ramp, in a single pass over its frames: each frame is read once, and compared to the
+    previous frame of its integration while both are in cache.
+
+    :param np.ndarray ramp: ramp (nb_integrations, nb_frames, nb_y, nb_x)
+    :return: min, max and mean of the values which are not NaN (None if all are NaN), number of NaN (nb_nan) and
+             number of pixels lower than in the previous frame (nb_negative_differences)
+    :rtype: dict
+    """
+    minimum = np.inf
+    maximum = -np.inf
+    total = 0.
+    nb_values = 0
+    nb_nan = 0
+    nb_negative_differences = 0
+    for integration in ramp:
+        previous_frame = None
+        for frame in integration:
+            nan = np.isnan(frame)
+            nb_frame_nan = int(np.count_nonzero(nan))
+            values = frame[~nan] if nb_frame_nan else frame
+            if values.size:
+                minimum = min(minimum, float(values.min()))
+                maximum = max(maximum, float(values.max()))
+                total += float(values.sum(dtype=np.float64))
+                nb_values += values.size
+            nb_nan += nb_frame_nan
+            if previous_frame is not None:
+                nb_negative_differences += int(np.count_nonzero(frame < previous_frame))
+            previous_frame = frame
+
+    if nb_values == 0:
+        (minimum, maximum, mean) = (None, None, None)
+    else:
+        mean = total / nb_values
+    return {"min": minimum, "max": maximum, "mean": mean, "nb_nan": nb_nan,
+            "nb_negative_differences": nb_negative_differences}
+
+
+def add_quality(name, ramp):
+    """
+    Data quality statistics of a ramp of the current simulation (see ramp_statistics), only computed when
+    [metrics] quality is set.
+
+    :param str name: name of the ramp in the record ("original", "output", ...)
+    :param np.ndarray ramp: ramp (nb_integrations, nb_frames, nb_y, nb_x)
+    """
+    record = _current()
+    if record is None or not _QUALITY:
+        return
+    with span("quality"):
+        statistics = ramp_statistics(ramp)
+    with record._lock:
+        record.quality[name] = statistics
+
+
+def finish(simulation_folder):
+    """
+    Write the record of a simulation, see Recorder.finish.
+
+    :param str simulation_folder: path to the MIRISim simulation folder
+    """
+    if _RECORDER is not None:
+        _RECORDER.finish(simulation_folder)
+
+
+def file_offset(recorder):
+    """
+    :param Recorder recorder: recorder of the run
+    :return: current size of the metrics file, the lines of the run are written after it
+    :rtype: int
+    """
+    if recorder is None or not os.path.isfile(recorder.filename):
+        return 0
+    return os.path.getsize(recorder.filename)
+
+
+def summary(recorder, offset, elapsed_time):
+    """
+    Summary of the run: median and 95th percentile of the time spent in each stage, number of integrations per second.
+    The summary is appended to the metrics file.
+
+    :param Recorder recorder: recorder of the run (None if the metrics are not active)
+    :param int offset: size of the metrics file at the start of the run, see file_offset
+    :param float elapsed_time: duration of the run, in s
+    :return: summary, None if the metrics are not active
+    :rtype: dict
+    """
+    if recorder is None:
+        return None
+
+    records = []
+    if os.path.isfile(recorder.filename):
+        with open(recorder.filename) as metrics_file:
+            metrics_file.seek(offset)
+            for line in metrics_file:
+                entry = json.loads(line)
+                if entry.get("type") == "simulation":
+                    records.append(entry)
+
+    stages = sorted({stage for record in records for stage in record["spans"]})
+    spans = {}
+    for stage in stages:
+        durations = [record["spans"][stage] for record in records if stage in record["spans"]]
+        spans[stage] = {"p50": float(np.percentile(durations, 50)), "p95": float(np.percentile(durations, 95))}
+    nb_integrations = sum(record["nb_integrations"] for record in records)
+    peak_rss_values = [record["peak_rss"] for record in records if record["peak_rss"] is not None]
+    run_summary = {"type": "summary", "nb_simulations": len(records), "nb_integrations": nb_integrations,
+                   "elapsed_time": elapsed_time,
+                   "integrations_per_s": nb_integrations / elapsed_time if elapsed_time > 0 else None,
+                   "bytes_read": sum(record["bytes_read"] for record in records),
+                   "bytes_written": sum(record["bytes_written"] for record in records),
+                   "peak_rss": max(peak_rss_values) if peak_rss_values else None,
+                   "spans": spans}
+
+    with open(recorder.filename, "a") as metrics_file:
+        metrics_file.write(json.dumps(run_summary) + "\n")
+    return run_summary
+
+
+def log_summary(run_summary):
+    """
+    Report the summary of the run, see summary.
+
+    :param dict run_summary: summary of the run (None if the metrics are not active)
+    """
+    if run_summary is None:
+        return
+    for (stage, percentiles) in run_summary["spans"].items():
+        LOG.info("Metrics | {:<12} p50={:.4f} s, p95={:.4f} s".format(stage, percentiles["p50"], percentiles["p95"]))
+    if run_summary["integrations_per_s"] is not None:
+        LOG.info("Metrics | {} integrations in {:.1f} s, {:.2f} integrations/s".format(
+            run_summary["nb_integrations"], run_summary["elapsed_time"], run_summary["integrations_per_s"]))
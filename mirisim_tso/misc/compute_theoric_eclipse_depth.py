@@ -1,6 +1,5 @@
 # IPython log file
 
-import matplotlib.pyplot as plt
 import numpy as np
 from astropy import units as u
 #
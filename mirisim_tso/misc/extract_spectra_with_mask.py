@@ -11,7 +11,6 @@
 
 from astropy.io import fits
 from astropy.io import ascii
-import matplotlib.pyplot as plt
 import numpy as np
 
 def extract_spectra_with_mask(cube, mask, plot=False):
@@ -16,7 +16,6 @@ RG 10 february  2021 in check_input_file if a directory is specified, do not add
 """
 
 import configparser
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import sys
@@ -107,6 +106,7 @@ def inspect_exonoodle_output(sed_dir, output_dir='plots', suffix='.pdf'):
 
     :param str sed_dir : name of the directory for exonoodle outputs
     """
+    import matplotlib.pyplot as plt
     
     # get just the name of the configuration for the title of the plots
     ini_file = glob.glob(os.path.join(sed_dir, "*.ini"))
@@ -6,7 +6,6 @@
 # see /Users/gastaud/test_dap/cascade/simulation_LRS/drift/plot_eclipse_v0.py
 # see kiss_images2spectra.py
 #
-import matplotlib.pyplot as plt
 import numpy as np
 from astropy.io import ascii
 from astropy import units as u
@@ -24,6 +23,7 @@ from mirisim_tso.misc.extract_tso_spectra import extract_tso_spectra
 
 def mirisim_tso2cascade(in_dir, in_pattern, object_ephemeris, object_period, zoom_t=1, verbose=False, out_dir=None, out_pattern=None, dphase=0, n_transit=1):
 
+    import matplotlib.pyplot as plt
     gain = 5.5
     ####  Read all the spectral images
     flux3d, wave2d, orbital_phase = read_tso_spectra(in_dir, verbose=True)
@@ -2,7 +2,6 @@
 
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy.io import fits
 import astropy.units as u
 
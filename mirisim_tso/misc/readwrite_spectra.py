@@ -14,7 +14,6 @@ from astropy.io import ascii
 from astropy.table import Table, Column
 import astropy.units as u
 import datetime
-import matplotlib.pyplot as plt
 
 
 ##########################  READ/WRITE/COMPARE GENERIC SPECTRA #########
@@ -247,6 +246,7 @@ def read_depth_ecsv(file_name):
 #################  PLOT ###################################
 
 def plot_spectrum_2d(spectrum, wavelengths, times,  title, kw=None, normalise=False):
+    import matplotlib.pyplot as plt
     nw, nt = spectrum.shape
     if (normalise):
         image = spectrum/(spectrum.mean(1)).reshape([nw, 1])
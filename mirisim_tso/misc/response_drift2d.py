@@ -9,7 +9,6 @@
 #  for minimisation purpose
 #  flux = slope DN/s
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 def response_drift2d( image, t ):
@@ -2,7 +2,6 @@
 
 import sys
 import os
-import matplotlib.pyplot as plt
 import numpy as np
 import astropy.units as u
 from astropy.io import ascii
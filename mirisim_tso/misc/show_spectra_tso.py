@@ -1,7 +1,6 @@
 # IPython log file
 
 from astropy.io import fits
-import matplotlib.pyplot as plt
 import numpy as np
 from astropy import units as u
 from scipy.ndimage import gaussian_filter1d
@@ -11,6 +10,7 @@ from mirisim_tso.misc.readwrite_spectra import write_depth_ecsv
 
 def show_spectra_tso(flux2d, wave1d, orbital_phase, period, SAVE=False, model="", pattern=""):
 
+    import matplotlib.pyplot as plt
     ttn = (orbital_phase - orbital_phase.min())*period
     ttn = ttn.to(u.second)
 
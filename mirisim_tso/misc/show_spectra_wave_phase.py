@@ -1,6 +1,5 @@
 # Plot Spectra function of phase and wavelength
 
-import matplotlib.pyplot as plt
 import numpy as np
 import astropy.units as u
 
@@ -10,6 +9,7 @@ suffix = '.png'
 """
 ########################
 def show_spectra_wave_phase(flux, wavelength, phase, my_title, suffix = '.png', save_file=None):
+    import matplotlib.pyplot as plt
     ref_waves = np.array([5.152243, 7.014417, 8.881744, 12.])#*u.micron
     # x1dints 12.008793404814282 5.022831579805857
     ##
@@ -1,7 +1,6 @@
 # IPython log file
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 def zieute(im01, comment=''):
     print(comment, im01.shape, im01.min(),  im01.mean(), im01.max(),im01.sum())
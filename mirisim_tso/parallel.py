@@ -0,0 +1,326 @@
+"""
+Parallel execution of the post-treatment of a set of MIRISim simulation folders.
+
+run_parallel: process pool. The validated configuration is sent once to each worker process through the pool
+initializer. The run-wide arrays (bad pixel mask, background image and ramps, coefficient tables) are copied once in
+shared memory by the parent process, and attached read-only without copy by the workers (see shared). The tasks
+themselves only carry the simulation folder and its time values (t_0, phase, obs_time), computed by the parent
+process exactly as in the serial path.
+The workers send their log records through a queue to a listener thread of the parent process, which owns the
+console and file handlers (see utils.queue_logging).
+
+run_streaming: single process, with the read, compute and write stages overlapped. A reader thread prefetches
+the next simulations while the current one is computed, and a pool of writer threads flushes the finished cubes.
+"""
+import concurrent.futures
+import contextlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+from . import main
+from . import effects
+from . import utils
+from . import cache
+from . import metrics
+from . import shared
+
+LOG = logging.getLogger(__name__)
+
+# Run-wide state of a worker process, filled once by _init_worker
+_WORKER_STATE = {}
+
+
+def _shared_arrays(config_dict, mask, background):
+    """
+    Run-wide arrays to place in shared memory: the bad pixel mask, the background image and the background ramps
+    already computed, the coefficient tables if an effect uses them.
+
+    :param dict config_dict: validated configuration
+    :param np.ndarray mask: bad pixel mask (True if bad, False if good)
+    :param background: image of the background, e-/s, or effects.BackgroundRamp (or None)
+    :return: arrays (key: name, value: np.ndarray) and keys of the background ramps, see _init_worker
+    :rtype: tuple(dict, list)
+    """
+    arrays = {}
+    background_keys = []
+    if mask is not None:
+        arrays["mask"] = mask
+    if isinstance(background, effects.BackgroundRamp):
+        arrays["background"] = background.background
+        for (key, ramp) in background.ramps.items():
+            arrays["background_ramp/{}".format(len(background_keys))] = ramp
+            background_keys.append(key)
+    elif background is not None:
+        arrays["background"] = background
+
+    union = utils.union_config([variant_config for (name, variant_config) in utils.variant_configs(config_dict)])
+    if effects.signal_effects_active(union):
+        for (name, table) in effects.coefficient_tables().items():
+            arrays["table/{}/values".format(name)] = table.values
+            arrays["table/{}/slopes".format(name)] = table.slopes
+    return arrays, background_keys
+
+
+def _init_worker(config_dict, shared_description, background_keys, log_queue=None, log_level=logging.DEBUG):
+    """
+    Initializer of each worker process, store the inputs shared by all the simulations of the run.
+
+    :param dict config_dict: validated configuration
+    :param dict shared_description: run-wide arrays in shared memory, see _shared_arrays and shared.SharedArrays
+    :param list background_keys: (nb_frames, frame time, gain) of each background ramp in shared memory
+    :param multiprocessing.Queue log_queue: [optional] queue of the log records, see utils.queue_logging
+    :param int log_level: level of the records sent through log_queue
+    """
+    if log_queue is not None:
+        utils.init_queue_log(log_queue, log_level)
+    arrays = shared.attach(shared_description)
+
+    background = arrays.get("background")
+    if background is not None:
+        ramps = {key: arrays["background_ramp/{}".format(index)] for (index, key) in enumerate(background_keys)}
+        background = effects.BackgroundRamp(background, ramps=ramps)
+    table_names = {name.split("/")[1] for name in arrays if name.startswith("table/")}
+    if table_names:
+        effects.set_coefficient_tables({name: (arrays["table/{}/values".format(name)],
+                                               arrays["table/{}/slopes".format(name)]) for name in table_names})
+
+    _WORKER_STATE["config"] = config_dict
+    _WORKER_STATE["mask"] = arrays.get("mask")
+    _WORKER_STATE["background"] = background
+    _WORKER_STATE["effects"] = effects.EffectState()
+    (_WORKER_STATE["cache"], _WORKER_STATE["stage_cache"]) = cache.run_caches(config_dict)
+    metrics.configure(config_dict)
+
+
+def _run_task(task):
+    """
+    Post-treatment of one simulation folder in a worker process.
+
+    :param tuple task: (simulation_folder, t_0, phase, obs_time)
+    :return: the simulation folder, to report progress, the worker process id and the stats of its caches
+    :rtype: tuple
+    """
+    (simulation, t_0, phase, obs_time) = task
+    main.single_simulation_post_treatment(simulation, t_0, phase, _WORKER_STATE["config"],
+                                          mask=_WORKER_STATE["mask"], background=_WORKER_STATE["background"],
+                                          obs_time=obs_time, state=_WORKER_STATE["effects"],
+                                          coefficient_cache=_WORKER_STATE["cache"],
+                                          stage_cache=_WORKER_STATE["stage_cache"])
+    return simulation, os.getpid(), cache.caches_stats(_WORKER_STATE["cache"], _WORKER_STATE["stage_cache"])
+
+
+def run_parallel(tasks, config_dict, mask=None, background=None, workers=2, on_done=None):
+    """
+    Run single_simulation_post_treatment on each task with a pool of worker processes.
+
+    The first exception raised in a worker is raised again in the parent process.
+
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time)
+    :param dict config_dict: validated configuration
+    :param np.ndarray mask: bad pixel mask (True if bad, False if good)
+    :param background: image of the background, e-/s, or effects.BackgroundRamp
+    :param int workers: number of worker processes
+    :param callable on_done: [optional] called in the parent process with the simulation folder, once it is written
+    :return: stats of the caches of each worker, see cache.caches_stats
+    :rtype: list(dict)
+    """
+    # ConfigObj sections keep references to their parents, a plain dict is lighter to send to the workers
+    if hasattr(config_dict, "dict"):
+        config_dict = config_dict.dict()
+
+    nb_tasks = len(tasks)
+    cache_stats = {}  # key: worker process id ; value: last stats of its cache
+    with contextlib.ExitStack() as stack:
+        (log_queue, log_level) = (None, logging.DEBUG)
+        if config_dict["simulations"].get("log_queue", True) and logging.getLogger().handlers:
+            # The listener is stopped after the executor shutdown, once the workers have sent all their records
+            log_queue = multiprocessing.Queue()
+            log_level = stack.enter_context(utils.queue_logging(log_queue))
+        # The shared memory is released after the executor shutdown, once the workers are done with it
+        (arrays, background_keys) = _shared_arrays(config_dict, mask, background)
+        shared_arrays = stack.enter_context(shared.SharedArrays(arrays))
+        del arrays
+        executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(config_dict, shared_arrays.description, background_keys, log_queue, log_level)))
+        futures = [executor.submit(_run_task, task) for task in tasks]
+        try:
+            for (simu_i, future) in enumerate(concurrent.futures.as_completed(futures), start=1):
+                (simulation, pid, cache_stats[pid]) = future.result()
+                LOG.debug("Done simulation {}: {:.1f}%".format(simulation, (simu_i*100/nb_tasks)))
+                if on_done is not None:
+                    on_done(simulation)
+        except BaseException:
+            # Don't start the pending simulations, the running ones are awaited by the executor shutdown
+            for future in futures:
+                future.cancel()
+            raise
+
+    return list(cache_stats.values())
+
+
+# Markers sent by the reader thread of run_streaming
+_END_OF_TASKS = object()
+_READ_ERROR = object()
+
+
+def _put(item_queue, item, stop):
+    """
+    Put item in a bounded queue, unless stop is set while waiting for a free slot.
+
+    :return: True if the item has been put in the queue
+    :rtype: bool
+    """
+    while not stop.is_set():
+        try:
+            item_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _acquire(semaphore, stop):
+    """
+    Acquire semaphore, unless stop is set while waiting.
+
+    :return: True if the semaphore has been acquired
+    :rtype: bool
+    """
+    while not stop.is_set():
+        if semaphore.acquire(timeout=0.1):
+            return True
+    return False
+
+
+def _reader(tasks, read_queue, in_flight, stop, config_dict, stage_cache):
+    """
+    Reader stage of run_streaming: read the simulations one after the other, and put them in read_queue.
+
+    A simulation is read only when there is a free in-flight slot, the slot is released once it is written.
+    The simulations in the stage cache are read from the cache, see main.read_stages.
+    """
+    for task in tasks:
+        if not _acquire(in_flight, stop):
+            return
+        try:
+            (simulation, t_0, phase, obs_time) = task
+            data = main.read_stages(simulation, t_0, phase, config_dict, stage_cache=stage_cache, preload=True)
+        except BaseException as error:
+            in_flight.release()
+            _put(read_queue, (_READ_ERROR, error), stop)
+            return
+        if not _put(read_queue, (task, data), stop):
+            in_flight.release()
+            return
+    _put(read_queue, (_END_OF_TASKS, None), stop)
+
+
+def _write(simulation, config_dict, output_folder, det_image, new_ramp, metadatas, obs_time, on_done=None,
+           previous=None):
+    """
+    Writer stage of run_streaming, for an output of main.compute_simulation.
+
+    The last output of a simulation is given the futures of the previous ones: it waits for them, closes the
+    det_image and calls on_done.
+    """
+    main.write_simulation(simulation, det_image, new_ramp, metadatas, config_dict, obs_time=obs_time,
+                          output_folder=output_folder)
+    if previous is None:
+        return
+    try:
+        for future in previous:
+            future.result()
+    finally:
+        det_image.close()
+    if on_done is not None:
+        on_done(simulation)
+    metrics.finish(simulation)
+
+
+def run_streaming(tasks, config_dict, mask=None, background=None, prefetch=2, writers=2, max_in_flight=4,
+                  on_done=None):
+    """
+    Run the post-treatment of each task, with the read, compute and write stages overlapped.
+
+    The simulations are processed in the order of tasks. The first exception raised in any stage is raised again.
+
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time)
+    :param dict config_dict: validated configuration
+    :param np.ndarray mask: bad pixel mask (True if bad, False if good)
+    :param background: image of the background, e-/s, or effects.BackgroundRamp
+    :param int prefetch: number of simulations read in advance, waiting to be computed
+    :param int writers: number of writer threads
+    :param int max_in_flight: maximum number of simulations read but not yet written, this caps the memory used
+    :param callable on_done: [optional] called in a writer thread with the simulation folder, once it is written
+    :return: stats of the caches, see cache.caches_stats
+    :rtype: dict
+    """
+    read_queue = queue.Queue(maxsize=prefetch)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    stop = threading.Event()
+    (coefficient_cache, stage_cache) = cache.run_caches(config_dict)
+
+    reader = threading.Thread(target=_reader, args=(tasks, read_queue, in_flight, stop, config_dict, stage_cache),
+                              name="mirisim_tso-reader", daemon=True)
+    reader.start()
+
+    nb_tasks = len(tasks)
+    state = effects.EffectState()
+    write_futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=writers, thread_name_prefix="mirisim_tso-writer") as executor:
+        try:
+            simu_i = 0
+            while True:
+                (task, data) = read_queue.get()
+                if task is _END_OF_TASKS:
+                    break
+                if task is _READ_ERROR:
+                    raise data
+
+                simu_i += 1
+                (simulation, t_0, phase, obs_time) = task
+                (det_image, stages, simulation_data) = data
+                del data
+                LOG.debug(' ')
+                LOG.debug("Run simulation {}: {:.1f}%".format(simulation, (simu_i*100/nb_tasks)))
+                outputs = main.compute_simulation(simulation, t_0, phase, config_dict, det_image, stages,
+                                                  simulation_data,
+                                                  mask=mask, background=background, state=state,
+                                                  coefficient_cache=coefficient_cache, stage_cache=stage_cache)
+                del stages, simulation_data
+
+                # One write per variant and noise realisation, the in-flight slot is released by the last one
+                simulation_futures = []
+                output = next(outputs)
+                for next_output in outputs:
+                    simulation_futures.append(executor.submit(_write, simulation, *output, obs_time))
+                    write_futures.append(simulation_futures[-1])
+                    output = next_output
+                    # Cap the number of outputs waiting to be written
+                    pending = [future for future in write_futures if not future.done()]
+                    while len(pending) >= max_in_flight:
+                        concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        pending = [future for future in pending if not future.done()]
+                future = executor.submit(_write, simulation, *output, obs_time, on_done,
+                                         simulation_futures)
+                future.add_done_callback(lambda f: in_flight.release())
+                write_futures.append(future)
+                del output, outputs, det_image
+
+                # Report write errors as soon as possible
+                for future in write_futures:
+                    if future.done():
+                        future.result()
+                write_futures = [future for future in write_futures if not future.done()]
+        finally:
+            stop.set()
+            reader.join()
+
+        for future in write_futures:
+            future.result()
+
+    return cache.caches_stats(coefficient_cache, stage_cache)
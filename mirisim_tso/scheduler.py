@@ -0,0 +1,222 @@
+"""
+Memory budget of a run: number of worker processes and size of the blocks of the noise, from the size of the
+det_images and the effects of the configuration.
+
+The shape of each det_image is read from the NAXIS* keywords of its first extension, before the post treatment
+(see det_image_layouts, the same read gives the frame time and the gain for the background ramps).
+The peak memory of a simulation is estimated from the largest shape (see simulation_bytes): the original ramp, the
+ramp with the effects, the per pixel coefficients of the effects, the noise and the write. The peak memory of a
+worker process adds the interpreter and the run-wide arrays (mask, background ramp, coefficient cache), see
+process_bytes.
+
+plan chooses the largest number of workers (up to the number of CPUs, or the requested number) whose memory stays
+under config["simulations"]["max_memory"], and if needed processes the noise of [noise] by smaller blocks of frames
+(effects.poisson_noise, same result). The deterministic effects and the noise of [noise_bis] are already computed
+frame by frame.
+"""
+import collections
+import logging
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from . import cache
+from . import effects
+from . import utils
+
+LOG = logging.getLogger(__name__)
+
+# Memory of a worker process before the first simulation (interpreter, numpy, astropy), in bytes
+PROCESS_BYTES = 100E6
+
+# Fraction of the physical memory used when max_memory is not set
+PHYSICAL_MEMORY_FRACTION = 0.8
+
+# key: workers, number of worker processes (1: serial)
+#      chunk_frames, number of frames of the blocks of the noise (None: all the frames of an integration)
+#      max_in_flight, number of simulations in flight when streaming
+#      simulation_bytes, peak memory of a simulation
+#      available, memory budget of the run, in bytes
+Plan = collections.namedtuple("Plan", ["workers", "chunk_frames", "max_in_flight", "simulation_bytes", "available"])
+
+
+# key: shape, (nb_integrations, nb_frames, nb_y, nb_x) of the ramp
+#      itemsize, number of bytes per value of the ramp
+#      frame_time, TFRAME of the primary header (None if missing)
+#      gain, GAINCF of the primary header (None if missing)
+Layout = collections.namedtuple("Layout", ["shape", "itemsize", "frame_time", "gain"])
+
+
+def _shape(header):
+    shape = tuple(header.get("NAXIS{}".format(axis), 1) for axis in range(header["NAXIS"], 0, -1))
+    return (1,) * (4 - len(shape)) + shape, abs(header["BITPIX"]) // 8
+
+
+def det_image_shape(filename):
+    """
+    :param str filename: det_image file
+    :return: shape of the ramp (nb_integrations, nb_frames, nb_y, nb_x), from the NAXIS* keywords, and number of
+             bytes per value, from BITPIX
+    :rtype: tuple(tuple(int), int)
+    """
+    return _shape(fits.getheader(filename, 1))
+
+
+def det_image_layouts(tasks, det_image_filename):
+    """
+    Layout of the det_image of each task, from its headers only, read once for the run.
+
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time)
+    :param callable det_image_filename: name of the det_image of a simulation folder
+    :return: key: simulation folder, value: Layout
+    :rtype: dict
+    """
+    layouts = {}
+    for task in tasks:
+        with fits.open(det_image_filename(task[0])) as hdulist:
+            primary = hdulist[0].header
+            (shape, itemsize) = _shape(hdulist[1].header)
+        layouts[task[0]] = Layout(shape, itemsize, primary.get("TFRAME"), primary.get("GAINCF"))
+    return layouts
+
+
+def physical_memory():
+    """
+    :return: physical memory of the node, in bytes (None if not available)
+    :rtype: int
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):  # Not available on Windows
+        return None
+
+
+def _nb_signal_terms(config_dict):
+    """
+    :return: number of per pixel terms of the effects, for all the variants
+    :rtype: int
+    """
+    union = utils.union_config([variant_config for (name, variant_config) in utils.variant_configs(config_dict)])
+    return sum(nb_terms for (effect, nb_terms) in effects.SIGNAL_EFFECTS if union[effect]["active"])
+
+
+def simulation_bytes(shape, config_dict, itemsize=4, chunk_frames=None):
+    """
+    Estimate of the peak memory of the post treatment of a simulation.
+
+    :param tuple shape: (nb_integrations, nb_frames, nb_y, nb_x) of the ramp
+    :param dict config_dict: validated configuration
+    :param int itemsize: [optional] number of bytes of the values of the det_image
+    :param int chunk_frames: [optional] number of frames of the blocks of the noise, see effects.poisson_noise
+    :return: number of bytes
+    :rtype: int
+    """
+    (nb_integrations, nb_frames, nb_y, nb_x) = shape
+    image = nb_y * nb_x
+    cube = 4 * nb_integrations * nb_frames * image  # float32
+
+    # Original ramp (memory-mapped pages or preloaded), ramp with the effects, output HDU
+    nb_bytes = itemsize * nb_integrations * nb_frames * image + 2 * cube
+    # Signal and per pixel terms (prefactor, alpha, decay, ratio), float64 images
+    nb_bytes += 8 * image * (1 + 4 * _nb_signal_terms(config_dict))
+
+    if utils.noise_active(config_dict):
+        if utils.nb_realisations(config_dict) > 1:
+            # Copy of the ramp for each realisation
+            nb_bytes += cube
+        if config_dict["noise"]["active"]:
+            # Noised ramp, and by block: differences, good pixels, Poisson values (int64), float64 and float32 noise
+            block = min(chunk_frames or nb_frames, nb_frames) * image
+            nb_bytes += cube + 32 * block
+        if config_dict.get("noise_bis", {}).get("active", False):
+            # A few frame images, see effects.add_poisson_noise
+            nb_bytes += 8 * 6 * image
+    return int(nb_bytes)
+
+
+def process_bytes(shape, config_dict, nb_tasks):
+    """
+    Memory of a worker process besides the simulation: interpreter, bad pixel mask, background ramp and coefficient
+    cache.
+
+    :param tuple shape: (nb_integrations, nb_frames, nb_y, nb_x) of the ramp
+    :param dict config_dict: validated configuration
+    :param int nb_tasks: number of simulations of the run
+    :return: number of bytes
+    :rtype: int
+    """
+    (nb_integrations, nb_frames, nb_y, nb_x) = shape
+    image = nb_y * nb_x
+    nb_bytes = PROCESS_BYTES + image
+    if config_dict.get("background", {}).get("filename") is not None:
+        nb_bytes += 8 * image + 4 * nb_frames * image
+    # Each entry of the coefficient cache has a prefactor and an alpha per term
+    nb_entries = min(cache.cache_options(config_dict)["max_entries"], nb_tasks)
+    nb_bytes += nb_entries * 2 * 8 * image * _nb_signal_terms(config_dict)
+    return int(nb_bytes)
+
+
+def plan(tasks, config_dict, det_image_filename, workers=0, cpu_count=None, layouts=None):
+    """
+    Number of workers and size of the blocks of the noise, so that the run stays under max_memory.
+
+    :param list tasks: list of (simulation_folder, t_0, phase, obs_time)
+    :param dict config_dict: validated configuration, config["simulations"]["max_memory"] in MB. If not set, a
+                             fraction of the physical memory (PHYSICAL_MEMORY_FRACTION).
+    :param callable det_image_filename: name of the det_image of a simulation folder
+    :param int workers: requested number of workers, 0 to choose it (up to cpu_count)
+    :param int cpu_count: [optional] number of CPUs, by default os.cpu_count()
+    :param dict layouts: [optional] layouts of the det_images, see det_image_layouts. By default, read here.
+    :return: plan of the run
+    :rtype: Plan
+    """
+    simulations_conf = config_dict["simulations"]
+    max_memory = simulations_conf.get("max_memory")
+    available = max_memory * 1E6 if max_memory is not None else None
+    if available is None and physical_memory() is not None:
+        available = PHYSICAL_MEMORY_FRACTION * physical_memory()
+
+    # Largest det_image of the run
+    if layouts is None:
+        layouts = det_image_layouts(tasks, det_image_filename)
+    (shape, itemsize) = max(((layouts[task[0]].shape, layouts[task[0]].itemsize) for task in tasks),
+                            key=lambda shape_itemsize: (int(np.prod(shape_itemsize[0])) * shape_itemsize[1]))
+    nb_frames = shape[1]
+
+    max_workers = workers if workers > 0 else (cpu_count or os.cpu_count() or 1)
+    max_workers = max(1, min(max_workers, len(tasks)))
+    max_in_flight = config_dict.get("streaming", {}).get("max_in_flight", 1)
+    chunk_frames = simulations_conf.get("chunk_frames")
+    if available is None:
+        return Plan(max_workers, chunk_frames, max_in_flight,
+                    simulation_bytes(shape, config_dict, itemsize, chunk_frames), None)
+
+    def fitting_workers(chunk):
+        per_worker = process_bytes(shape, config_dict, len(tasks)) + simulation_bytes(shape, config_dict, itemsize,
+                                                                                        chunk)
+        return int(available // per_worker)
+
+    # Smaller blocks of noise only if they give more workers, down to one frame
+    candidates = [chunk_frames] if chunk_frames is not None else [None]
+    if chunk_frames is None and config_dict["noise"]["active"] and utils.noise_active(config_dict):
+        chunk = nb_frames
+        while chunk > 1:
+            chunk = (chunk + 1) // 2
+            candidates.append(chunk)
+    for chunk_frames in candidates:
+        if fitting_workers(chunk_frames) >= max_workers:
+            break
+    nb_workers = max(1, min(max_workers, fitting_workers(chunk_frames)))
+    nb_bytes = simulation_bytes(shape, config_dict, itemsize, chunk_frames)
+    if fitting_workers(chunk_frames) < 1:
+        LOG.warning("scheduler.plan() | a simulation {} needs about {:.0f} MB, more than the {:.0f} MB available".format(
+            shape, nb_bytes / 1E6, available / 1E6))
+
+    if nb_workers == 1:
+        # Simulations in flight when streaming, each one holds its original ramp and its output until written
+        held = (itemsize + 4) * int(np.prod(shape))
+        free = available - process_bytes(shape, config_dict, len(tasks)) - nb_bytes
+        max_in_flight = max(1, min(max_in_flight, int(free // held) + 1))
+
+    return Plan(nb_workers, chunk_frames, max_in_flight, nb_bytes, available)
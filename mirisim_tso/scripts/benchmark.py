@@ -0,0 +1,342 @@
+"""
+Benchmarks of the post treatment, on synthetic MIRISim simulations at the LRS (416x72) and FULL (1024x1032) sizes.
+
+Each effect, the noise kernels and the post treatment of simulation folders are timed (best time of several runs).
+The results can be stored as a baseline, a later run on the same machine flags the cases slower than the baseline
+by more than a threshold.
+
+usage:
+    python -m mirisim_tso.scripts.benchmark --save                     # store the baseline
+    python -m mirisim_tso.scripts.benchmark --threshold 0.2            # compare with the baseline
+    python -m mirisim_tso.scripts.benchmark --modes LRS --groups 65 --integrations 1 --simulations 4
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+import mirisim_tso
+from mirisim_tso import effects
+
+LOG = logging.getLogger(__name__)
+
+# (nb_y, nb_x) of the det_images of each subarray
+SUBARRAYS = {"LRS": (416, 72), "FULL": (1024, 1032)}
+
+FRAME_TIME = 0.159
+GAIN = 5.5
+BASELINE_FILENAME = "benchmark_baseline.json"
+
+EFFECTS_CONFIG = {"response_drift": {"active": True}, "response_drift_one": {"active": True},
+                  "idle_recovery": {"active": True, "duration": 1000.}, "anneal_recovery": {"active": True, "time": 600.}}
+
+
+def synthetic_illumination(shape, seed=0):
+    """
+    Illumination of a slitless spectrum: faint background and a bright trace.
+
+    :param tuple shape: (nb_y, nb_x) of the illumination, without the 4 reference columns
+    :param int seed: [optional] seed of the random values
+    :return: illumination in e-/s
+    :rtype: np.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    (nb_y, nb_x) = shape
+    illumination = rng.uniform(20., 80., shape)
+    trace = slice(nb_x // 2 - max(nb_x // 20, 1), nb_x // 2 + max(nb_x // 20, 1))
+    illumination[:, trace] += rng.uniform(500., 30000., (nb_y, trace.stop - trace.start))
+    return illumination
+
+
+def synthetic_simulation(folder, shape, nb_groups=10, nb_integrations=1, seed=0):
+    """
+    Write a MIRISim-like simulation folder: det_images/det_image_*.fits and illum_models/illum_model_*.fits.
+
+    :param str folder: simulation folder, created
+    :param tuple shape: (nb_y, nb_x) of the det_image
+    :param int nb_groups: number of groups (frames) per integration
+    :param int nb_integrations: number of integrations
+    :param int seed: [optional] seed of the illumination
+    :return: the simulation folder
+    :rtype: str
+    """
+    (nb_y, nb_x) = shape
+    os.makedirs(os.path.join(folder, "det_images"), exist_ok=True)
+    os.makedirs(os.path.join(folder, "illum_models"), exist_ok=True)
+
+    illumination = synthetic_illumination((nb_y, nb_x - 4), seed=seed)
+    signal = np.zeros(shape, dtype=np.float32)
+    signal[:, 4:] = illumination / GAIN
+    ramp = 10000. + np.arange(nb_groups)[:, np.newaxis, np.newaxis] * FRAME_TIME * signal
+    ramp = np.repeat(np.float32(ramp)[np.newaxis], nb_integrations, axis=0)
+
+    primary = fits.PrimaryHDU()
+    primary.header["TFRAME"] = FRAME_TIME
+    primary.header["GAINCF"] = GAIN
+    primary.header["NGROUPS"] = nb_groups
+    primary.header["NINTS"] = nb_integrations
+    primary.header["EFFINTTM"] = nb_groups * FRAME_TIME
+    fits.HDUList([primary, fits.ImageHDU(ramp, name="SCI")]).writeto(
+        os.path.join(folder, "det_images", "det_image_seq1_MIRIMAGE_P750Lexp1.fits"), overwrite=True)
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(illumination[np.newaxis], name="INTENSITY")]).writeto(
+        os.path.join(folder, "illum_models", "illum_model_1_MIRIMAGE_P750L.fits"), overwrite=True)
+    return folder
+
+
+def synthetic_mask(filename, shape, fraction=0.01, seed=0):
+    """
+    Write a bad pixel mask of the size of the det_images (read with mode = 'FULL', not cropped).
+
+    :param str filename: name of the mask file
+    :param tuple shape: (nb_y, nb_x) of the det_images
+    :param float fraction: [optional] fraction of bad pixels
+    :param int seed: [optional] seed of the bad pixels
+    :return: the mask file
+    :rtype: str
+    """
+    rng = np.random.default_rng(seed)
+    mask = np.uint8(rng.random(shape) < fraction)
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(mask, name="DQ")]).writeto(filename, overwrite=True)
+    return filename
+
+
+def synthetic_run(directory, shape, nb_groups=10, nb_integrations=1, nb_simulations=2):
+    """
+    Write the inputs and the configuration of a run: simulation folders, times.dat and bad pixel mask.
+
+    :param str directory: directory of the run
+    :param tuple shape: (nb_y, nb_x) of the det_images
+    :param int nb_groups: number of groups per integration
+    :param int nb_integrations: number of integrations per simulation
+    :param int nb_simulations: number of simulation folders
+    :return: validated configuration of the run, all the effects active
+    :rtype: dict
+    """
+    input_dir = os.path.join(directory, "mirisim")
+    for idx in range(nb_simulations):
+        synthetic_simulation(os.path.join(input_dir, "simulation_{:03d}".format(idx)), shape, nb_groups=nb_groups,
+                             nb_integrations=nb_integrations, seed=idx)
+    with open(os.path.join(input_dir, "times.dat"), "w") as times_file:
+        times_file.write("file_index time phase\n")
+        for idx in range(nb_simulations):
+            times_file.write("{} {} {}\n".format(idx, 100. + 60. * idx, -0.01 + 0.005 * idx))
+    mask_file = synthetic_mask(os.path.join(directory, "mask.fits"), shape)
+
+    config_filename = os.path.join(directory, "post_treatment.ini")
+    with open(config_filename, "w") as config_file:
+        config_file.write("""
+[simulations]
+input_dir = "{}"
+filtername = "simulation_*"
+output_dir = "{}"
+
+[response_drift_one]
+active = True
+
+[idle_recovery]
+active = True
+duration = 1000.
+
+[anneal_recovery]
+active = True
+
+[noise]
+seed = 0
+
+[noise_bis]
+active = True
+
+[CDP]
+mask_file = "{}"
+mode = 'FULL'
+""".format(input_dir, os.path.join(directory, "outputs"), mask_file))
+    return mirisim_tso.utils.get_config(config_filename)
+
+
+def best_time(function, setup=None, repeat=3):
+    """
+    Best duration of several calls of a function.
+
+    :param callable function: function timed, called with the arguments returned by setup
+    :param callable setup: [optional] returns the arguments of function, not timed
+    :param int repeat: number of calls
+    :return: best duration, in s
+    :rtype: float
+    """
+    durations = []
+    for _ in range(repeat):
+        arguments = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def benchmark_cases(mode, shape, nb_groups, nb_integrations, nb_simulations, directory):
+    """
+    Cases of a subarray size.
+
+    :return: list of (name, function, setup)
+    :rtype: list(tuple)
+    """
+    (nb_y, nb_x) = shape
+    illumination = synthetic_illumination((nb_y, nb_x - 4))
+    signal = np.zeros(shape)
+    signal[:, 4:] = illumination / GAIN
+    ramp = 10000. + np.arange(nb_groups)[:, np.newaxis, np.newaxis] * FRAME_TIME * signal
+    ramp = np.repeat(np.float32(ramp)[np.newaxis], nb_integrations, axis=0)
+    mask = np.random.default_rng(0).random(shape) < 0.01
+    background = np.full(shape, 30.)
+    t_0 = 100.
+
+    terms = effects.signal_terms(signal, EFFECTS_CONFIG, nb_x) + effects.anneal_terms(EFFECTS_CONFIG)
+    config = synthetic_run(directory, shape, nb_groups=nb_groups, nb_integrations=nb_integrations,
+                           nb_simulations=nb_simulations)
+    rng = np.random.default_rng(0)
+
+    def copy():
+        return (ramp.copy(),)
+
+    return [
+        ("effects/response_drift", lambda: effects.response_drift(ramp, t_0, signal, FRAME_TIME), None),
+        ("effects/response_drift_one", lambda: effects.response_drift_one(ramp, t_0, signal, FRAME_TIME), None),
+        ("effects/idle_recovery", lambda: effects.idle_recovery(ramp, t_0, signal, FRAME_TIME, EFFECTS_CONFIG), None),
+        ("effects/anneal_recovery", lambda: effects.anneal_recovery(ramp, t_0, FRAME_TIME, EFFECTS_CONFIG), None),
+        ("effects/coefficients", lambda: effects.signal_terms(signal, EFFECTS_CONFIG, nb_x), None),
+        ("effects/deterministic", lambda new_ramp: effects.add_deterministic_effects(new_ramp, t_0, terms,
+                                                                                      FRAME_TIME), copy),
+        ("effects/background", lambda new_ramp: effects.BackgroundRamp(background).add(new_ramp, time=FRAME_TIME,
+                                                                                         gain=GAIN), copy),
+        ("noise/poisson_noise", lambda: effects.poisson_noise(ramp, mask, GAIN, rng=rng), None),
+        ("noise/add_poisson_noise", lambda new_ramp: effects.add_poisson_noise(new_ramp, mask, GAIN, rng=rng), copy),
+        ("pipeline/serial", lambda: mirisim_tso.sequential_lightcurve_post_treatment(config), None),
+    ]
+
+
+def run_benchmarks(modes=("LRS", "FULL"), nb_groups=10, nb_integrations=1, nb_simulations=2, repeat=3,
+                   directory=None):
+    """
+    Time all the cases of each subarray size.
+
+    :param list(str) modes: subarrays, keys of SUBARRAYS
+    :param int nb_groups: number of groups per integration
+    :param int nb_integrations: number of integrations per simulation
+    :param int nb_simulations: number of simulation folders of the pipeline cases
+    :param int repeat: number of runs of each case, the best time is kept
+    :param str directory: [optional] directory of the synthetic inputs. By default, a temporary directory.
+    :return: best time of each case in s, key: "<mode>/<case>"
+    :rtype: dict
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(dir=directory) as work_dir:
+        for mode in modes:
+            cases = benchmark_cases(mode, SUBARRAYS[mode], nb_groups, nb_integrations, nb_simulations,
+                                    os.path.join(work_dir, mode))
+            for (name, function, setup) in cases:
+                results["{}/{}".format(mode, name)] = best_time(function, setup=setup, repeat=repeat)
+                LOG.info("benchmark | {}/{}: {:.4f} s".format(mode, name, results["{}/{}".format(mode, name)]))
+    return results
+
+
+def machine():
+    """
+    :return: description of the machine and of the versions, stored with the baseline
+    :rtype: dict
+    """
+    return {"node": platform.node(), "processor": platform.processor(), "python": platform.python_version(),
+            "numpy": np.__version__, "mirisim_tso": mirisim_tso.__version__}
+
+
+def save_baseline(filename, results, parameters):
+    """
+    :param str filename: name of the baseline file
+    :param dict results: see run_benchmarks
+    :param dict parameters: parameters of the run (groups, integrations, ...), compared before the results
+    """
+    with open(filename, "w") as baseline_file:
+        json.dump({"machine": machine(), "parameters": parameters, "results": results}, baseline_file, indent=2,
+                  sort_keys=True)
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Cases slower than the baseline by more than threshold.
+
+    :param dict results: see run_benchmarks
+    :param dict baseline: results of the baseline
+    :param float threshold: relative slow down, 0.2 flags the cases more than 20% slower
+    :return: list of (name, baseline time, time, ratio)
+    :rtype: list(tuple)
+    """
+    regressions = []
+    for (name, duration) in sorted(results.items()):
+        if name in baseline and duration > baseline[name] * (1. + threshold):
+            regressions.append((name, baseline[name], duration, duration / baseline[name]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of mirisim_tso on synthetic simulations")
+    parser.add_argument("--modes", nargs="+", choices=sorted(SUBARRAYS), default=["LRS", "FULL"])
+    parser.add_argument("--groups", type=int, default=10, help="number of groups per integration")
+    parser.add_argument("--integrations", type=int, default=1, help="number of integrations per simulation")
+    parser.add_argument("--simulations", type=int, default=2, help="number of simulations of the pipeline cases")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of each case, the best one is kept")
+    parser.add_argument("--baseline", default=BASELINE_FILENAME, help="baseline file")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slow down flagged as a regression")
+    args = parser.parse_args(argv)
+
+    parameters = {"groups": args.groups, "integrations": args.integrations, "simulations": args.simulations}
+
+    baseline = None
+    if not args.save:
+        if not os.path.isfile(args.baseline):
+            print("No baseline {}, run with --save first".format(args.baseline))
+        else:
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline["parameters"] != parameters:
+                print("The baseline was run with other parameters: {}".format(baseline["parameters"]))
+                return 2
+            if baseline["machine"] != machine():
+                print("Warning: the baseline was run on another machine or with other versions: {}".format(
+                    baseline["machine"]))
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # Only the results, not the log of each post treatment
+    logging.getLogger("mirisim_tso").setLevel(logging.WARNING)
+    LOG.setLevel(logging.INFO)
+
+    results = run_benchmarks(modes=args.modes, nb_groups=args.groups, nb_integrations=args.integrations,
+                             nb_simulations=args.simulations, repeat=args.repeat)
+
+    if args.save:
+        save_baseline(args.baseline, results, parameters)
+        print("Baseline stored in {}".format(args.baseline))
+        return 0
+    if baseline is None:
+        return 0
+
+    print("{:<40} {:>10} {:>10} {:>7}".format("case", "baseline", "time", "ratio"))
+    for (name, duration) in sorted(results.items()):
+        reference = baseline["results"].get(name)
+        ratio = "" if reference is None else "{:7.2f}".format(duration / reference)
+        print("{:<40} {:>10} {:10.4f} {:>7}".format(name, "" if reference is None else "{:.4f}".format(reference),
+                                                     duration, ratio))
+
+    regressions = compare(results, baseline["results"], threshold=args.threshold)
+    for (name, reference, duration, ratio) in regressions:
+        print("REGRESSION {}: {:.4f} s -> {:.4f} s (x{:.2f})".format(name, reference, duration, ratio))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
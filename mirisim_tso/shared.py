@@ -0,0 +1,94 @@
+"""
+Read-only arrays of a run in shared memory, for the worker processes of parallel.run_parallel.
+
+The parent process copies each run-wide array (bad pixel mask, background image and ramps, coefficient tables)
+once in a shared memory block, and sends to the workers only its description: name of the block, shape and
+dtype. Each worker attaches the blocks without copy, as read-only arrays.
+
+In the parent process:
+
+    with SharedArrays({"mask": mask}) as arrays:
+        ... initargs=(arrays.description, ...)
+
+In a worker process:
+
+    arrays = attach(description)
+"""
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+# Blocks attached by this process, kept open as long as the process uses their arrays
+_ATTACHED = []
+
+
+class SharedArrays:
+    """
+    Copy of arrays in shared memory blocks, owned by the parent process. The blocks are released on close.
+
+    :param dict arrays: key: name, value: np.ndarray
+    """
+
+    def __init__(self, arrays):
+        self.description = {}  # key: name ; value: (name of the block, shape, dtype)
+        self._blocks = []
+        try:
+            for (name, array) in arrays.items():
+                array = np.ascontiguousarray(array)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self._blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                self.description[name] = (block.name, array.shape, array.dtype.str)
+        except BaseException:
+            self.close()
+            raise
+        LOG.debug("SharedArrays() | {} arrays, {:.1f} MB".format(
+            len(self._blocks), sum(block.size for block in self._blocks) / 1E6))
+
+    def close(self):
+        """
+        Release the shared memory blocks. The workers must be done with them.
+        """
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _open(block_name):
+    """
+    :param str block_name: name of an existing shared memory block
+    :rtype: shared_memory.SharedMemory
+    """
+    try:
+        # The block is released by the parent process, not by the resource tracker of the worker (Python >= 3.13)
+        return shared_memory.SharedMemory(name=block_name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=block_name)
+
+
+def attach(description):
+    """
+    Arrays of a SharedArrays, without copy.
+
+    :param dict description: SharedArrays.description
+    :return: key: name, value: read-only np.ndarray
+    :rtype: dict
+    """
+    arrays = {}
+    for (name, (block_name, shape, dtype)) in description.items():
+        block = _open(block_name)
+        _ATTACHED.append(block)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays
@@ -0,0 +1,44 @@
+import glob
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from mirisim_tso.scripts import benchmark
+
+
+def test_synthetic_simulation(tmp_path):
+    """
+    The det_image has the size of the subarray, the illum_model has 4 reference columns less
+    """
+    folder = benchmark.synthetic_simulation(str(tmp_path / "simulation_000"), benchmark.SUBARRAYS["LRS"],
+                                            nb_groups=3, nb_integrations=2)
+    with fits.open(glob.glob(os.path.join(folder, "det_images", "det_image_*.fits"))[0]) as hdulist:
+        assert hdulist[1].data.shape == (2, 3, 416, 72)
+        assert hdulist[0].header["NGROUPS"] == 3
+        assert hdulist[0].header["NINTS"] == 2
+    with fits.open(glob.glob(os.path.join(folder, "illum_models", "illum_model_*.fits"))[0]) as hdulist:
+        assert hdulist["INTENSITY"].data.shape == (1, 416, 68)
+
+
+def test_run_benchmarks(tmp_path, monkeypatch):
+    monkeypatch.setitem(benchmark.SUBARRAYS, "LRS", (16, 12))
+    results = benchmark.run_benchmarks(modes=["LRS"], nb_groups=3, nb_simulations=2, repeat=1,
+                                       directory=str(tmp_path))
+    assert "LRS/effects/response_drift" in results
+    assert "LRS/noise/poisson_noise" in results
+    assert "LRS/pipeline/serial" in results
+    assert all(duration > 0 for duration in results.values())
+
+
+def test_compare():
+    baseline = {"a": 1., "b": 1., "c": 1.}
+    regressions = benchmark.compare({"a": 1.1, "b": 1.5, "d": 9.}, baseline, threshold=0.2)
+    assert [name for (name, _, _, _) in regressions] == ["b"]
+    assert np.isclose(regressions[0][3], 1.5)
+
+
+def test_baseline(tmp_path):
+    filename = str(tmp_path / "baseline.json")
+    benchmark.save_baseline(filename, {"a": 1.}, {"groups": 3})
+    assert benchmark.main(["--modes", "LRS", "--groups", "4", "--repeat", "1", "--baseline", filename]) == 2
@@ -0,0 +1,93 @@
+import shutil
+
+import mirisim_tso
+import numpy as np
+import pytest
+import numpy.testing as npt
+from astropy.io import fits
+
+GAIN = 5.5
+NB_Y, NB_X = 6, 5
+
+
+@pytest.fixture
+def illum_models(tmp_path):
+    """
+    Two illum_model files with the same content, and a third one with a different illumination
+    """
+    rng = np.random.default_rng(3)
+    illumination = rng.uniform(50., 6000., (NB_Y, NB_X + 4)) * GAIN
+    filenames = [str(tmp_path / "illum_model_{}.fits".format(idx)) for idx in range(3)]
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(illumination[np.newaxis], name="INTENSITY")]).writeto(filenames[0])
+    shutil.copy(filenames[0], filenames[1])
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(0.99 * illumination[np.newaxis], name="INTENSITY")]).writeto(
+        filenames[2])
+    return [mirisim_tso.utils.IllumModel(filename) for filename in filenames]
+
+
+def effect_config(drift_one=True):
+    return {"response_drift": {"active": False}, "response_drift_one": {"active": drift_one},
+            "idle_recovery": {"active": True, "duration": 1000.},
+            "anneal_recovery": {"active": False, "time": 600.}}
+
+
+def test_coefficient_cache(illum_models, tmp_path):
+    """
+    The coefficients are computed once per illum_model content, and are the ones of effects.signal_terms
+    """
+    config = effect_config()
+    coefficient_cache = mirisim_tso.cache.CoefficientCache(max_entries=1)
+
+    (key_0, terms_0) = coefficient_cache.signal_terms(illum_models[0], GAIN, config, NB_X)
+    (key_1, terms_1) = coefficient_cache.signal_terms(illum_models[1], GAIN, config, NB_X)
+    assert key_0 == key_1
+    assert terms_1 is terms_0
+    assert coefficient_cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 1}
+
+    expected = mirisim_tso.effects.signal_terms(illum_models[0].signal(GAIN), config, NB_X)
+    assert len(terms_0) == len(expected)
+    for ((prefactor, alpha, offset), (expected_prefactor, expected_alpha, expected_offset)) in zip(terms_0, expected):
+        npt.assert_array_equal(prefactor, expected_prefactor)
+        npt.assert_array_equal(alpha, expected_alpha)
+        assert offset == expected_offset
+        assert not prefactor.flags.writeable
+
+    # Another illumination, another gain or other effect parameters: another key. The oldest entry is evicted.
+    assert coefficient_cache.signal_terms(illum_models[2], GAIN, config, NB_X)[0] != key_0
+    assert coefficient_cache.key(illum_models[0], 2 * GAIN, config, NB_X) != key_0
+    assert coefficient_cache.key(illum_models[0], GAIN, effect_config(drift_one=False), NB_X) != key_0
+    coefficient_cache.signal_terms(illum_models[0], GAIN, config, NB_X)
+    assert coefficient_cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 3}
+
+
+def test_coefficient_cache_on_disk(illum_models, tmp_path):
+    """
+    A new cache with the same directory reads the coefficients from the disk
+    """
+    config = effect_config()
+    directory = str(tmp_path / "cache")
+    (key, terms) = mirisim_tso.cache.CoefficientCache(directory=directory).signal_terms(illum_models[0], GAIN, config,
+                                                                                         NB_X)
+
+    coefficient_cache = mirisim_tso.cache.CoefficientCache(directory=directory)
+    (disk_key, disk_terms) = coefficient_cache.signal_terms(illum_models[1], GAIN, config, NB_X)
+    assert disk_key == key
+    assert coefficient_cache.stats() == {"hits": 0, "disk_hits": 1, "misses": 0}
+    for ((prefactor, alpha, offset), (disk_prefactor, disk_alpha, disk_offset)) in zip(terms, disk_terms):
+        npt.assert_array_equal(prefactor, disk_prefactor)
+        npt.assert_array_equal(alpha, disk_alpha)
+
+
+def test_effects_version(illum_models, tmp_path, monkeypatch):
+    """
+    A new version of the computation of the effects doesn't use the coefficients and the ramps already cached
+    """
+    config = effect_config()
+    config["background"] = {"filename": None}
+    simulation = tmp_path / "simulation_000"
+    coefficient_key = mirisim_tso.cache.CoefficientCache.key(illum_models[0], GAIN, config, NB_X)
+    stage_key = mirisim_tso.cache.StageCache.key(str(simulation), 10., 0.1, config)
+
+    monkeypatch.setattr(mirisim_tso.effects, "EFFECTS_VERSION", mirisim_tso.effects.EFFECTS_VERSION + 1)
+    assert mirisim_tso.cache.CoefficientCache.key(illum_models[0], GAIN, config, NB_X) != coefficient_key
+    assert mirisim_tso.cache.StageCache.key(str(simulation), 10., 0.1, config) != stage_key
@@ -1,3 +1,5 @@
+import tracemalloc
+
 import mirisim_tso
 import numpy as np
 import pytest
@@ -43,3 +45,278 @@ def test_response_drift(input_ramp, flux, t_0, frame_time):
     npt.assert_array_almost_equal(ramp_difference, np.zeros_like(ramp_difference))
 
 
+
+
+def effect_config(idle_duration=1000., anneal_time=600.):
+    return {"response_drift": {"active": True}, "response_drift_one": {"active": True},
+            "idle_recovery": {"active": True, "duration": idle_duration},
+            "anneal_recovery": {"active": True, "time": anneal_time}}
+
+
+@pytest.mark.parametrize("t_0", [0., 60., 3000., 12000.])
+def test_add_deterministic_effects(t_0, caplog):
+    """
+    The fused computation of the deterministic effects gives the sum of the single effect functions, and reports
+    the reference columns of the illum model
+    """
+    frame_time = 0.159
+    (nb_frames, nb_y, nb_x) = (20, 16, 12)
+    rng = np.random.default_rng(1)
+    # Reference columns in the illum model, to check they are removed like in the single effect functions
+    signal = np.zeros((nb_y, nb_x + 4))
+    signal[:, 4:] = rng.uniform(0., 8000., (nb_y, nb_x))
+    original_ramp = np.float32(np.arange(nb_frames)[np.newaxis, :, np.newaxis, np.newaxis] * signal[:, 4:] * frame_time)
+    config = effect_config()
+
+    expected = original_ramp.copy()
+    expected += mirisim_tso.effects.response_drift(original_ramp, t_0, signal, frame_time)
+    expected += mirisim_tso.effects.response_drift_one(original_ramp, t_0, signal, frame_time)
+    expected += mirisim_tso.effects.idle_recovery(original_ramp, t_0, signal, frame_time, config)
+    expected += mirisim_tso.effects.anneal_recovery(original_ramp, t_0, frame_time, config)
+
+    new_ramp = original_ramp.copy()
+    caplog.clear()
+    with caplog.at_level("DEBUG", logger="mirisim_tso.effects"):
+        terms = mirisim_tso.effects.deterministic_terms(signal, config, nb_x)
+    assert any("problem of reference pixels" in record.getMessage() for record in caplog.records)
+    result = mirisim_tso.effects.add_deterministic_effects(new_ramp, t_0, terms, frame_time)
+
+    assert result is new_ramp
+    assert new_ramp.dtype == np.float32
+    npt.assert_allclose(new_ramp, expected, rtol=1e-6, atol=1e-3)
+
+
+def test_exponential_decay_accuracy():
+    """
+    The recurrence on the frames gives the closed form exp(-t / alpha), over a TSO of 12000s
+    """
+    frame_time = 0.159
+    nb_frames = 500
+    signal = np.linspace(0., 8000., 200)[np.newaxis, :]
+    config = effect_config()
+    terms = mirisim_tso.effects.deterministic_terms(signal, config, signal.shape[1])
+
+    for t_0 in np.arange(0., 12000., 250.):
+        t = t_0 + np.arange(nb_frames)[:, np.newaxis, np.newaxis] * frame_time
+        expected = sum(prefactor * (np.exp(-(t_0 + offset) / alpha) - np.exp(-(t + offset) / alpha))
+                       for (prefactor, alpha, offset) in terms)
+
+        ramp = np.zeros((1, nb_frames) + signal.shape)
+        mirisim_tso.effects.add_deterministic_effects(ramp, t_0, terms, frame_time)
+        npt.assert_allclose(ramp[0], expected, rtol=1e-9, atol=1e-9 * np.abs(expected).max())
+
+        for (prefactor, alpha, offset) in terms:
+            alpha = np.broadcast_to(alpha, signal.shape)
+            decay = mirisim_tso.effects.exponential_decay(alpha, t_0 + offset, nb_frames, frame_time)
+            npt.assert_allclose(decay, np.exp(-(t + offset) / alpha), rtol=1e-11)
+
+
+def test_effect_state():
+    """
+    The effect state carried from one integration to the next gives the same ramps than the full computation
+    """
+    frame_time = 0.159
+    (nb_frames, nb_y, nb_x) = (10, 6, 5)
+    rng = np.random.default_rng(2)
+    signal_out = rng.uniform(0., 8000., (nb_y, nb_x))
+    signal_in = 0.99 * signal_out
+    config = effect_config()
+
+    # Evenly spaced integrations, a transit, and integrations out of chronological order
+    t_0s = [0., 60., 120., 180., 240., 300., 360., 240., 420.]
+    keys = ["out", "out", "out", "in", "in", "out", "out", "out", "out"]
+    signals = {"out": signal_out, "in": signal_in}
+
+    state = mirisim_tso.effects.EffectState()
+    for (t_0, key) in zip(t_0s, keys):
+        terms = mirisim_tso.effects.deterministic_terms(signals[key], config, nb_x)
+        expected = np.zeros((1, nb_frames, nb_y, nb_x))
+        mirisim_tso.effects.add_deterministic_effects(expected, t_0, terms, frame_time)
+
+        ramp = np.zeros((1, nb_frames, nb_y, nb_x))
+        state.add_effects(ramp, t_0, terms, frame_time, key=key)
+        npt.assert_allclose(ramp, expected, rtol=1e-10, atol=1e-10 * np.abs(expected).max())
+
+    assert state.nb_full == 4
+    assert state.nb_incremental == 5
+
+
+@pytest.mark.parametrize("contiguous", [True, False])
+def test_active_pixels(contiguous):
+    """
+    Only the pixels with a response drift are evaluated, with the same result than the dense evaluation
+    """
+    frame_time = 0.159
+    (nb_frames, nb_y, nb_x) = (7, 20, 10)
+    rng = np.random.default_rng(4)
+    # Most pixels are below the low threshold or above the fading threshold of response_drift_one
+    signal = rng.choice([10., 20000.], (nb_y, nb_x))
+    signal[3, 4:7] = [200., 1000., 4000.]
+    config = effect_config()
+    config["response_drift"]["active"] = False
+    config["idle_recovery"]["active"] = False
+
+    terms = mirisim_tso.effects.deterministic_terms(signal, config, nb_x)
+    index = mirisim_tso.effects.active_pixels(terms)
+    npt.assert_array_equal(index, np.ravel_multi_index(([3, 3, 3], [4, 5, 6]), (nb_y, nb_x)))
+
+    expected = np.zeros((2, nb_frames, nb_y, nb_x))
+    prefactors = [prefactor for (prefactor, alpha, offset) in terms]
+    decays = [np.array(np.exp(-(60. + offset) / alpha)) for (prefactor, alpha, offset) in terms]
+    ratios = [np.exp(-frame_time / alpha) for (prefactor, alpha, offset) in terms]
+    mirisim_tso.effects._accumulate_terms(expected, prefactors, decays, ratios)
+
+    ramp = np.zeros((2, nb_frames, nb_y, nb_x))
+    if not contiguous:
+        ramp = np.zeros((2, nb_frames, nb_x, nb_y)).transpose(0, 1, 3, 2)
+    mirisim_tso.effects.add_deterministic_effects(ramp, 60., terms, frame_time)
+    npt.assert_allclose(ramp, expected, rtol=1e-12, atol=1e-12 * np.abs(expected).max())
+
+    # Idle recovery is active on all pixels: dense evaluation
+    config["idle_recovery"]["active"] = True
+    assert mirisim_tso.effects.active_pixels(mirisim_tso.effects.deterministic_terms(signal, config, nb_x)) is None
+
+
+def test_coefficient_tables():
+    """
+    The tabulated coefficients are the fits within the documented relative error, including at the thresholds
+    """
+    thresholds = [75., 750., 5000.]
+    signal = np.concatenate([np.linspace(-10., 12000., 100001), thresholds, np.nextafter(thresholds, 0),
+                             np.nextafter(thresholds, 1e5)])[np.newaxis, :]
+
+    for (tabulated, exact) in [(mirisim_tso.effects.response_drift_coefficients(signal, tabulated=True),
+                                mirisim_tso.effects.response_drift_coefficients(signal)),
+                               (mirisim_tso.effects.response_drift_one_coefficients(signal, tabulated=True),
+                                mirisim_tso.effects.response_drift_one_coefficients(signal)),
+                               (mirisim_tso.effects.idle_recovery_coefficients(signal, 1000., tabulated=True),
+                                mirisim_tso.effects.idle_recovery_coefficients(signal, 1000.))]:
+        for ((tab_prefactor, tab_alpha, _), (prefactor, alpha, _)) in zip(tabulated, exact):
+            npt.assert_allclose(tab_alpha, alpha, rtol=4e-7)
+            npt.assert_allclose(tab_prefactor, prefactor, rtol=1e-6, atol=1e-9)
+
+
+def test_add_poisson_noise():
+    """
+    Mean and standard deviation of the Poisson noise, bad pixels and negative differences, memory used
+    """
+    gain = 5.5
+    (nb_integrations, nb_frames, nb_y, nb_x) = (2, 20, 100, 100)
+    difference = 2000.
+    ramp = 100. + difference * np.arange(nb_frames)[np.newaxis, :, np.newaxis, np.newaxis] * np.ones(
+        (nb_integrations, nb_frames, nb_y, nb_x), dtype=np.float32)
+    ramp = np.float32(ramp)
+    original_ramp = ramp.copy()
+    mask = np.zeros((nb_y, nb_x), dtype=bool)
+    mask[10, 20] = True
+    # Negative difference (read out noise): no noise added for this frame
+    ramp[:, 2, 50, 50] = ramp[:, 1, 50, 50] - 10.
+    original_ramp[:, 2, 50, 50] = ramp[:, 2, 50, 50]
+
+    # First call, memory allocated once by numpy
+    mirisim_tso.effects.add_poisson_noise(ramp[:1, :2].copy(), mask, gain)
+    tracemalloc.start()
+    noised_ramp = mirisim_tso.effects.add_poisson_noise(ramp, mask, gain, rng=np.random.default_rng(5))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert noised_ramp is ramp
+    # A few frame images (float64), whatever the number of frames
+    assert peak < 10 * nb_y * nb_x * 8
+
+    npt.assert_array_equal(noised_ramp[:, :, 10, 20], original_ramp[:, :, 10, 20])
+    noise = np.float64(noised_ramp) - original_ramp
+    npt.assert_allclose(noise[:, 2, 50, 50], noise[:, 1, 50, 50], atol=1e-3)
+
+    # The noise of each frame difference is independent, the first frame gets the noise of one difference
+    for k in range(nb_frames):
+        expected_std = np.sqrt((k + 1) * difference / gain)
+        npt.assert_allclose(noise[:, k].mean(), 0., atol=4 * expected_std / 100)
+        npt.assert_allclose(noise[:, k].std(), expected_std, rtol=0.02)
+
+
+def test_add_poisson_noise_integrations():
+    """
+    The first frame of each integration gets the noise of the first difference of this integration
+    """
+    gain = 5.5
+    (nb_frames, nb_y, nb_x) = (4, 100, 100)
+    differences = np.array([500., 8000.])
+    ramp = np.float32(100. + differences[:, np.newaxis, np.newaxis, np.newaxis] *
+                      np.arange(nb_frames)[np.newaxis, :, np.newaxis, np.newaxis] * np.ones((2, nb_frames, nb_y, nb_x)))
+    original_ramp = ramp.copy()
+    noise = np.float64(mirisim_tso.effects.add_poisson_noise(ramp, np.zeros((nb_y, nb_x), dtype=bool), gain,
+                                                             rng=np.random.default_rng(3))) - original_ramp
+    for (integration, difference) in enumerate(differences):
+        npt.assert_allclose(noise[integration, 0].std(), np.sqrt(difference / gain), rtol=0.05)
+
+
+def test_poisson_noise_chunks():
+    """
+    The noise computed by blocks of frames is the same than for the whole integration, with less memory, and each
+    integration keeps its level
+    """
+    rng = np.random.default_rng(1)
+    (nb_frames, nb_y, nb_x) = (12, 50, 40)
+    ramp = np.float32(100. + np.cumsum(rng.uniform(-5., 300., (1, nb_frames, nb_y, nb_x)), axis=1))
+    mask = rng.random((nb_y, nb_x)) < 0.1
+
+    tracemalloc.start()
+    expected = mirisim_tso.effects.poisson_noise(ramp, mask, 5.5, rng=np.random.default_rng(7))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    for chunk_frames in [1, 5, 12]:
+        tracemalloc.start()
+        noised_ramp = mirisim_tso.effects.poisson_noise(ramp, mask, 5.5, rng=np.random.default_rng(7),
+                                                        chunk_frames=chunk_frames)
+        chunk_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        npt.assert_array_equal(noised_ramp, expected)
+        if chunk_frames == 1:
+            assert chunk_peak < peak / 2
+
+    # Each integration keeps its own level, whatever the blocks
+    ramp = np.float32(np.concatenate([ramp, ramp + 1000.]))
+    good_pixels = np.invert(mask)
+    expected = mirisim_tso.effects.poisson_noise(ramp, mask, 5.5, rng=np.random.default_rng(7))
+    for chunk_frames in [1, 5, 12]:
+        noised_ramp = mirisim_tso.effects.poisson_noise(ramp, mask, 5.5, rng=np.random.default_rng(7),
+                                                        chunk_frames=chunk_frames)
+        npt.assert_array_equal(noised_ramp, expected)
+        for integration in range(2):
+            difference = (noised_ramp[integration] - ramp[integration])[:, good_pixels]
+            assert abs(difference.mean()) < 1.
+            npt.assert_array_equal(noised_ramp[integration][:, mask], ramp[integration][:, mask])
+
+
+def test_noise_seed_sequence():
+    """
+    The seed sequence of a simulation is the child of the run seed sequence with the simulation index
+    """
+    children = np.random.SeedSequence(42).spawn(5)
+    for idx in [0, 3]:
+        npt.assert_array_equal(mirisim_tso.effects.noise_seed_sequence(42, idx).generate_state(4),
+                               children[idx].generate_state(4))
+
+
+def test_add_background():
+    """
+    The background is accumulated from the first frame, for all the integrations
+    """
+    (nb_integrations, nb_frames, nb_y, nb_x) = (3, 5, 4, 6)
+    (frame_time, gain) = (0.159, 5.5)
+    rng = np.random.default_rng(6)
+    background = rng.uniform(0., 100., (nb_y, nb_x))
+    ramp = np.float32(rng.uniform(0., 1000., (nb_integrations, nb_frames, nb_y, nb_x)))
+
+    expected = ramp + np.cumsum(np.broadcast_to(background * frame_time / gain, (nb_frames, nb_y, nb_x)), axis=0)
+    new_ramp = mirisim_tso.effects.add_background(ramp, background, time=frame_time, gain=gain)
+    assert new_ramp is not ramp
+    assert new_ramp.dtype == np.float32
+    npt.assert_allclose(new_ramp, expected, rtol=1e-6)
+
+    # Computed once, added in place
+    background_ramp = mirisim_tso.effects.BackgroundRamp(background)
+    assert background_ramp.ramp(nb_frames, frame_time, gain) is background_ramp.ramp(nb_frames, frame_time, gain)
+    assert background_ramp.add(ramp, time=frame_time, gain=gain) is ramp
+    npt.assert_array_equal(ramp, new_ramp)
@@ -0,0 +1,61 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# Import time budget of "import mirisim_tso", in s. Generous, the actual time is a few tens of ms.
+IMPORT_BUDGET = 0.5
+HEAVY_MODULES = ["astropy", "configobj", "validate", "pkg_resources", "matplotlib"]
+
+
+def imported_modules(statement):
+    """
+    Run statement in a new interpreter
+
+    Returns
+    -------
+    duration of the statement in s, heavy modules imported
+    """
+    code = """
+import json, sys, time
+start = time.perf_counter()
+{}
+duration = time.perf_counter() - start
+print(json.dumps([duration, [name for name in {} if name in sys.modules]]))
+""".format(statement, HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_import_budget():
+    """
+    The package import doesn't load the heavy dependencies, and stays within the budget
+    """
+    (duration, heavy_modules) = imported_modules("import mirisim_tso")
+    assert heavy_modules == []
+    assert duration < IMPORT_BUDGET
+
+
+@pytest.mark.parametrize("statement", ["from mirisim_tso import effects", "import mirisim_tso.metrics",
+                                       "import mirisim_tso.scripts"])
+def test_light_modules(statement):
+    """
+    The effects and the metrics only need numpy
+    """
+    assert imported_modules(statement)[1] == []
+
+
+def test_lazy_attributes():
+    """
+    The modules and functions of the package are loaded on first access
+    """
+    (duration, heavy_modules) = imported_modules("import mirisim_tso; mirisim_tso.sequential_lightcurve_post_treatment")
+    assert "astropy" in heavy_modules
+    assert "configobj" not in heavy_modules
+
+    import mirisim_tso
+    assert mirisim_tso.utils.get_config is not None
+    assert "sequential_lightcurve_post_treatment" in dir(mirisim_tso)
+    with pytest.raises(AttributeError):
+        mirisim_tso.not_an_attribute
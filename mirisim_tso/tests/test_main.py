@@ -0,0 +1,616 @@
+import os
+import glob
+import json
+import logging
+import logging.handlers
+import re
+import shutil
+
+import mirisim_tso
+import numpy as np
+import pytest
+import numpy.testing as npt
+from astropy.io import fits
+
+NB_SIMULATIONS = 4
+NB_FRAMES, NB_Y, NB_X = 6, 8, 5
+FRAME_TIME = 0.159
+GAIN = 5.5
+
+
+def write_config(tmp_path, input_dir, output_dir, mask_file, extra="", simulations_extra="", duration=1000.):
+    config_filename = str(tmp_path / "post_treatment.ini")
+    with open(config_filename, "w") as config_file:
+        config_file.write("""
+[simulations]
+input_dir = "{}"
+filtername = "simulation_*"
+output_dir = "{}"
+{}
+
+[response_drift_one]
+active = True
+
+[idle_recovery]
+active = True
+duration = {}
+
+[anneal_recovery]
+active = True
+
+[CDP]
+mask_file = "{}"
+mode = 'FULL'
+{}
+""".format(input_dir, output_dir, simulations_extra, duration, mask_file, extra))
+    return config_filename
+
+
+def make_simulations(directory):
+    """
+    Small MIRISim-like simulation folders, with times.dat and a bad pixel mask
+
+    Returns
+    -------
+    input_dir, mask_file
+    """
+    input_dir = directory / "mirisim"
+    rng = np.random.default_rng(0)
+    for idx in range(NB_SIMULATIONS):
+        folder = input_dir / "simulation_{:03d}".format(idx)
+        os.makedirs(folder / "det_images")
+        os.makedirs(folder / "illum_models")
+
+        illumination = rng.uniform(50., 6000., (NB_Y, NB_X)) * GAIN
+        ramp = np.arange(NB_FRAMES)[:, np.newaxis, np.newaxis] * FRAME_TIME * illumination / GAIN + 100.
+        primary = fits.PrimaryHDU()
+        primary.header["TFRAME"] = FRAME_TIME
+        primary.header["GAINCF"] = GAIN
+        fits.HDUList([primary, fits.ImageHDU(np.float32(ramp[np.newaxis]), name="SCI")]).writeto(
+            folder / "det_images" / "det_image_seq1_MIRIMAGE_P750Lexp1.fits")
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(illumination[np.newaxis], name="INTENSITY")]).writeto(
+            folder / "illum_models" / "illum_model_1_MIRIMAGE_P750L.fits")
+
+    with open(input_dir / "times.dat", "w") as times_file:
+        times_file.write("file_index time phase\n")
+        for idx in range(NB_SIMULATIONS):
+            times_file.write("{} {} {}\n".format(idx, 100. + 60. * idx, -0.01 + 0.005 * idx))
+
+    mask = np.zeros((NB_Y, NB_X), dtype=np.uint8)
+    mask[2, 3] = 1
+    mask_file = str(directory / "mask.fits")
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(mask, name="DQ")]).writeto(mask_file)
+
+    return str(input_dir), mask_file
+
+
+@pytest.fixture
+def simulations(tmp_path):
+    """
+    Simulations of a test, which it can modify
+    """
+    return make_simulations(tmp_path)
+
+
+class SerialReference:
+    """
+    Simulations shared by the tests of the module, read-only, with the outputs of the serial path computed once per
+    configuration
+
+    :param pathlib.Path directory: directory of the simulations and of the outputs
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        (self.input_dir, self.mask_file) = make_simulations(directory)
+        self._outputs = {}  # key: extra configuration ; value: read_outputs
+
+    def outputs(self, extra=""):
+        """
+        :param str extra: extra sections of the configuration, as in write_config
+        :return: outputs of the serial path, see read_outputs
+        :rtype: dict
+        """
+        if extra not in self._outputs:
+            output_dir = str(self.directory / "serial_{}".format(len(self._outputs)))
+            mirisim_tso.sequential_lightcurve_post_treatment(write_config(self.directory, self.input_dir, output_dir,
+                                                                          self.mask_file, extra))
+            self._outputs[extra] = read_outputs(output_dir)
+        return self._outputs[extra]
+
+
+@pytest.fixture(scope="module")
+def reference(tmp_path_factory):
+    return SerialReference(tmp_path_factory.mktemp("reference"))
+
+
+def read_outputs(output_dir):
+    outputs = {}
+    for filename in sorted(glob.glob(os.path.join(output_dir, "simulation_*.fits"))):
+        with fits.open(filename) as hdulist:
+            outputs[os.path.basename(filename)] = (hdulist[1].data.copy(), hdulist[0].header.copy())
+    return outputs
+
+
+@pytest.mark.parametrize("noise, extra, simulations_extra, workers", [
+    pytest.param("", "", "", 2, id="workers"),
+    pytest.param("", "[streaming]\nactive = True\nprefetch = 1\nwriters = 2\nmax_in_flight = 2\n", "", 1,
+                 id="streaming"),
+    pytest.param("[noise]\nactive = True\nseed = 3\n", "", "workers = 0\nmax_memory = 1.", None, id="memory_plan"),
+    pytest.param("[noise_bis]\nactive = True\n[noise]\nseed = 42\n", "", "", 3, id="noise_seed"),
+])
+def test_same_outputs(reference, tmp_path, noise, extra, simulations_extra, workers):
+    """
+    A process pool, the streaming mode (read, compute and write stages overlapped) and the memory plan (workers and
+    blocks of the noise chosen from max_memory) give the same outputs (data, t_0 and phase) than the serial path,
+    with the same noise for a seed, and the configuration of the caller is not modified
+    """
+    serial = reference.outputs(noise)
+
+    output_dir = str(tmp_path / "outputs")
+    config = mirisim_tso.utils.get_config(write_config(tmp_path, reference.input_dir, output_dir, reference.mask_file,
+                                                       noise + extra, simulations_extra=simulations_extra))
+    mirisim_tso.sequential_lightcurve_post_treatment(config, workers=workers)
+    assert config["simulations"]["chunk_frames"] is None
+
+    outputs = read_outputs(output_dir)
+    assert len(serial) == NB_SIMULATIONS
+    assert serial.keys() == outputs.keys()
+    for (idx, name) in enumerate(serial):
+        (serial_data, serial_header) = serial[name]
+        (data, header) = outputs[name]
+        npt.assert_array_equal(serial_data, data)
+        assert header["TIME_0"] == serial_header["TIME_0"] == 100. + 60. * idx
+        assert header["PHASE"] == serial_header["PHASE"]
+
+
+def test_noise_seed_history(reference):
+    """
+    The noise seed of each simulation is recorded in the history
+    """
+    serial = reference.outputs("[noise_bis]\nactive = True\n[noise]\nseed = 42\n")
+    for (idx, name) in enumerate(serial):
+        history = str(serial[name][1]["HISTORY"])
+        assert "Noise seed entropy=42 spawn_key=({},)".format(idx) in history
+
+
+def test_workers_background(simulations, tmp_path, monkeypatch):
+    """
+    With a background, the workers use the background ramps computed by the parent process, one per frame time,
+    same outputs
+    """
+    (input_dir, mask_file) = simulations
+    det_image = glob.glob(os.path.join(input_dir, "simulation_003", "det_images", "det_image_*.fits"))[0]
+    with fits.open(det_image, mode="update") as hdulist:
+        hdulist[0].header["TFRAME"] = 2 * FRAME_TIME
+    shared_keys = []
+    shared_arrays = mirisim_tso.parallel._shared_arrays
+
+    def recording_shared_arrays(*args):
+        (arrays, background_keys) = shared_arrays(*args)
+        shared_keys.extend(background_keys)
+        return arrays, background_keys
+
+    monkeypatch.setattr(mirisim_tso.parallel, "_shared_arrays", recording_shared_arrays)
+    background_file = str(tmp_path / "background.fits")
+    fits.writeto(background_file, np.random.default_rng(1).uniform(0., 50., (NB_Y, NB_X)))
+    extra = "[background]\nfilename = \"{}\"\n".format(background_file)
+
+    serial_dir = str(tmp_path / "serial")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, serial_dir, mask_file, extra))
+
+    pool_dir = str(tmp_path / "pool")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, pool_dir, mask_file, extra),
+                                                     workers=2)
+
+    assert sorted(shared_keys) == [(NB_FRAMES, FRAME_TIME, GAIN), (NB_FRAMES, 2 * FRAME_TIME, GAIN)]
+
+    serial = read_outputs(serial_dir)
+    pool = read_outputs(pool_dir)
+    assert len(pool) == NB_SIMULATIONS
+    for name in serial:
+        npt.assert_array_equal(serial[name][0], pool[name][0])
+
+
+def test_effect_state_without_cache(simulations, tmp_path):
+    """
+    Without coefficient cache, the effects of the next integrations of the same illum_model are incremental
+    """
+    (input_dir, mask_file) = simulations
+    config = mirisim_tso.utils.get_config(write_config(tmp_path, input_dir, str(tmp_path / "output"), mask_file))
+    simulation = os.path.join(input_dir, "simulation_000")
+    state = mirisim_tso.effects.EffectState()
+    for t_0 in [100., 160., 220.]:
+        mirisim_tso.single_simulation_post_treatment(simulation, t_0, 0., config, state=state)
+    assert (state.nb_full, state.nb_incremental) == (1, 2)
+
+
+def test_resume(simulations, tmp_path):
+    """
+    With resume, a rerun only processes the simulations whose inputs or effect configuration have changed
+    """
+    (input_dir, mask_file) = simulations
+    output_dir = str(tmp_path / "output")
+    config_filename = write_config(tmp_path, input_dir, output_dir, mask_file, simulations_extra="resume = True")
+
+    mirisim_tso.sequential_lightcurve_post_treatment(config_filename)
+    outputs = sorted(glob.glob(os.path.join(output_dir, "simulation_*.fits")))
+    assert len(outputs) == NB_SIMULATIONS
+    for filename in outputs:
+        os.utime(filename, ns=(0, 0))
+
+    # Nothing changed: nothing is done
+    mirisim_tso.sequential_lightcurve_post_treatment(config_filename)
+    assert [os.stat(filename).st_mtime_ns for filename in outputs] == [0] * NB_SIMULATIONS
+
+    # One input changed: only this simulation is done again
+    det_image = glob.glob(os.path.join(input_dir, "simulation_002", "det_images", "*.fits"))[0]
+    os.utime(det_image, ns=(10**9, 10**9))
+    mirisim_tso.sequential_lightcurve_post_treatment(config_filename)
+    assert [os.stat(filename).st_mtime_ns != 0 for filename in outputs] == [False, False, True, False]
+
+    # Effect configuration changed: everything is done again
+    config_filename = write_config(tmp_path, input_dir, output_dir, mask_file, simulations_extra="resume = True",
+                                   duration=500.)
+    mirisim_tso.sequential_lightcurve_post_treatment(config_filename)
+    assert all(os.stat(filename).st_mtime_ns != 0 for filename in outputs)
+
+
+def test_resume_container(simulations, tmp_path):
+    """
+    With resume, a container recreated for more simulations gets the integrations of the simulations already done
+    """
+    (input_dir, mask_file) = simulations
+    output_dir = str(tmp_path / "output")
+    extra = "[container]\nactive = True\n"
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, output_dir, mask_file, extra,
+                                                                  simulations_extra="resume = True\nnb_simulations = 2"))
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, output_dir, mask_file, extra,
+                                                                  simulations_extra="resume = True"))
+
+    data = fits.getdata(os.path.join(output_dir, "integrations_det_images_drift1_idle_anneal.fits"), 1)
+    assert data.shape[0] == NB_SIMULATIONS
+    assert all(np.any(integration != 0.) for integration in data)
+
+
+def test_noise_realisations(simulations, tmp_path):
+    """
+    Each noise realisation is written in its own directory, with its own noise, the same with streaming
+    """
+    (input_dir, mask_file) = simulations
+    extra = "[noise_bis]\nactive = True\n[noise]\nseed = 7\nn_realisations = 3\n"
+
+    serial_dir = str(tmp_path / "serial")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, serial_dir, mask_file, extra))
+    assert read_outputs(serial_dir) == {}
+
+    streaming_dir = str(tmp_path / "streaming")
+    extra_streaming = extra + "[streaming]\nactive = True\nmax_in_flight = 1\n"
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, streaming_dir, mask_file,
+                                                                  extra_streaming))
+
+    realisations = [read_outputs(os.path.join(serial_dir, "realisation_{:03d}".format(realisation)))
+                    for realisation in range(3)]
+    for (realisation, outputs) in enumerate(realisations):
+        assert len(outputs) == NB_SIMULATIONS
+        streaming = read_outputs(os.path.join(streaming_dir, "realisation_{:03d}".format(realisation)))
+        for (idx, name) in enumerate(outputs):
+            npt.assert_array_equal(outputs[name][0], streaming[name][0])
+            history = str(outputs[name][1]["HISTORY"])
+            assert "Noise seed entropy=7 spawn_key=({}, {})".format(idx, realisation) in history
+
+    name = sorted(realisations[0])[0]
+    assert not np.array_equal(realisations[0][name][0], realisations[1][name][0])
+
+
+@pytest.mark.parametrize("streaming", ["False", "True"])
+def test_det_image_opened_once(simulations, tmp_path, monkeypatch, streaming):
+    """
+    The det_image of a simulation is opened once for the read and all the writes, the outputs of the same det_image
+    do not share their header edits
+    """
+    (input_dir, mask_file) = simulations
+    det_images = []
+    fits_open = fits.open
+
+    def counting_open(name, *args, **kwargs):
+        if os.path.basename(str(name)).startswith("det_image_"):
+            det_images.append(name)
+        return fits_open(name, *args, **kwargs)
+
+    monkeypatch.setattr(fits, "open", counting_open)
+    extra = "[noise_bis]\nactive = True\n[noise]\nseed = 2\nn_realisations = 2\n"
+    extra += "[streaming]\nactive = {}\n".format(streaming)
+    output_dir = str(tmp_path / "outputs")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, output_dir, mask_file, extra))
+    monkeypatch.undo()
+
+    assert len(det_images) == len(set(det_images)) == NB_SIMULATIONS
+    for realisation in range(2):
+        outputs = read_outputs(os.path.join(output_dir, "realisation_{:03d}".format(realisation)))
+        assert len(outputs) == NB_SIMULATIONS
+        for (data, header) in outputs.values():
+            history = [str(line) for line in header["HISTORY"]]
+            assert len([line for line in history if line.startswith("Post processing")]) == 1
+            assert len([line for line in history if line.startswith("MIRISim TSO: Noise realisation")]) == 1
+
+
+@pytest.mark.parametrize("mode", ["serial", "workers", "streaming"])
+def test_container(reference, tmp_path, mode):
+    """
+    The container has the integrations of all the simulations, the same as the files written per simulation,
+    and their times in the INTEGRATIONS table
+    """
+    serial = reference.outputs()
+
+    extra = "[container]\nactive = True\n"
+    if mode == "streaming":
+        extra += "[streaming]\nactive = True\n"
+    container_dir = str(tmp_path / "container")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, reference.input_dir, container_dir,
+                                                                  reference.mask_file, extra),
+                                                     workers=2 if mode == "workers" else 1)
+    assert read_outputs(container_dir) == {}
+
+    with fits.open(os.path.join(container_dir, "integrations_det_images_drift1_idle_anneal.fits")) as hdulist:
+        assert hdulist[0].header["NINTS"] == NB_SIMULATIONS
+        assert hdulist[1].data.shape == (NB_SIMULATIONS, NB_FRAMES, NB_Y, NB_X)
+        table = hdulist["INTEGRATIONS"].data
+        npt.assert_array_equal(table["INTEGRATION"], np.arange(NB_SIMULATIONS))
+        npt.assert_allclose(table["TIME_0"], 100. + 60. * np.arange(NB_SIMULATIONS))
+        for (idx, name) in enumerate(serial):
+            assert name.startswith(table["SIMULATION"][idx])
+            npt.assert_array_equal(hdulist[1].data[idx], serial[name][0][0])
+            assert table["PHASE"][idx] == serial[name][1]["PHASE"]
+
+
+def test_container_noise_seed(simulations, tmp_path):
+    """
+    Without a seed, the entropy of the run is written in the container with the spawn key of each integration:
+    the run is reproduced with the entropy as seed
+    """
+    (input_dir, mask_file) = simulations
+    extra = "[container]\nactive = True\n[noise_bis]\nactive = True\n[noise]\nn_realisations = 2\n"
+    container_dir = str(tmp_path / "container")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, container_dir, mask_file, extra))
+
+    containers = []
+    for realisation in range(2):
+        filename = os.path.join(container_dir, "realisation_{:03d}".format(realisation),
+                                "integrations_det_images_drift1_idle_anneal_noisebis.fits")
+        with fits.open(filename) as hdulist:
+            history = [str(line) for line in hdulist[0].header["HISTORY"]]
+            entropy = [re.search(r"Noise seed entropy=(\d+)", line) for line in history]
+            entropy = [match.group(1) for match in entropy if match is not None]
+            assert len(entropy) == 1
+            assert list(hdulist["INTEGRATIONS"].data["SPAWN_KEY"]) == ["({}, {})".format(idx, realisation)
+                                                                       for idx in range(NB_SIMULATIONS)]
+            containers.append((entropy[0], hdulist[1].data.copy()))
+    assert containers[0][0] == containers[1][0]
+
+    seed_dir = str(tmp_path / "seed")
+    extra += "seed = {}\n".format(containers[0][0])
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, seed_dir, mask_file, extra))
+    for realisation in range(2):
+        filename = os.path.join(seed_dir, "realisation_{:03d}".format(realisation),
+                                "integrations_det_images_drift1_idle_anneal_noisebis.fits")
+        npt.assert_array_equal(fits.getdata(filename, 1), containers[realisation][1])
+
+
+def test_segments(simulations, reference, tmp_path):
+    """
+    The segments have the integrations of their simulations, the REFOUT of the det_images and the JWST keywords
+    """
+    (input_dir, mask_file) = simulations
+    det_images = sorted(glob.glob(os.path.join(input_dir, "simulation_*", "det_images", "det_image_*.fits")))
+    refout_shape = (1, NB_FRAMES, NB_Y, 2)
+    for (idx, det_image) in enumerate(det_images):
+        with fits.open(det_image, mode="append") as hdulist:
+            hdulist.append(fits.ImageHDU(np.zeros((NB_Y, NB_X), dtype=np.uint32), name="PIXELDQ"))
+            hdulist.append(fits.ImageHDU(np.full(refout_shape, idx, dtype=np.float32), name="REFOUT"))
+    serial = reference.outputs()
+
+    # Two simulations per segment
+    simulation_size = 4 * (NB_FRAMES * NB_Y * NB_X + np.prod(refout_shape))
+    extra = "[container]\nactive = True\nsegment_size = {}\n".format(2.5 * simulation_size / 1E6)
+    segments_dir = str(tmp_path / "segments")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, segments_dir, mask_file, extra),
+                                                     workers=2)
+
+    names = list(serial)
+    for segment in range(2):
+        filename = os.path.join(segments_dir, "integrations_det_images_drift1_idle_anneal-seg{:03d}.fits".format(
+            segment + 1))
+        with fits.open(filename) as hdulist:
+            assert [hdu.name for hdu in hdulist] == ["PRIMARY", "SCI", "PIXELDQ", "REFOUT", "INTEGRATIONS"]
+            header = hdulist[0].header
+            assert (header["EXSEGNUM"], header["EXSEGTOT"], header["NINTS"]) == (segment + 1, 2, NB_SIMULATIONS)
+            assert (header["INTSTART"], header["INTEND"]) == (2 * segment + 1, 2 * segment + 2)
+            npt.assert_array_equal(hdulist["INTEGRATIONS"].data["INTEGRATION"], [2 * segment, 2 * segment + 1])
+            for idx in range(2):
+                npt.assert_array_equal(hdulist["SCI"].data[idx], serial[names[2 * segment + idx]][0][0])
+                npt.assert_array_equal(hdulist["REFOUT"].data[idx], 2 * segment + idx)
+
+
+def test_segments_simulation_index(simulations, tmp_path):
+    """
+    The integrations are numbered from the index of the simulations, when they don't start at 0
+    """
+    (input_dir, mask_file) = simulations
+    for idx in range(2):
+        shutil.rmtree(os.path.join(input_dir, "simulation_{:03d}".format(idx)))
+
+    simulation_size = 4 * NB_FRAMES * NB_Y * NB_X
+    extra = "[container]\nactive = True\nsegment_size = {}\n".format(1.5 * simulation_size / 1E6)
+    segments_dir = str(tmp_path / "segments")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, segments_dir, mask_file, extra))
+
+    for (segment, idx) in enumerate([2, 3]):
+        filename = os.path.join(segments_dir, "integrations_det_images_drift1_idle_anneal-seg{:03d}.fits".format(
+            segment + 1))
+        with fits.open(filename) as hdulist:
+            header = hdulist[0].header
+            assert (header["INTSTART"], header["INTEND"], header["NINTS"]) == (idx + 1, idx + 1, NB_SIMULATIONS)
+            npt.assert_array_equal(hdulist["INTEGRATIONS"].data["INTEGRATION"], [idx])
+
+
+@pytest.mark.parametrize("mode", ["serial", "workers", "streaming"])
+def test_metrics(simulations, tmp_path, mode):
+    """
+    One line of metrics per simulation, with the time of each stage, and a summary line at the end of the run
+    """
+    (input_dir, mask_file) = simulations
+    extra = "[noise_bis]\nactive = True\n"
+    if mode == "streaming":
+        extra += "[streaming]\nactive = True\n"
+    output_dir = str(tmp_path / "outputs")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, output_dir, mask_file, extra),
+                                                     workers=2 if mode == "workers" else 1)
+
+    with open(os.path.join(output_dir, "mirisim_tso_metrics.jsonl")) as metrics_file:
+        lines = [json.loads(line) for line in metrics_file]
+    records = [line for line in lines if line["type"] == "simulation"]
+    assert len(records) == NB_SIMULATIONS
+    assert lines[-1]["type"] == "summary"
+    for record in records:
+        assert set(record["spans"]) == {"read", "coefficients", "effects", "noise", "header", "write"}
+        assert record["nb_integrations"] == 1
+        assert record["bytes_read"] > 0
+        assert record["bytes_written"] > NB_FRAMES * NB_Y * NB_X * 4
+        assert record["peak_rss"] > 0
+
+    summary = lines[-1]
+    assert summary["nb_integrations"] == NB_SIMULATIONS
+    assert summary["integrations_per_s"] > 0
+    assert set(summary["spans"]) == set(records[0]["spans"])
+    assert all(span["p50"] <= span["p95"] for span in summary["spans"].values())
+
+
+def test_metrics_quality(simulations, tmp_path):
+    """
+    Statistics of the original and output ramps, only when [metrics] quality is set
+    """
+    (input_dir, mask_file) = simulations
+    output_dir = str(tmp_path / "outputs")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, output_dir, mask_file,
+                                                                  "[metrics]\nquality = True\n"))
+    outputs = read_outputs(output_dir)
+
+    with open(os.path.join(output_dir, "mirisim_tso_metrics.jsonl")) as metrics_file:
+        records = [json.loads(line) for line in metrics_file if '"simulation"' in line]
+    for record in records:
+        assert set(record["quality"]) == {"original", "output"}
+        assert "quality" in record["spans"]
+        [output_ramp] = [data for (filename, (data, header)) in outputs.items()
+                         if filename.startswith(os.path.basename(record["simulation"]))]
+        statistics = record["quality"]["output"]
+        npt.assert_allclose(statistics["min"], output_ramp.min())
+        npt.assert_allclose(statistics["max"], output_ramp.max())
+        npt.assert_allclose(statistics["mean"], output_ramp.mean(dtype=np.float64), rtol=1e-6)
+        assert statistics["nb_nan"] == 0
+        assert statistics["nb_negative_differences"] == np.count_nonzero(np.diff(output_ramp, axis=1) < 0)
+
+    output_dir = str(tmp_path / "no_quality")
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, output_dir, mask_file))
+    with open(os.path.join(output_dir, "mirisim_tso_metrics.jsonl")) as metrics_file:
+        records = [json.loads(line) for line in metrics_file if '"simulation"' in line]
+    assert all(record["quality"] == {} and "quality" not in record["spans"] for record in records)
+
+
+def test_log_queue(simulations, tmp_path):
+    """
+    The records of the workers are sent to the main process, which writes them to the log file
+    """
+    (input_dir, mask_file) = simulations
+    output_dir = str(tmp_path / "outputs")
+    mirisim_tso.sequential_lightcurve_post_treatment(
+        write_config(tmp_path, input_dir, output_dir, mask_file, "[noise_bis]\nactive = True\n"), workers=2)
+
+    # The handlers are given back to the root logger once the records of the workers are written
+    root_handlers = logging.getLogger().handlers
+    assert not any(isinstance(handler, logging.handlers.QueueHandler) for handler in root_handlers)
+    for handler in root_handlers:
+        handler.flush()
+
+    with open(os.path.join(output_dir, "mirisim_tso.log")) as log_file:
+        lines = log_file.read().splitlines()
+    assert all(re.match(r"\d\d:\d\d:\d\d \[\w+-?\d*/", line) for line in lines)
+    worker_lines = [idx for (idx, line) in enumerate(lines) if "poisson_noise()" in line]
+    assert len(worker_lines) == NB_SIMULATIONS
+    assert all("MainProcess" not in lines[idx] for idx in worker_lines)
+    assert max(worker_lines) < [idx for (idx, line) in enumerate(lines) if "Done !" in line][0]
+
+
+def test_stage_cache(reference, tmp_path, monkeypatch):
+    """
+    When only the noise changes, the ramps with the deterministic effects are read from the stage cache
+    """
+    (input_dir, mask_file) = (reference.input_dir, reference.mask_file)
+    stage_dir = str(tmp_path / "stages")
+    extra = "[noise_bis]\nactive = True\n[noise]\nseed = {}\n[cache]\nstage_dir = " + stage_dir + "\n"
+
+    mirisim_tso.sequential_lightcurve_post_treatment(write_config(tmp_path, input_dir, str(tmp_path / "first"),
+                                                                  mask_file, extra.format(1)))
+
+    expected = reference.outputs("[noise_bis]\nactive = True\n[noise]\nseed = 2\n")
+
+    def read_simulation(*args, **kwargs):
+        raise AssertionError("det_image read instead of the stage cache")
+
+    monkeypatch.setattr(mirisim_tso.main, "read_simulation", read_simulation)
+    for streaming in ["False", "True"]:
+        output_dir = str(tmp_path / "streaming_{}".format(streaming))
+        mirisim_tso.sequential_lightcurve_post_treatment(write_config(
+            tmp_path, input_dir, output_dir, mask_file, extra.format(2) + "[streaming]\nactive = " + streaming))
+
+        outputs = read_outputs(output_dir)
+        assert len(outputs) == NB_SIMULATIONS
+        for name in expected:
+            npt.assert_array_equal(outputs[name][0], expected[name][0])
+            assert outputs[name][1]["TIME_0"] == expected[name][1]["TIME_0"]
+            assert outputs[name][1]["PHASE"] == expected[name][1]["PHASE"]
+
+
+@pytest.mark.parametrize("streaming", ["False", "True"])
+def test_variants(simulations, tmp_path, streaming):
+    """
+    Each variant is written with its own suffix, as if computed by a run with its effects only
+    """
+    (input_dir, mask_file) = simulations
+    variants = {"drift": ["response_drift_one"],
+                "drift_idle": ["response_drift_one", "idle_recovery"],
+                "all": ["response_drift_one", "idle_recovery", "anneal_recovery", "noise_bis"]}
+    extra = "[noise]\nseed = 3\n[streaming]\nactive = {}\n[variants]\n".format(streaming)
+    for (name, variant_effects) in variants.items():
+        extra += "[[{}]]\neffects = {},\n".format(name, ", ".join(variant_effects))
+
+    output_dir = str(tmp_path / "variants")
+    config_filename = write_config(tmp_path, input_dir, output_dir, mask_file, extra)
+    mirisim_tso.sequential_lightcurve_post_treatment(config_filename)
+    outputs = read_outputs(output_dir)
+    assert len(outputs) == NB_SIMULATIONS * len(variants)
+
+    for (name, variant_effects) in variants.items():
+        config = mirisim_tso.utils.get_config(config_filename)
+        del config["variants"]
+        for effect in mirisim_tso.utils.VARIANT_EFFECTS:
+            config[effect]["active"] = effect in variant_effects
+        config["simulations"]["output_dir"] = str(tmp_path / name)
+        mirisim_tso.sequential_lightcurve_post_treatment(config)
+
+        expected = read_outputs(str(tmp_path / name))
+        assert len(expected) == NB_SIMULATIONS
+        for filename in expected:
+            npt.assert_array_equal(outputs[filename][0], expected[filename][0])
+
+
+def test_variants_errors(simulations, tmp_path):
+    (input_dir, mask_file) = simulations
+    output_dir = str(tmp_path / "variants")
+    with pytest.raises(ValueError, match="unknown effects"):
+        mirisim_tso.sequential_lightcurve_post_treatment(write_config(
+            tmp_path, input_dir, output_dir, mask_file, "[variants]\n[[a]]\neffects = drift,\n"))
+    with pytest.raises(ValueError, match="same effects"):
+        mirisim_tso.sequential_lightcurve_post_treatment(write_config(
+            tmp_path, input_dir, output_dir, mask_file,
+            "[variants]\n[[a]]\neffects = noise,\n[[b]]\neffects = noise,\n"))
@@ -0,0 +1,15 @@
+import mirisim_tso.metrics
+import numpy as np
+
+
+def test_ramp_statistics():
+    """
+    The statistics of a ramp ignore the NaN, and count the negative frame differences
+    """
+    ramp = np.arange(24, dtype=np.float32).reshape((2, 3, 2, 2))
+    ramp[0, 2, 0, 0] = -1.
+    ramp[1, 0, 1, 1] = np.nan
+    statistics = mirisim_tso.metrics.ramp_statistics(ramp)
+    valid = ramp[~np.isnan(ramp)]
+    assert statistics == {"min": -1., "max": 23., "mean": float(valid.mean(dtype=np.float64)), "nb_nan": 1,
+                          "nb_negative_differences": 1}
@@ -0,0 +1,99 @@
+import os
+
+import mirisim_tso
+import numpy as np
+import pytest
+from astropy.io import fits
+
+NB_INTEGRATIONS, NB_FRAMES, NB_Y, NB_X = 2, 40, 64, 72
+
+
+@pytest.fixture
+def config(tmp_path):
+    """
+    Validated configuration with the legacy noise, and the det_image of a simulation
+    """
+    folder = tmp_path / "simulation_000" / "det_images"
+    os.makedirs(folder)
+    ramp = np.zeros((NB_INTEGRATIONS, NB_FRAMES, NB_Y, NB_X), dtype=np.float32)
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(ramp, name="SCI")]).writeto(folder / "det_image_1.fits")
+
+    config_filename = str(tmp_path / "post_treatment.ini")
+    with open(config_filename, "w") as config_file:
+        config_file.write("""
+[simulations]
+input_dir = "{0}"
+filtername = "simulation_*"
+output_dir = "{0}"
+[response_drift_one]
+active = True
+[idle_recovery]
+active = True
+duration = 1000.
+[noise]
+active = True
+[CDP]
+mask_file = "mask.fits"
+""".format(tmp_path))
+    return mirisim_tso.utils.get_config(config_filename)
+
+
+def det_image_filename(simulation_folder):
+    return os.path.join(simulation_folder, "det_images", "det_image_1.fits")
+
+
+def test_det_image_shape(config, tmp_path):
+    (shape, itemsize) = mirisim_tso.scheduler.det_image_shape(det_image_filename(str(tmp_path / "simulation_000")))
+    assert shape == (NB_INTEGRATIONS, NB_FRAMES, NB_Y, NB_X)
+    assert itemsize == 4
+
+
+def test_det_image_layouts(config, tmp_path):
+    simulation = str(tmp_path / "simulation_000")
+    with fits.open(det_image_filename(simulation), mode="update") as hdulist:
+        hdulist[0].header["TFRAME"] = 0.159
+    layouts = mirisim_tso.scheduler.det_image_layouts([(simulation, 0., 0., None)], det_image_filename)
+    assert layouts == {simulation: ((NB_INTEGRATIONS, NB_FRAMES, NB_Y, NB_X), 4, 0.159, None)}
+
+
+def test_simulation_bytes(config):
+    shape = (NB_INTEGRATIONS, NB_FRAMES, NB_Y, NB_X)
+    cube = 4 * NB_INTEGRATIONS * NB_FRAMES * NB_Y * NB_X
+    nb_bytes = mirisim_tso.scheduler.simulation_bytes(shape, config)
+    assert nb_bytes > 4 * cube
+    assert mirisim_tso.scheduler.simulation_bytes(shape, config, chunk_frames=4) < nb_bytes - cube
+    config["noise"]["active"] = False
+    assert mirisim_tso.scheduler.simulation_bytes(shape, config) < 4 * cube
+
+
+def test_plan(config, tmp_path, monkeypatch):
+    """
+    The workers and the blocks of the noise are chosen to stay under max_memory
+    """
+    # Memory of the simulations only, the interpreter would be most of it with these small det_images
+    monkeypatch.setattr(mirisim_tso.scheduler, "PROCESS_BYTES", 0)
+    tasks = [(str(tmp_path / "simulation_000"), 0., 0., None)] * 8
+    shape = (NB_INTEGRATIONS, NB_FRAMES, NB_Y, NB_X)
+    per_worker = (mirisim_tso.scheduler.process_bytes(shape, config, len(tasks))
+                  + mirisim_tso.scheduler.simulation_bytes(shape, config))
+
+    # Enough memory for 3 workers without blocks
+    config["simulations"]["max_memory"] = 3.5 * per_worker / 1E6
+    plan = mirisim_tso.scheduler.plan(tasks, config, det_image_filename, workers=0, cpu_count=3)
+    assert (plan.workers, plan.chunk_frames) == (3, None)
+
+    # 4 workers fit with blocks of noise
+    plan = mirisim_tso.scheduler.plan(tasks, config, det_image_filename, workers=0, cpu_count=4)
+    assert plan.workers == 4
+    assert plan.chunk_frames < NB_FRAMES
+    assert plan.workers * (mirisim_tso.scheduler.process_bytes(shape, config, len(tasks))
+                           + plan.simulation_bytes) <= plan.available
+
+    # The requested number of workers is an upper bound
+    plan = mirisim_tso.scheduler.plan(tasks, config, det_image_filename, workers=2, cpu_count=8)
+    assert (plan.workers, plan.chunk_frames) == (2, None)
+
+    # Not enough memory for a simulation: serial, smallest blocks
+    config["simulations"]["max_memory"] = 1.
+    plan = mirisim_tso.scheduler.plan(tasks, config, det_image_filename, workers=0, cpu_count=4)
+    assert (plan.workers, plan.chunk_frames) == (1, 1)
@@ -0,0 +1,45 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import mirisim_tso.effects
+import mirisim_tso.shared
+
+
+def test_shared_arrays():
+    """
+    The attached arrays are read-only views of the same values, released on close
+    """
+    arrays = {"mask": np.eye(4, dtype=bool), "ramp": np.arange(24, dtype=np.float32).reshape(2, 3, 4),
+              "empty": np.zeros(0)}
+    with mirisim_tso.shared.SharedArrays(arrays) as shared_arrays:
+        attached = mirisim_tso.shared.attach(shared_arrays.description)
+        assert attached.keys() == arrays.keys()
+        for (name, array) in arrays.items():
+            assert attached[name].dtype == array.dtype
+            npt.assert_array_equal(attached[name], array)
+            assert not attached[name].flags.writeable
+        description = shared_arrays.description
+
+    with pytest.raises(FileNotFoundError):
+        mirisim_tso.shared.attach(description)
+
+
+def test_set_coefficient_tables():
+    """
+    Tables built from the values and slopes of other tables give the same coefficients
+    """
+    tables = mirisim_tso.effects.coefficient_tables()
+    signal = np.linspace(-10., 12000., 1001)[np.newaxis, :]
+    expected = mirisim_tso.effects.response_drift_coefficients(signal, tabulated=True)
+    try:
+        mirisim_tso.effects.set_coefficient_tables({name: (table.values.copy(), table.slopes.copy())
+                                                    for (name, table) in tables.items()})
+        assert mirisim_tso.effects.coefficient_tables() is not tables
+        for (terms, expected_terms) in zip(mirisim_tso.effects.response_drift_coefficients(signal, tabulated=True),
+                                           expected):
+            for (value, expected_value) in zip(terms, expected_terms):
+                npt.assert_array_equal(value, expected_value)
+    finally:
+        mirisim_tso.effects.set_coefficient_tables({name: (table.values, table.slopes)
+                                                    for (name, table) in tables.items()})
@@ -1,15 +1,19 @@
+import io
 import os
 from astropy.io import fits
-from astropy.time import Time
 import numpy as np
 import sys
 
 import logging
+import logging.handlers
 import collections
+import contextlib
+import copy
+import hashlib
+import json
+import threading
 
-import validate
-import pkg_resources
-import configobj
+from . import metrics
 
 
 ##  RG 15 March 2022  add BJD-OBS  in write_det_image
@@ -19,6 +23,13 @@ import configobj
 
 LOG = logging.getLogger(__name__)
 
+# Sections of the configuration that change the content of the output det_images
+EFFECT_SECTIONS = ["background", "response_drift", "response_drift_one", "idle_recovery", "anneal_recovery",
+                   "noise", "noise_bis", "CDP", "variants", "container"]
+# Sections of the configuration used by the deterministic effects, before the noise
+DETERMINISTIC_SECTIONS = ["background", "response_drift", "response_drift_one", "idle_recovery", "anneal_recovery"]
+
+
 def read_det_image(filename):
     """
     . Function to read the variable if it comes from a FITS file. Only takes |.fits containing detector image from
@@ -45,7 +56,85 @@ def read_det_image(filename):
         raise
 
 
-def read_illum_model(illum_model_filename, gain):
+class DetImage:
+    """
+    det_image file of a MIRISim simulation, opened once and memory-mapped.
+
+    The science cube and the primary header are read at their first use. The output det_image is written from the
+    same handle (see write_det_image_with_effects), with the new cube and the other extensions of the input file,
+    so that the input file is parsed once per simulation.
+
+    :param str filename: name of the det_image file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            # astropy memory-maps the extensions when it can (not the scaled ones, e.g. unsigned PIXELDQ)
+            self._hdulist = fits.open(filename)
+        except OSError:
+            LOG.error("The det_image file shall be a .fits file")
+            raise
+        # The writer threads of the streaming mode can build outputs of the same det_image at the same time
+        self._lock = threading.Lock()
+
+    @property
+    def header(self):
+        """
+        :return: primary header
+        :rtype: fits.Header
+        """
+        return self._hdulist[0].header
+
+    @property
+    def shape(self):
+        """
+        :return: shape of the ramp (nb_integrations, nb_frames, nb_y, nb_x), from the header
+        :rtype: tuple
+        """
+        return self._hdulist[1].shape
+
+    @property
+    def data(self):
+        """
+        :return: ramp in DN (nb_integrations, nb_frames, nb_y, nb_x), memory-mapped, read-only
+        :rtype: np.ndarray
+        """
+        return self._hdulist[1].data
+
+    def extension(self, extname):
+        """
+        :param str extname: name of an extension (e.g. REFOUT)
+        :return: data of the extension, memory-mapped, read-only
+        :rtype: np.ndarray
+        """
+        with self._lock:
+            return self._hdulist[extname].data
+
+    def output_hdulist(self, new_data):
+        """
+        HDU list of an output det_image: a copy of the primary header, the new cube in the science extension,
+        the other extensions unchanged. The input file is not modified.
+
+        :param np.ndarray new_data: new data cube (nb_integrations, nb_groups, nb_y, nb_x)
+        :rtype: fits.HDUList
+        """
+        with self._lock:
+            hdus = [fits.PrimaryHDU(data=self._hdulist[0].data, header=self._hdulist[0].header.copy()),
+                    fits.ImageHDU(data=new_data, header=self._hdulist[1].header.copy())]
+            return fits.HDUList(hdus + self._hdulist[2:])
+
+    def close(self):
+        self._hdulist.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_illum_model(illum_model_filename, gain, content=None):
     """
     . Function to read the variable if it comes from a FITS file. Only takes |.fits containing illumination model
     from MIRISim
@@ -58,6 +147,9 @@ def read_illum_model(illum_model_filename, gain):
     gain:
         float - Gain in electron/DN
 
+    content:
+        bytes - [optional] content of the file, already read. By default, the file is read.
+
     >>>> RETURNS
     • slope_array   : np.array - values in DN/s of the illumination
     """
@@ -66,7 +158,7 @@ def read_illum_model(illum_model_filename, gain):
 
 
     if ext==".fits":
-        hdulist      = fits.open(illum_model_filename)
+        hdulist      = fits.open(illum_model_filename if content is None else io.BytesIO(content))
         illumination = (hdulist['INTENSITY'].data).squeeze() # RG  15 nov 2021
         hdulist.close()
 
@@ -82,6 +174,41 @@ def read_illum_model(illum_model_filename, gain):
         raise ValueError
 
 
+class IllumModel:
+    """
+    illum_model file of a MIRISim simulation, read once in memory.
+
+    The illumination is decoded from the FITS content only when signal() is called, the digest of the content
+    identifies identical illuminations without decoding them.
+
+    :param str filename: name of the illum_model file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as illum_model_file:
+            self.content = illum_model_file.read()
+        self._digest = None
+
+    @property
+    def digest(self):
+        """
+        :return: hexadecimal digest of the content of the file
+        :rtype: str
+        """
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self.content, digest_size=20).hexdigest()
+        return self._digest
+
+    def signal(self, gain):
+        """
+        :param float gain: Gain in electron/DN
+        :return: illumination in DN/s, with the 4 reference columns, see read_illum_model
+        :rtype: np.ndarray
+        """
+        return read_illum_model(self.filename, gain, content=self.content)
+
+
 def extract_signal(illum_models_directory, x, y):
     """
     In order to calculate the effects evolution parameters, one need the theoretical slope. It is available in MIRISim illum_model.
@@ -166,6 +293,54 @@ def init_log(log="mirisim_tso.log", stdout_loglevel="INFO", file_loglevel="DEBUG
     logging.config.dictConfig(log_config)
 
 
+@contextlib.contextmanager
+def queue_logging(log_queue):
+    """
+    Send the records of the root logger through a queue to a listener thread, which owns the handlers of the root
+    logger (console and file, see init_log). The worker processes send their records to the same queue
+    (see init_queue_log): the log file is written by a single thread, in the order of the records.
+
+    The handlers are given back to the root logger at exit, once the records in the queue are handled.
+
+    :param multiprocessing.Queue log_queue: queue of the log records
+    :return: level of the records to send from the worker processes, see init_queue_log
+    :rtype: int
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    # Lowest level handled, the records under this level are dropped by the workers, not sent
+    level = max(root.getEffectiveLevel(), min((handler.level for handler in handlers), default=logging.WARNING))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener.start()
+    try:
+        yield level
+    finally:
+        root.removeHandler(queue_handler)
+        listener.stop()
+        for handler in handlers:
+            root.addHandler(handler)
+
+
+def init_queue_log(log_queue, level=logging.DEBUG):
+    """
+    Logging of a worker process: the records of the root logger are only sent to the listener of the parent process,
+    see queue_logging. The handlers inherited from the parent process (fork) are removed.
+
+    :param multiprocessing.Queue log_queue: queue of the log records
+    :param int level: level of the root logger
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+
 def update_dict(d, u):
     """
     Recursively merge or update dict-like objects.
@@ -187,37 +362,14 @@ def update_dict(d, u):
     return d
 
 
-def write_det_image_with_effects(original_path, new_path, new_data, extra_metadata, config, obs_time=None, overwrite=True):
+def output_suffix(config):
     """
-    Based on the original .fits file, will overwrite the data cube with the one given
-    in parameter.
-    This .fits file will be stored in the same simulation folder, but in a new subfolder called
-    "det_images_post_processed".
-
-
-    Parameters
-    ----------
-    original_path: str
-        Full path (relative or absolute) with filename of the input det_image
-    new_path: str
-        Full path (relative or absolute) with filename of the input det_image
-    new_data: np.ndarray
-        new data cube (nb_integrations, nb_groups, nb_y, nb_x)
-    extra_metadata: dict
-        New metadata you want to add in the future .fits file (as opposed to the original one)
-    obs_time : float
-       barycenter julian date of the start of the exposure
-    overwrite: bool
-        [optional] By defaut, True. Do you want to overwrite the post_processed .fits file if it already exists?
-
-    Returns
-    -------
-    Write a new .fits file
+    Name of the output det_image, depending on the effects activated in the configuration.
 
+    :param dict config: validated configuration
+    :return: suffix added to the simulation name, "det_images" if all effects are deactivated
+    :rtype: str
     """
-
-    # Construct name depending on effect activated
-
     final_dir = "det_images"
 
     if 'add_background' in config:
@@ -245,7 +397,41 @@ def write_det_image_with_effects(original_path, new_path, new_data, extra_metada
             final_dir += "_noisebis"
             #print('config["noise_bis"]["active"]', type(config["noise_bis"]["active"]))
 
- 
+    return final_dir
+
+
+def write_det_image_with_effects(original_path, new_path, new_data, extra_metadata, config, obs_time=None, overwrite=True):
+    """
+    Based on the original .fits file, will overwrite the data cube with the one given
+    in parameter.
+    This .fits file will be stored in the same simulation folder, but in a new subfolder called
+    "det_images_post_processed".
+
+
+    Parameters
+    ----------
+    original_path: str or DetImage
+        Full path (relative or absolute) with filename of the input det_image, or the input det_image already opened
+    new_path: str
+        Full path (relative or absolute) with filename of the input det_image
+    new_data: np.ndarray
+        new data cube (nb_integrations, nb_groups, nb_y, nb_x)
+    extra_metadata: dict
+        New metadata you want to add in the future .fits file (as opposed to the original one)
+    obs_time : float
+       barycenter julian date of the start of the exposure
+    overwrite: bool
+        [optional] By defaut, True. Do you want to overwrite the post_processed .fits file if it already exists?
+
+    Returns
+    -------
+    Write a new .fits file
+
+    """
+
+    # Construct name depending on effect activated
+    final_dir = output_suffix(config)
+
     # If all effects are deactivated, don't write any outputs
     if final_dir == "det_images":
         LOG.warning("All effects are deactivated, not writing any output")
@@ -254,32 +440,37 @@ def write_det_image_with_effects(original_path, new_path, new_data, extra_metada
     original_name = os.path.basename(original_path)
     original_dir = os.path.dirname(original_path)
     """
-    hdulist = fits.open(original_path)
+    if isinstance(original_path, DetImage):
+        det_image = original_path
+    else:
+        det_image = DetImage(original_path)
 
     # Replace existing data
-    hdulist[1].data = new_data
+    hdulist = det_image.output_hdulist(new_data)
 
-    metadata = hdulist[0].header
-    if(obs_time is not None):
-        my_obs_time = Time(obs_time, format='jd')
-        date_obs = my_obs_time.to_value('iso', 'date')
-        time_obs = my_obs_time.to_value('iso', 'date_hms')[11:-4]
-        metadata['DATE-OBS'] = date_obs, '[yyyy-mm-dd] UTC date at start of exposure, barycenter'
-        metadata['TIME-OBS'] = time_obs, '[hh:mm:ss.sss] UTC time at start of exposure, barycenter '
-        metadata['MJD-OBS']  = my_obs_time.mjd, 'Modified Julian Day, start of exposure, barycenter'
-        metadata['BJD-OBS']  = obs_time, 'Barycenter Julian Day, start of exposure'
+    with metrics.span("header"):
+        metadata = hdulist[0].header
+        if(obs_time is not None):
+            from astropy.time import Time
+            my_obs_time = Time(obs_time, format='jd')
+            date_obs = my_obs_time.to_value('iso', 'date')
+            time_obs = my_obs_time.to_value('iso', 'date_hms')[11:-4]
+            metadata['DATE-OBS'] = date_obs, '[yyyy-mm-dd] UTC date at start of exposure, barycenter'
+            metadata['TIME-OBS'] = time_obs, '[hh:mm:ss.sss] UTC time at start of exposure, barycenter '
+            metadata['MJD-OBS']  = my_obs_time.mjd, 'Modified Julian Day, start of exposure, barycenter'
+            metadata['BJD-OBS']  = obs_time, 'Barycenter Julian Day, start of exposure'
 
-    # Treat history separately
-    if "history" in extra_metadata:
-        history_list = extra_metadata["history"]
+        # Treat history separately
+        if "history" in extra_metadata:
+            history_list = extra_metadata["history"]
 
-        for line in history_list:
-            metadata["history"] = line
+            for line in history_list:
+                metadata["history"] = line
 
-        del(extra_metadata["history"])
+            del(extra_metadata["history"])
 
-    # Update the rest of the parameters
-    metadata.update(extra_metadata)
+        # Update the rest of the parameters
+        metadata.update(extra_metadata)
 
     """
     new_path = os.path.abspath(os.path.join(original_dir, os.path.pardir, final_dir))
@@ -288,7 +479,29 @@ def write_det_image_with_effects(original_path, new_path, new_data, extra_metada
     new_path = os.path.join(new_path, original_name)
     """
     
-    hdulist.writeto(new_path+final_dir+'.fits', overwrite=overwrite)
+    with metrics.span("write"):
+        hdulist.writeto(new_path+final_dir+'.fits', overwrite=overwrite)
+    metrics.add_bytes(written=os.path.getsize(new_path+final_dir+'.fits'))
+    if det_image is not original_path:
+        det_image.close()
+
+
+def config_digest(config, sections=None):
+    """
+    Digest of a part of the configuration, to detect a change of the parameters between two runs.
+
+    :param dict config: validated configuration
+    :param list(str) sections: [optional] sections to use, by default EFFECT_SECTIONS. Missing sections are ignored.
+    :return: hexadecimal SHA-256 digest
+    :rtype: str
+    """
+    if sections is None:
+        sections = EFFECT_SECTIONS
+
+    selected = {section: dict(config[section]) for section in sections if section in config}
+    text = json.dumps(selected, sort_keys=True, default=str)
+
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
 def get_nested(data, args):
@@ -327,9 +540,12 @@ def get_config(filename):
     if not os.path.isfile(filename):
         raise ValueError("The file '{}' can't be found".format(filename))
 
+    import configobj
+    import validate
+
     # Prepare to convert values in the config file
     val = validate.Validator()
-    specfile = pkg_resources.resource_filename('mirisim_tso', 'configspec.ini')
+    specfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configspec.ini')
     configspec = configobj.ConfigObj(specfile, list_values=False)
 
     config = configobj.ConfigObj(filename, configspec=configspec, raise_errors=True)
@@ -366,6 +582,108 @@ def progressBar(value, endvalue, message, bar_length=20):
     sys.stdout.flush()
 
 
+def noise_active(config_dict):
+    """
+    :param dict config_dict: validated configuration
+    :return: True if noise or noise_bis is active
+    :rtype: bool
+    """
+    return config_dict["noise"]["active"] or ('noise_bis' in config_dict and config_dict["noise_bis"]["active"])
+
+
+def nb_realisations(config_dict):
+    """
+    :param dict config_dict: validated configuration
+    :return: number of noise realisations written for each simulation. 1 if the noise is not active.
+    :rtype: int
+    """
+    if not noise_active(config_dict):
+        return 1
+    return config_dict["noise"].get("n_realisations", 1)
+
+
+# Effects which can be activated or not in a variant, see variant_configs
+VARIANT_EFFECTS = ["response_drift", "response_drift_one", "idle_recovery", "anneal_recovery", "noise", "noise_bis"]
+
+
+def variant_configs(config_dict):
+    """
+    Configurations of the variants of the [variants] section.
+
+    A variant activates the effects in its list, and deactivates the others. The parameters of the effects and the
+    background are the ones of the configuration. Each variant is written with its own output suffix.
+
+    :param dict config_dict: validated configuration
+    :return: list of (name, configuration). Without variants, [(None, config_dict)]
+    :rtype: list(tuple)
+    """
+    variants = config_dict.get("variants", {})
+    if not variants:
+        return [(None, config_dict)]
+
+    base = config_dict.dict() if hasattr(config_dict, "dict") else copy.deepcopy(config_dict)
+    del base["variants"]
+
+    configs = []
+    suffixes = {}
+    for (name, variant) in variants.items():
+        unknown = set(variant["effects"]) - set(VARIANT_EFFECTS)
+        if unknown:
+            raise ValueError("Variant {}: unknown effects {}, allowed: {}".format(name, sorted(unknown),
+                                                                                VARIANT_EFFECTS))
+        variant_config = copy.deepcopy(base)
+        for effect in VARIANT_EFFECTS:
+            variant_config.setdefault(effect, {})["active"] = effect in variant["effects"]
+
+        suffix = output_suffix(variant_config)
+        if suffix in suffixes:
+            raise ValueError("Variants {} and {} have the same effects".format(suffixes[suffix], name))
+        suffixes[suffix] = name
+        configs.append((name, variant_config))
+
+    return configs
+
+
+def union_config(configs):
+    """
+    Configuration with the effects active in at least one of the configurations.
+
+    :param list(dict) configs: configurations of the variants, see variant_configs
+    :rtype: dict
+    """
+    union = copy.deepcopy(configs[0])
+    for effect in VARIANT_EFFECTS:
+        if effect in union:
+            union[effect]["active"] = any(config[effect]["active"] for config in configs)
+    return union
+
+
+def realisation_folder(output_folder, realisation):
+    """
+    Output directory of a noise realisation.
+
+    :param str output_folder: output directory of the run
+    :param int realisation: index of the noise realisation
+    :rtype: str
+    """
+    return os.path.join(output_folder, "realisation_{:03d}".format(realisation))
+
+
+def simulation_index(simulation_folder):
+    """
+    Index of a MIRISim simulation folder, from its name (e.g. simulation_012 -> 12).
+
+    :param str simulation_folder: path to the MIRISim simulation folder
+    :return: index of the simulation, or None if the name doesn't end with an integer
+    :rtype: int
+    """
+    name = os.path.basename(os.path.normpath(simulation_folder))
+    try:
+        return int(name.split("_")[-1])
+    except ValueError:
+        return None
+
+
 def read_mask(filename, mode="LRS"):
     """
     Read MIRI CDP MASK and return mask cropped for a SLITLESS observation (mode = LRS)
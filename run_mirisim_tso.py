@@ -4,14 +4,13 @@
 """
 Example of how to use the mirisim_tso package
 """
-import sys
+import argparse
 import mirisim_tso
 
-if len(sys.argv) > 1:
-    config_filename = sys.argv[1]
-else:
-    sys.stdout.write('Configuration file missing')
-    sys.exit()
-
-mirisim_tso.sequential_lightcurve_post_treatment(config_filename)
+parser = argparse.ArgumentParser(description="Post-treatment of MIRISim simulations for time-series observations")
+parser.add_argument("config_filename", help="configuration file (.ini)")
+parser.add_argument("-w", "--workers", type=int, default=None,
+                    help="number of worker processes (default: [simulations] workers of the configuration file)")
+args = parser.parse_args()
 
+mirisim_tso.sequential_lightcurve_post_treatment(args.config_filename, workers=args.workers)